@@ -2,27 +2,133 @@
 # MPL/GPL/LGPL licensed
 # Andrew Sutherland <asutherland@asutherland.org>
 #
-# Usage: addrsymfilt.py <PID>
+# Usage: addrsymfilt.py [--stats] [--block-size BYTES] <PID>
 #
 # Example: stap mytap.stp | addrsymfilt.py `pgrep thunderbird-bin`
 #
 # We filter the provided text stream, replacing any addresses we find with the
-#  closest preceding symbol found in the process.
+#  closest preceding symbol found in the process.  The stream is processed in
+#  large blocks (whatever is available, up to --block-size) so that we can keep
+#  up with a busy stap pipe; --stats reports how fast we went on stderr.
 #
 # This is accomplished by reading /proc/PID/maps to understand the address space
 # of the process.  Once we have this information, we are able to get the symbols
-# for each process using 'nm'.  (We could be fancier, but why bother?)  We do
-# not do anything with dwarf debug symbols, but do ask nm to perform C++
-# demangling for us.
+# for each binary.  We read the ELF program headers and symbol tables ourselves
+# (see elfsyms.py) because spinning up 'readelf' and 'nm' for something
+# libxul-sized takes seconds; if that does not work out we still fall back to
+# the binutils.  We do not do anything with dwarf debug symbols.  C++ names
+# stay mangled until we actually hand them out, at which point demangler.py
+# takes care of them.
 #
 
 import sys, re
-import subprocess
+import array, bisect, multiprocessing, optparse, os, subprocess, time
+
+import demangler, elfsyms, symcache
 
 
 def hexparse(x):
     return int(x, 16)
 
+def cleanSymbolName(symname):
+    '''
+    Turn a demangled symbol name into the display name we use when not asked
+    for the raw name; thunks get abbreviated and big argument lists get
+    elided.
+    '''
+    # - trim the symbol name of junk
+    if symname.startswith('non-virtual thunk to '):
+        symname = 'thunk:' + symname[21:]
+
+    # - Special (non-)transformations...
+    if (symname.startswith('nsRunnableMethod') or
+        symname.startswith('vtable for nsRunnableMethod')):
+        pass
+    # - Otherwise clean up ranty big parts
+    else:
+        idxParen = symname.find('(')
+        if idxParen >= 0:
+            if symname[idxParen+1] != ')':
+                ridxParen = symname.find(')', idxParen+1)
+                symname = symname[:idxParen+1] + '...' + symname[ridxParen:]
+    return symname
+
+class SymbolTable(object):
+    '''
+    Compact address-sorted symbol table.  Rather than keeping a tuple and two
+    strings around per symbol (which for libxul-sized binaries adds up to
+    hundreds of megs), we keep the addresses in one array, offsets into a
+    single buffer of nul-terminated (interned) names in another, and only
+    create the strings for symbols someone actually asks about.
+
+    Names are stored mangled; we only demangle the ones we hand out.
+
+    The names buffer can be a string or anything else that supports find()
+    and slicing, like the mmap symcache hands us.  namesBase is the offset of
+    the blob of names within it.
+    '''
+    def __init__(self, addrs, nameOffsets, names, namesBase=0):
+        self.addrs = addrs
+        self.nameOffsets = nameOffsets
+        self.names = names
+        self.namesBase = namesBase
+        self.demangler = demangler.getDemangler()
+
+    @classmethod
+    def fromSorted(cls, rawsyms):
+        '''
+        Build a table from a list of (addr, mangled name) sorted by address,
+        dropping all but the first symbol at any given address.
+        '''
+        addrs = array.array('L')
+        nameOffsets = array.array('I')
+        name_offsets = {}
+        blob_parts = []
+        blob_size = 0
+        lastaddr = -1
+        for addr, name in rawsyms:
+            # no dupes!
+            if addr == lastaddr:
+                continue
+            lastaddr = addr
+
+            offset = name_offsets.get(name)
+            if offset is None:
+                offset = name_offsets[name] = blob_size
+                blob_parts.append(name)
+                blob_parts.append('\0')
+                blob_size += len(name) + 1
+            addrs.append(addr)
+            nameOffsets.append(offset)
+        return cls(addrs, nameOffsets, ''.join(blob_parts))
+
+    def __len__(self):
+        return len(self.addrs)
+
+    def lookup(self, addr):
+        '''
+        @returns the index of the closest symbol at or preceding addr, or -1
+            if there is no such symbol.
+        '''
+        return bisect.bisect_right(self.addrs, addr) - 1
+
+    def mangledName(self, i):
+        start = self.namesBase + self.nameOffsets[i]
+        return self.names[start:self.names.find('\0', start)]
+
+    def rawName(self, i):
+        return self.demangler.demangle(self.mangledName(i))
+
+    def rawNames(self, indices):
+        '''
+        Batch version of rawName, demangling everything in one go.
+        '''
+        return self.demangler.demangleMany([self.mangledName(i)
+                                            for i in indices])
+
+    def displayName(self, i):
+        return cleanSymbolName(self.rawName(i))
+
 class BinaryInfo(object):
     '''
     Provides address to symbol translation for a binary with on-demand retrieval
@@ -32,12 +138,46 @@ class BinaryInfo(object):
     We do some pragmatic if likely sketchy things when it comes to address
     mapping.  Sadly, I even used to know how to do these things properly, but
     it turns out this is easier than re-learning.  See _loadOffsetInfo.
+
+    If given a symcache.SymbolCache we will try and load our symbols from it
+    before doing any real work, and populate it when we had to do real work.
+
+    Symbols can also be loaded ahead of time in another process by
+    startPreload; we only wait on that when we actually need the symbols.
     '''
-    def __init__(self, path):
+    def __init__(self, path, symbolCache=None):
         self.path = path
+        self.symbolCache = symbolCache
         #: the adjustment to apply if we have any offset passed
         self.offsetAdjustment = 0
         self.symbols = None
+        #: AsyncResult for our symbols if they are being preloaded
+        self.pendingLoad = None
+
+    def startPreload(self, pool):
+        '''
+        Start loading our symbols in the given multiprocessing pool.
+        '''
+        self.pendingLoad = pool.apply_async(_preloadSymbols,
+                                            (self.path, self.symbolCache))
+
+    def _finishPreload(self):
+        '''
+        Wait for our preload to complete and adopt its results.  Returns False
+        if the preload failed, in which case the caller should just load the
+        symbols itself.
+        '''
+        pendingLoad = self.pendingLoad
+        self.pendingLoad = None
+        try:
+            offsetAdjustment, addrs, nameOffsets, names = pendingLoad.get()
+        except Exception, e:
+            sys.stderr.write('Preloading symbols for %s failed: %s\n' %
+                             (self.path, e))
+            return False
+        self.offsetAdjustment = offsetAdjustment
+        self.symbols = SymbolTable(addrs, nameOffsets, names)
+        return True
 
     def _loadOffsetInfo(self):
         '''
@@ -60,16 +200,36 @@ class BinaryInfo(object):
                 virtAddr = int(bits[2], 16)
                 self.offsetAdjustment = virtAddr - offset
 
-    def _loadSymbols(self):
+    def _readElfSymbols(self):
         '''
-        Grab symbols from the binary via nm.
+        Get the offset adjustment and the symbols straight out of the ELF file
+        without involving any other processes.  Raises elfsyms.ElfError if the
+        file is not something we understand.
+
+        @returns a list of (addr, mangled name) sorted by address.
         '''
-        self._loadOffsetInfo()
-        self.symbols = []
-        lastaddr = -1
+        elf = elfsyms.ElfFile(self.path)
+        try:
+            # same logic as _loadOffsetInfo; the last LOAD segment wins.
+            for offset, virtAddr, filesz, memsz in elf.loadSegments():
+                self.offsetAdjustment = virtAddr - offset
+            rawsyms = elf.symbols()
+        finally:
+            elf.close()
+
+        # (stable, so .symtab still beats .dynsym on address ties)
+        rawsyms.sort(key=lambda x: x[0])
+        return rawsyms
+
+    def _readNmSymbols(self):
+        '''
+        Grab symbols from the binary via nm.  This is our fallback path for
+        when _readElfSymbols does not work out.
 
-        args = ['/usr/bin/nm', '--demangle', '--defined-only',
-                '--numeric-sort', self.path]
+        @returns a list of (addr, mangled name) sorted by address.
+        '''
+        rawsyms = []
+        args = ['/usr/bin/nm', '--defined-only', '--numeric-sort', self.path]
         proc = subprocess.Popen(args, stdout=subprocess.PIPE)
         for line in proc.stdout:
             try:
@@ -77,33 +237,42 @@ class BinaryInfo(object):
             except Exception, e:
                 # weird lines should not kill us.
                 continue
-            addr = hexparse(addrStr)
-
-            # no dupes!
-            if addr == lastaddr:
-                continue
-
+            rawsyms.append((hexparse(addrStr), symname))
+        return rawsyms
 
-            rawname = symname
+    def _loadSymbols(self):
+        '''
+        Grab symbols from the binary, preferring our in-process ELF reader and
+        falling back to readelf/nm.  Goes through the symbol cache if we
+        have one.
+        '''
+        if self.pendingLoad is not None and self._finishPreload():
+            return
+
+        cache_key = None
+        if self.symbolCache is not None:
+            cache_key = self.symbolCache.keyFor(self.path)
+            cached = self.symbolCache.load(cache_key)
+            if cached is not None:
+                (self.offsetAdjustment, addrs, nameOffsets, names,
+                 namesBase) = cached
+                self.symbols = SymbolTable(addrs, nameOffsets, names,
+                                           namesBase)
+                return
 
-            # - trim the symbol name of junk
-            if symname.startswith('non-virtual thunk to '):
-                symname = 'thunk:' + symname[21:]
+        try:
+            rawsyms = self._readElfSymbols()
+        except elfsyms.ElfError, e:
+            self._loadOffsetInfo()
+            rawsyms = self._readNmSymbols()
 
-            # - Special (non-)transformations...
-            if (symname.startswith('nsRunnableMethod') or
-                symname.startswith('vtable for nsRunnableMethod')):
-                pass
-            # - Otherwise clean up ranty big parts
-            else:
-                idxParen = symname.find('(')
-                if idxParen >= 0:
-                    if symname[idxParen+1] != ')':
-                        ridxParen = symname.find(')', idxParen+1)
-                        symname = symname[:idxParen+1] + '...' + symname[ridxParen:]
+        self.symbols = SymbolTable.fromSorted(rawsyms)
 
-            lastaddr = addr
-            self.symbols.append((addr, symname, rawname))
+        if cache_key is not None and len(self.symbols):
+            self.symbolCache.store(cache_key, self.offsetAdjustment,
+                                   self.symbols.addrs,
+                                   self.symbols.nameOffsets,
+                                   self.symbols.names)
 
     def translateAddress(self, addr, offset, raw=False):
         '''
@@ -112,42 +281,241 @@ class BinaryInfo(object):
         if self.symbols is None:
             self._loadSymbols()
 
-        if raw:
-            result_index = 2
-        else:
-            result_index = 1
-
         if offset:
             addr += offset + self.offsetAdjustment
 
         symbols = self.symbols
-        if not symbols:
+        i = symbols.lookup(addr)
+        if i < 0:
             return None, None
+        if raw:
+            symname = symbols.rawName(i)
+        else:
+            symname = symbols.displayName(i)
+        return symname, addr - symbols.addrs[i]
+
+    def translateAddresses(self, addrOffsets, raw=False):
+        '''
+        Batch version of translateAddress.  Takes a list of (addr, offset)
+        pairs and returns a list of (symbol string, overshoot in bytes) in the
+        same order.  We resolve them in address order so each lookup only has
+        to search the part of the symbol table past the previous one.
+        '''
+        if self.symbols is None:
+            self._loadSymbols()
+
+        adjustment = self.offsetAdjustment
+        adjusted = []
+        for addr, offset in addrOffsets:
+            if offset:
+                addr += offset + adjustment
+            adjusted.append(addr)
+
+        symbols = self.symbols
+        symaddrs = symbols.addrs
+        bisect_right = bisect.bisect_right
+        results = [(None, None)] * len(adjusted)
+        order = sorted(range(len(adjusted)), key=adjusted.__getitem__)
+        found = []
+        symindices = []
         lo = 0
-        hi = len(symbols)
-        while lo < hi:
-            mid = (lo+hi)//2
-            midtupe = symbols[mid]
-            midaddr = midtupe[0]
-            if midaddr < addr:
-                lo = mid+1
-            elif midaddr > addr:
-                hi = mid
-            else:
-                # exact match! hooray!
-                return midtupe[result_index], 0
-        # not an exact match, lo-1 is our index if lo>0
-        if lo:
-            midtupe = symbols[lo-1]
-            return midtupe[result_index], addr-midtupe[0]
-        return None, None
+        for idx in order:
+            addr = adjusted[idx]
+            lo = bisect_right(symaddrs, addr, lo)
+            if lo:
+                found.append(idx)
+                symindices.append(lo - 1)
+
+        # demangle everything we found in one batch
+        names = symbols.rawNames(symindices)
+        for idx, symindex, name in zip(found, symindices, names):
+            if not raw:
+                name = cleanSymbolName(name)
+            results[idx] = (name, adjusted[idx] - symaddrs[symindex])
+        return results
+
+def _preloadSymbols(path, symbolCache):
+    '''
+    multiprocessing worker for BinaryInfo.startPreload; load the symbols and
+    send back (offsetAdjustment, addrs, nameOffsets, names).
+    '''
+    binary = BinaryInfo(path, symbolCache)
+    binary._loadSymbols()
+    symbols = binary.symbols
+    names = symbols.names
+    # (tables from the symcache are still backed by their mapping)
+    if symbols.namesBase or not isinstance(names, str):
+        names = names[symbols.namesBase:]
+    return binary.offsetAdjustment, symbols.addrs, symbols.nameOffsets, names
+
+class LRUCache(object):
+    '''
+    Bounded least-recently-used cache that keeps count of how it is doing.
+    Entries live in a dict and a circular doubly-linked list of
+    [prev, next, key, value] links with the most recently used entry right
+    after the root.
+    '''
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.map = {}
+        self.root = root = []
+        root[:] = [root, root, None, None]
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.map)
+
+    def get(self, key, default=None):
+        link = self.map.get(key)
+        if link is None:
+            self.misses += 1
+            return default
+        self.hits += 1
+        # unlink and move to the front
+        prev, next = link[0], link[1]
+        prev[1] = next
+        next[0] = prev
+        root = self.root
+        first = root[1]
+        link[0] = root
+        link[1] = first
+        first[0] = link
+        root[1] = link
+        return link[3]
+
+    def put(self, key, value):
+        link = self.map.get(key)
+        if link is not None:
+            link[3] = value
+            return
+        root = self.root
+        if len(self.map) >= self.max_size:
+            # evict the least recently used link
+            oldest = root[0]
+            prev = oldest[0]
+            prev[1] = root
+            root[0] = prev
+            del self.map[oldest[2]]
+            self.evictions += 1
+        first = root[1]
+        link = [root, first, key, value]
+        first[0] = link
+        root[1] = link
+        self.map[key] = link
+
+    def clear(self):
+        '''
+        Forget every entry, keeping the counts.
+        '''
+        self.map.clear()
+        root = self.root
+        root[:] = [root, root, None, None]
+
+    def describe(self):
+        lookups = self.hits + self.misses
+        if lookups:
+            hit_rate = 100.0 * self.hits / lookups
+        else:
+            hit_rate = 0.0
+        return ('%d hits, %d misses (%.1f%% hit rate), %d evictions, '
+                '%d/%d entries' % (self.hits, self.misses, hit_rate,
+                                   self.evictions, len(self.map),
+                                   self.max_size))
+
+class MapsLogger(object):
+    '''
+    Records timestamped snapshots of /proc/PID/maps into a directory for the
+    benefit of post-processing, which can replay them using
+    ProcInfo.load_maps_log.  Snapshots are only written when the maps actually
+    change.
+
+    The directory contains an 'epoch' file holding the wall-clock time (in
+    nanoseconds) that trace times are relative to and 'maps-NANOSECONDS'
+    snapshot files named by wall-clock time.
+    '''
+    def __init__(self, pid, logdir, min_interval=1.0):
+        self.pid = pid
+        self.logdir = logdir
+        self.min_interval = min_interval
+        self.last_poll = 0
+        self.last_contents = None
+        if not os.path.isdir(logdir):
+            os.makedirs(logdir)
+
+    def mark_epoch(self, when=None):
+        '''
+        Note the wall-clock time the trace's times are relative to; for
+        systemtap scripts that is when the probes went live.
+        '''
+        if when is None:
+            when = time.time()
+        f = open(os.path.join(self.logdir, 'epoch'), 'w')
+        f.write('%d\n' % (int(when * 1000000000),))
+        f.close()
+
+    def poll(self, force=False):
+        '''
+        Snapshot the maps if it has been long enough since the last time and
+        they changed.  Returns False once the process is gone.
+        '''
+        now = time.time()
+        if not force and now - self.last_poll < self.min_interval:
+            return True
+        self.last_poll = now
+        try:
+            f = open('/proc/%d/maps' % (self.pid,), 'r')
+            try:
+                contents = f.read()
+            finally:
+                f.close()
+        except IOError:
+            return False
+        if contents != self.last_contents:
+            self.last_contents = contents
+            f = open(os.path.join(self.logdir, 'maps-%d' % (
+                        int(now * 1000000000),)), 'w')
+            f.write(contents)
+            f.close()
+        return True
 
 class ProcInfo(object):
-    def __init__(self, pid, mappath=None):
+    def __init__(self, pid, mappath=None, symbol_cache=True,
+                 memo_size=65536, preload=None, preload_jobs=None,
+                 maps_refresh_interval=1.0):
+        '''
+        @param symbol_cache a symcache.SymbolCache to share across our
+            binaries, True (the default) for symcache.SymbolCache.default(),
+            or None to not cache symbols on disk.
+        @param memo_size the number of normalizeHexAddress results to
+            remember; stacks repeat the same return addresses a whole lot.
+        @param preload if True, start loading the symbols for all the mapped
+            binaries in a process pool right away instead of lazily on first
+            use.  If a string, only binaries whose path matches that regular
+            expression get preloaded.  This lets symbol loading overlap with
+            whatever the caller does next (like decoding the trace).
+        @param preload_jobs the number of preload processes; defaults to the
+            number of CPUs.
+        @param maps_refresh_interval if we have a live pid and an address does
+            not fall in any range, we re-read the maps (at most this often, in
+            seconds) in case a library got dlopen'ed since.
+        '''
         #: Tuples of (low addr, high addr, adjust, binary).
         #:  The low address is inclusive, the high address is exclusive.
         self.ranges = []
+        #: bumped every time self.ranges changes after the initial read
+        self.maps_version = 0
+        self.maps_refresh_interval = maps_refresh_interval
+        self.last_maps_read = 0
+        #: sorted (time in mS, path) of maps-log snapshots yet to be applied
+        self.pending_maps = []
         self.binaries_by_path = {}
+        if symbol_cache is True:
+            symbol_cache = symcache.SymbolCache.default()
+        self.symbol_cache = symbol_cache
+        #: (hexaddr, command, padding) => normalizeHexAddress result
+        self.translation_cache = LRUCache(memo_size)
 
         if pid is None:
             self.pid = None
@@ -157,10 +525,54 @@ class ProcInfo(object):
             self.pid = int(pid)
         self._read_maps(mappath)
 
-    def _read_maps(self, mappath=None):
+        if preload:
+            self.start_preload(preload, preload_jobs)
+
+    def start_preload(self, preload=True, jobs=None):
         '''
-        Read /proc/PID/maps to get info about the address space and store it in
-        self.ranges.
+        Kick off loading the symbols of our binaries (all of them, or those
+        whose path matches the regular expression `preload`) in a process
+        pool.  Each BinaryInfo only blocks on its result the first time
+        someone needs its symbols.
+        '''
+        if preload is True:
+            wanted = lambda path: True
+        else:
+            wanted = re.compile(preload).search
+        binaries = [binary for path, binary in self.binaries_by_path.items()
+                    if binary.symbols is None and binary.pendingLoad is None
+                    and wanted(path)]
+        if not binaries:
+            return
+        if jobs is None:
+            jobs = multiprocessing.cpu_count()
+        pool = multiprocessing.Pool(min(jobs, len(binaries)))
+        for binary in binaries:
+            binary.startPreload(pool)
+        # no more work for the pool; the workers go away once they are done.
+        pool.close()
+
+    def finish_preload(self):
+        '''
+        Wait for any symbol preloading to finish.  Do this before forking off
+        processes that should all get the loaded symbols.
+        '''
+        for binary in self.binaries_by_path.values():
+            if binary.pendingLoad is not None:
+                # (if it failed, the binary just loads itself when used)
+                binary._finishPreload()
+
+    def _make_binary(self, path):
+        '''
+        Create the BinaryInfo-alike for a newly mapped path.  Subclasses that
+        want to symbolize some other way (see symdaemon.py) override this.
+        '''
+        return BinaryInfo(path, self.symbol_cache)
+
+    def _parse_maps(self, mappath):
+        '''
+        Parse a maps file, returning a list of range tuples like self.ranges
+        has.  We reuse any BinaryInfo we already have for a path.
         '''
         # example:
         #address           perms offset  dev   inode      pathname
@@ -169,8 +581,7 @@ class ProcInfo(object):
         # offset: the offset into the mapped file
         # dev: major/minor device number of the file's origin
         # inode: inode on the origin device
-        if mappath is None:
-            mappath = '/proc/%d/maps' % (self.pid,)
+        ranges = []
         mapfile = open(mappath, 'r')
         for line in mapfile:
             bits = line.rstrip().split(None, 5)
@@ -185,16 +596,145 @@ class ProcInfo(object):
             if path.endswith(' (deleted)'):
                 continue
             if path not in self.binaries_by_path:
-                self.binaries_by_path[path] = BinaryInfo(path)
+                self.binaries_by_path[path] = self._make_binary(path)
             binary = self.binaries_by_path[path]
 
             addr_low, addr_high = map(hexparse, bits[0].split('-'))
             offset = hexparse(bits[2])
 
             #print 'mapped', hex(addr_low), hex(addr_high), hex(offset), binary.path
-            self.ranges.append((addr_low, addr_high, offset, binary))
+            ranges.append((addr_low, addr_high, offset, binary))
 
         mapfile.close()
+        return ranges
+
+    def _read_maps(self, mappath=None):
+        '''
+        Read /proc/PID/maps to get info about the address space and store it in
+        self.ranges.
+        '''
+        if mappath is None:
+            mappath = '/proc/%d/maps' % (self.pid,)
+        self.last_maps_read = time.time()
+        self.ranges = self._parse_maps(mappath)
+
+    def _merge_ranges(self, new_ranges):
+        '''
+        Merge freshly read ranges into self.ranges.  New ranges win; old ranges
+        that do not overlap any of them are kept so that we can still make
+        sense of addresses from before something got unmapped.  If an old
+        range got replaced, addresses in it may now mean something else, so
+        we forget everything we memoized.
+
+        @returns True if anything changed.
+        '''
+        new_ranges.sort()
+        new_highs = [r[1] for r in new_ranges]
+        new_set = set(new_ranges)
+        kept = []
+        replaced = False
+        for old in self.ranges:
+            # the first new range that ends after we start...
+            i = bisect.bisect_right(new_highs, old[0])
+            # ...overlaps us if it starts before we end.
+            if i < len(new_ranges) and new_ranges[i][0] < old[1]:
+                if old not in new_set:
+                    replaced = True
+                continue
+            kept.append(old)
+        merged = new_ranges + kept
+        merged.sort()
+        if merged == self.ranges:
+            return False
+        self.ranges = merged
+        self.maps_version += 1
+        # (purely new ranges only turn misses into hits, and we do not
+        #  memoize misses while the maps can still change)
+        if replaced:
+            self.translation_cache.clear()
+        return True
+
+    def _maybe_refresh_maps(self):
+        '''
+        Called when an address was not in any of our ranges.  If the process
+        is still around and we have not re-read its maps recently, do so.
+
+        @returns True if our ranges changed and a retry might help.
+        '''
+        if self.pid is None:
+            return False
+        now = time.time()
+        if now - self.last_maps_read < self.maps_refresh_interval:
+            return False
+        self.last_maps_read = now
+        try:
+            new_ranges = self._parse_maps('/proc/%d/maps' % (self.pid,))
+        except IOError:
+            # the process is gone; the maps are not going to change now.
+            self.pid = None
+            return False
+        return self._merge_ranges(new_ranges)
+
+    def _maps_may_change(self):
+        '''
+        Could an address we fail to translate now translate later?  If so,
+        failures should not be memoized.
+        '''
+        return self.pid is not None or bool(self.pending_maps)
+
+    def load_maps_log(self, logdir):
+        '''
+        Load the list of maps snapshots a MapsLogger wrote so that they can be
+        replayed by advance_maps_to as the trace's time advances.
+        '''
+        snapshots = []
+        for fname in os.listdir(logdir):
+            if fname.startswith('maps-'):
+                snapshots.append((int(fname[5:]),
+                                  os.path.join(logdir, fname)))
+        if not snapshots:
+            return
+        snapshots.sort()
+        epoch_path = os.path.join(logdir, 'epoch')
+        if os.path.isfile(epoch_path):
+            f = open(epoch_path, 'r')
+            epoch = int(f.read().strip())
+            f.close()
+        else:
+            epoch = snapshots[0][0]
+        # trace times are in mS (once post-processing has converted them)
+        self.pending_maps = [((ns - epoch) * 0.000001, path)
+                             for ns, path in snapshots]
+        if not self.ranges:
+            self.advance_maps_to(self.pending_maps[0][0])
+
+    def save_maps(self):
+        '''
+        @returns what restore_maps needs to go back to our current address
+            space and the maps-log snapshots yet to be applied.
+        '''
+        return self.ranges, list(self.pending_maps), self.maps_version
+
+    def restore_maps(self, saved):
+        '''
+        Go back to the address space save_maps saw.  If the maps changed in
+        between, what we memoized since may not hold there, so forget it.
+        '''
+        ranges, pending_maps, maps_version = saved
+        if self.maps_version != maps_version:
+            self.translation_cache.clear()
+        self.ranges = ranges
+        self.pending_maps = list(pending_maps)
+        self.maps_version = maps_version
+
+    def advance_maps_to(self, time_ms):
+        '''
+        Apply all the maps snapshots taken at or before the given trace time.
+        '''
+        pending = self.pending_maps
+        while pending and pending[0][0] <= time_ms:
+            snapshot_time, path = pending.pop(0)
+            self._merge_ranges(self._parse_maps(path))
 
     def translateAddress(self, addr, raw=False):
         '''
@@ -203,9 +743,6 @@ class ProcInfo(object):
         map that normalized address into a useful symbol.
         '''
         ranges = self.ranges
-        if not ranges:
-            return None, None
-
         lo = 0
         hi = len(ranges)
         while lo < hi:
@@ -223,9 +760,68 @@ class ProcInfo(object):
                 offset = midtupe[2]
                 #print hex(addr), hex(range_start), hex(addr-range_start), 'in', binary.path
                 return binary.translateAddress(addr-range_start, offset, raw)
+        # maybe something new got mapped in there?
+        if self._maybe_refresh_maps():
+            return self.translateAddress(addr, raw)
         return None, None
 
+    def translateAddresses(self, addrs, raw=False):
+        '''
+        Batch version of translateAddress; returns a list of (symbol string,
+        overshoot) in the same order as addrs.  We dedupe and sort the
+        addresses so that we can resolve them in a single walk over
+        self.ranges, and then hand each binary all of its addresses at once.
+        '''
+        uniq = sorted(set(addrs))
+        ranges = self.ranges
+        num_ranges = len(ranges)
+        resolved = {}
+        #: binary => list of addresses we are asking it about
+        addrs_by_binary = {}
+        #: binary => list of (addr relative to range start, offset)
+        asks_by_binary = {}
+        iRange = 0
+        for addr in uniq:
+            while iRange < num_ranges and ranges[iRange][1] <= addr:
+                iRange += 1
+            if iRange == num_ranges:
+                break
+            range_start, range_end, offset, binary = ranges[iRange]
+            if addr < range_start:
+                continue
+            if binary in asks_by_binary:
+                addrs_by_binary[binary].append(addr)
+                asks_by_binary[binary].append((addr - range_start, offset))
+            else:
+                addrs_by_binary[binary] = [addr]
+                asks_by_binary[binary] = [(addr - range_start, offset)]
+
+        for binary, asks in asks_by_binary.iteritems():
+            answers = binary.translateAddresses(asks, raw)
+            for addr, answer in zip(addrs_by_binary[binary], answers):
+                resolved[addr] = answer
+
+        # anything that fell outside our ranges might be in something that
+        #  got mapped in since we last looked.
+        if len(resolved) < len(uniq) and self._maybe_refresh_maps():
+            unmapped = [addr for addr in uniq if addr not in resolved]
+            for addr, answer in zip(unmapped,
+                                    self.translateAddresses(unmapped, raw)):
+                resolved[addr] = answer
+
+        miss = (None, None)
+        return [resolved.get(addr, miss) for addr in addrs]
+
     def normalizeHexAddress(self, hexaddr, command, padding=None):
+        key = (hexaddr, command, padding)
+        result = self.translation_cache.get(key)
+        if result is None:
+            result = self._normalizeHexAddress(hexaddr, command, padding)
+            if result is not hexaddr or not self._maps_may_change():
+                self.translation_cache.put(key, result)
+        return result
+
+    def _normalizeHexAddress(self, hexaddr, command, padding):
         addr = int(hexaddr, 16)
         symname, overshoot = self.translateAddress(addr, raw=(command == 'raw'))
         if symname:
@@ -256,37 +852,159 @@ class ProcInfo(object):
         Given a string with space-delimited pointers, return a list of
         symbol names.
         '''
-        frames = []
-        for addr in s.split(' '):
-            frames.append(self.normalizeHexAddress(addr, 'raw'))
-        return frames
+        return self.transformStackStrings([s])[0]
 
-def main(pid):
-    normal_hex_re = re.compile("0x[0-9a-f]+")
-    addr_hex_re = re.compile(':!([a-z]{2,2})(?:,(\d+))?:([0-9a-f]+)')
-    
-    proc = ProcInfo(pid)
+    def transformStackStrings(self, stack_strings):
+        '''
+        Batch version of transformStackString that symbolizes all of the
+        given stacks at once, returning a list of lists of symbol names.
+        '''
+        stacks = [s.split(' ') for s in stack_strings]
+        frame_names = {}
+        uniq = []
+        for hexaddrs in stacks:
+            for hexaddr in hexaddrs:
+                if hexaddr not in frame_names:
+                    frame_names[hexaddr] = None
+                    uniq.append(hexaddr)
+        frame_names = dict(zip(uniq, self.transformFrames(uniq)))
+        return [[frame_names[hexaddr] for hexaddr in hexaddrs]
+                for hexaddrs in stacks]
+
+    def transformFrames(self, hexaddrs):
+        '''
+        Symbolize the given (distinct) stack frame addresses, returning a list
+        of symbol names.  Addresses we have already seen come out of
+        translation_cache; the rest go through translateAddresses in one go.
+        '''
+        cache = self.translation_cache
+        names = []
+        missing = []
+        for i, hexaddr in enumerate(hexaddrs):
+            name = cache.get((hexaddr, 'raw', None))
+            names.append(name)
+            if name is None:
+                missing.append(i)
+
+        if missing:
+            answers = self.translateAddresses([int(hexaddrs[i], 16)
+                                               for i in missing],
+                                              raw=True)
+            may_change = self._maps_may_change()
+            for i, (symname, overshoot) in zip(missing, answers):
+                hexaddr = hexaddrs[i]
+                name = names[i] = symname or hexaddr
+                if symname or not may_change:
+                    cache.put((hexaddr, 'raw', None), name)
+        return names
+
+def main(pid, block_size=1024 * 1024, stats=False):
+    # ':!cmd[,padding]:hexaddr' expressions or plain '0x' hex addresses
+    filter_re = re.compile(r':!([a-z]{2,2})(?:,(\d+))?:([0-9a-f]+)|0x[0-9a-f]+')
 
-    def normal_replacer(match):
-        hexaddr = match.group(0)
-        symname, overshoot = proc.translateAddress(int(hexaddr, 16))
-        return symname or hexaddr
+    proc = ProcInfo(pid)
+    translation_cache = proc.translation_cache
 
     def replacer(match):
-        command = match.group(1)
-        padding = match.group(2)
         hexaddr = match.group(3)
-        return proc.normalizeHexAddress(hexaddr, command, padding)
-
-    while not sys.stdin.closed:
-        line = sys.stdin.readline()
-        line = addr_hex_re.sub(replacer, line)
-        line = normal_hex_re.sub(normal_replacer, line)
-        sys.stdout.write(line)
+        if hexaddr is not None:
+            return proc.normalizeHexAddress(hexaddr, match.group(1),
+                                            match.group(2))
+        # plain hex address; just the symbol name, no overshoot
+        hexaddr = match.group(0)
+        key = (hexaddr, '0x', None)
+        result = translation_cache.get(key)
+        if result is None:
+            symname, overshoot = proc.translateAddress(int(hexaddr, 16))
+            result = symname or hexaddr
+            if symname or not proc._maps_may_change():
+                translation_cache.put(key, result)
+        return result
+
+    match_at = filter_re.match
+    def filter_chunk(chunk):
+        '''
+        Equivalent to filter_re.sub(replacer, chunk), but we let str.find
+        skip over the (vast majority of) text that cannot start a match; the
+        regex engine is a lot slower at that since every '0' is a candidate.
+        '''
+        pieces = []
+        copy_from = 0
+        next_expr = chunk.find(':!')
+        next_hex = chunk.find('0x')
+        while next_expr != -1 or next_hex != -1:
+            if next_hex == -1 or (next_expr != -1 and next_expr < next_hex):
+                candidate = next_expr
+            else:
+                candidate = next_hex
+            match = match_at(chunk, candidate)
+            if match:
+                pieces.append(chunk[copy_from:candidate])
+                pieces.append(replacer(match))
+                copy_from = search_from = match.end()
+            else:
+                search_from = candidate + 1
+            if next_expr != -1 and next_expr < search_from:
+                next_expr = chunk.find(':!', search_from)
+            if next_hex != -1 and next_hex < search_from:
+                next_hex = chunk.find('0x', search_from)
+        if not pieces:
+            return chunk
+        pieces.append(chunk[copy_from:])
+        return ''.join(pieces)
+
+    # Read whatever is available (up to block_size) and only process up
+    #  through the last newline, carrying the partial line over to the next
+    #  block.  (Addresses never span lines.)
+    in_fd = sys.stdin.fileno()
+    out = sys.stdout
+    sub = filter_chunk
+    pending = ''
+    num_bytes = 0
+    num_lines = 0
+    start = time.time()
+    while True:
+        block = os.read(in_fd, block_size)
+        if not block:
+            break
+        num_bytes += len(block)
+        idx_newline = block.rfind('\n')
+        if idx_newline == -1:
+            pending += block
+            continue
+        chunk = pending + block[:idx_newline + 1]
+        pending = block[idx_newline + 1:]
+        if stats:
+            num_lines += chunk.count('\n')
+        out.write(sub(chunk))
+        out.flush()
+    if pending:
+        num_lines += 1
+        out.write(sub(pending))
+        out.flush()
+
+    if stats:
+        elapsed = max(time.time() - start, 0.000001)
+        sys.stderr.write(
+            '%d lines, %d bytes in %.3fs: %.0f lines/sec, %.1f MB/s\n' %
+            (num_lines, num_bytes, elapsed, num_lines / elapsed,
+             num_bytes / elapsed / 1000000.0))
+        sys.stderr.write('Translation cache: %s\n' %
+                         (translation_cache.describe(),))
 
 if __name__ == '__main__':
-    if len(sys.argv) != 2:
+    parser = optparse.OptionParser(
+        usage='usage: %prog [--stats] [--block-size BYTES] PID')
+    parser.add_option('--stats', dest='stats', action='store_true',
+                      default=False,
+                      help='Report throughput and translation cache ' +
+                           'behaviour on stderr when done.')
+    parser.add_option('--block-size', dest='block_size', type='int',
+                      default=1024 * 1024,
+                      help='Maximum number of bytes to read at a time.')
+    options, args = parser.parse_args()
+    if len(args) != 1:
         sys.stderr.write('We need the PID as an arg!')
         sys.exit(1)
 
-    main(sys.argv[1])
+    main(args[0], options.block_size, options.stats)
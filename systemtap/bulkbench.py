@@ -0,0 +1,192 @@
+#!/usr/bin/python
+# MPL/GPL/LGPL licensed
+#
+# Usage: bulkbench.py [--runs N] [--cpus N] [--records N]
+#
+# Benchmark for chewchewwoowoo.BulkProcessor.  We write out --cpus synthetic
+#  bulk_N files the way staprun does on a machine with that many CPUs (each
+#  record going to a random CPU's file, with the sequence numbers interleaved
+#  across them) and time merging them back into order with the old
+#  scan-every-file, two-reads-per-record BulkProcessor and with the heap-based
+#  one, handing out strings and memoryviews.  Each variant also glues the
+#  blobs into chunks like perfishpostproc's RecordDecoder does, since that is
+#  where memoryviews get paid for.
+#
+
+import optparse, os, os.path, random, shutil, struct, sys, tempfile, time
+
+import chewchewwoowoo
+
+#: how many bytes the blobs get glued into, like RecordDecoder does
+CHUNK_SIZE = 256 * 1024
+
+class LinearBulkProcessor(object):
+    '''
+    The BulkProcessor from before the heap: it scans every file for the
+    lowest sequence for every blob and reads each record with two reads.
+    '''
+    def __init__(self, path):
+        self.files = []
+        self.next_seqs_by_file = []
+        self.next_blobs_by_file = []
+
+        i = 0
+        while True:
+            speculative_path = os.path.join(path, 'bulk_%d' % (i,))
+            if not os.path.exists(speculative_path):
+                break
+            self.files.append(open(speculative_path, 'r'))
+            seq, blob = self._read_next(i)
+            self.next_seqs_by_file.append(seq)
+            self.next_blobs_by_file.append(blob)
+            i += 1
+
+    def _read_next(self, i):
+        try:
+            seq, pdu_len = struct.unpack('II', self.files[i].read(8))
+            blob = self.files[i].read(pdu_len)
+            return seq, blob
+        except:
+            self.files[i].close()
+            return None, None
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        min_idx = 0
+        min_seq = self.next_seqs_by_file[0]
+        for i in range(1, len(self.next_seqs_by_file)):
+            seq = self.next_seqs_by_file[i]
+            if (seq is not None) and ((min_seq is None) or seq < min_seq):
+                min_idx = i
+                min_seq = seq
+        if min_seq is None:
+            raise StopIteration
+
+        min_blob = self.next_blobs_by_file[min_idx]
+        next_seq, next_blob = self._read_next(min_idx)
+        self.next_seqs_by_file[min_idx] = next_seq
+        self.next_blobs_by_file[min_idx] = next_blob
+
+        return min_blob
+
+def write_bulk_files(path, cpus, records):
+    '''
+    Write records records spread over cpus bulk files, returning the total
+    number of bytes of blobs.
+    '''
+    rng = random.Random(0)
+    files = [open(os.path.join(path, 'bulk_%d' % (i,)), 'wb', 1024 * 1024)
+             for i in range(cpus)]
+    num_bytes = 0
+    for seq in xrange(records):
+        # (about the size of a mozperfish.stp record)
+        blob = ('{"tid":%d,"gseq":%d,"depth":0,"type":4096,"time":%d,'
+                '"duration":%d,"data":{"scriptName":":!vt:%x"}}%s\n' % (
+                    rng.randint(2000, 2100), seq, seq * 1000,
+                    rng.randint(1, 100000), rng.randint(0, 1 << 40),
+                    ' ' * rng.randint(0, 200)))
+        files[rng.randrange(cpus)].write(struct.pack('II', seq, len(blob)) +
+                                         blob)
+        num_bytes += len(blob)
+    for f in files:
+        f.close()
+    return num_bytes
+
+def glue_strings(blobs):
+    pending = []
+    pending_size = 0
+    count = 0
+    for blob in blobs:
+        pending.append(blob)
+        pending_size += len(blob)
+        if pending_size >= CHUNK_SIZE:
+            count += len(''.join(pending))
+            pending = []
+            pending_size = 0
+    return count + len(''.join(pending))
+
+def glue_memoryviews(blobs):
+    pending = bytearray()
+    count = 0
+    for blob in blobs:
+        pending += blob
+        if len(pending) >= CHUNK_SIZE:
+            count += len(str(pending))
+            pending = bytearray()
+    return count + len(str(pending))
+
+def time_variant(make, glue, path, runs):
+    '''
+    @returns the best time of `runs` runs of merging (and maybe gluing) the
+        bulk files in path.
+    '''
+    best = None
+    for i in range(runs):
+        start = time.time()
+        blobs = make(path)
+        if glue:
+            glue(blobs)
+        else:
+            for blob in blobs:
+                pass
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+def check_order(path):
+    '''
+    Make sure the variants all hand out the same blobs in the same order.
+    '''
+    expected = list(LinearBulkProcessor(path))
+    if list(chewchewwoowoo.BulkProcessor(path)) != expected:
+        raise Exception('BulkProcessor disagrees with the linear scan')
+    if [blob.tobytes() for blob in
+            chewchewwoowoo.BulkProcessor(path, True)] != expected:
+        raise Exception('BulkProcessor memoryviews disagree')
+
+def main():
+    parser = optparse.OptionParser(
+        usage='usage: %prog [--runs N] [--cpus N] [--records N]')
+    parser.add_option('--runs', type='int', dest='runs', default=3,
+                      help='Number of runs to take the best of.')
+    parser.add_option('--cpus', type='int', dest='cpus', default=64,
+                      help='Number of bulk files.')
+    parser.add_option('--records', type='int', dest='records',
+                      default=500000,
+                      help='Number of records across the bulk files.')
+    options, args = parser.parse_args()
+
+    path = tempfile.mkdtemp(prefix='bulkbench-')
+    try:
+        num_bytes = write_bulk_files(path, options.cpus, options.records)
+        print '%d records, %.1f MiB in %d bulk files' % (
+            options.records, num_bytes / 1048576.0, options.cpus)
+        check_order(path)
+
+        variants = [
+            ('linear scan', LinearBulkProcessor, None),
+            ('heap', chewchewwoowoo.BulkProcessor, None),
+            ('linear scan + glue', LinearBulkProcessor, glue_strings),
+            ('heap + glue', chewchewwoowoo.BulkProcessor, glue_strings),
+            ]
+        if chewchewwoowoo.HAVE_MEMORYVIEW:
+            memoryviews = lambda path: chewchewwoowoo.BulkProcessor(path,
+                                                                    True)
+            variants.extend([
+                ('heap, memoryviews', memoryviews, None),
+                ('heap, memoryviews + glue', memoryviews, glue_memoryviews),
+                ])
+        for name, make, glue in variants:
+            elapsed = time_variant(make, glue, path, options.runs)
+            print '%-28s %7.3fs %10.0f records/s %7.1f MiB/s' % (
+                name, elapsed, options.records / elapsed,
+                num_bytes / 1048576.0 / elapsed)
+    finally:
+        shutil.rmtree(path, True)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -46,8 +46,8 @@
 #  used by others without this script.
 
 import imp, optparse, os.path, re, shutil, struct, subprocess, sys, time
-import fcntl
-import addrsymfilt
+import __builtin__, fcntl, heapq, threading
+import addrsymfilt, symdaemon
 import json
 
 class ChewContext(object):
@@ -434,6 +434,94 @@ class ScriptChewer(object):
 
         return wrote_it
 
+#: how many bytes of each bulk file BulkProcessor reads at a time
+BULK_READ_SIZE = 1024 * 1024
+
+#: the _stp_trace header of each record in a bulk file; see BulkProcessor
+_TRACE_HEADER = struct.Struct('II')
+#: (python 2.6 has no memoryview, so it gets strings regardless)
+HAVE_MEMORYVIEW = hasattr(__builtin__, 'memoryview')
+
+class BulkFileReader(object):
+    '''
+    Reads the (sequence, blob) records of one bulk file, BULK_READ_SIZE bytes
+    at a time rather than a couple of little reads per record.  With
+    memoryviews, the blobs are memoryviews of what we read so that they do
+    not get copied; a blob keeps the read it came from alive, so hold on to
+    them only as long as you need them.
+
+    The file can still be growing (see TailingBulkProcessor), which is why we
+    read it with os.read rather than through a file object; stdio does not
+    promise to look again once it has hit the end of the file.
+    '''
+    def __init__(self, path, memoryviews=False):
+        self.path = path
+        self.fd = os.open(path, os.O_RDONLY)
+        self.memoryviews = memoryviews and HAVE_MEMORYVIEW
+        self.buf = ''
+        self.view = None
+        self.pos = 0
+
+    def _fill(self, need):
+        '''
+        Make sure we have at least need bytes past pos, if the file has that
+        many left.  This moves what we have left to the start of a new
+        buffer.
+
+        @returns whether we got them
+        '''
+        have = len(self.buf) - self.pos
+        if have >= need:
+            return True
+        parts = [self.buf[self.pos:]]
+        while have < need:
+            data = os.read(self.fd, max(BULK_READ_SIZE, need - have))
+            if not data:
+                break
+            parts.append(data)
+            have += len(data)
+        self.buf = ''.join(parts)
+        self.pos = 0
+        if self.memoryviews:
+            self.view = memoryview(self.buf)
+        return have >= need
+
+    @property
+    def closed(self):
+        return self.fd is None
+
+    def read_next(self, final=True):
+        '''
+        Read the next seq and blob packet.  If final (nothing more is going to
+        get written to the file) and we reach the end of the file, we close
+        it and return None for both values; a truncated last blob gets
+        returned as is.  If not final and the next record is not all there
+        yet, we return None for both values and leave it for next time.
+        '''
+        if self.fd is None:
+            return None, None
+        if not self._fill(_TRACE_HEADER.size):
+            if final:
+                self.close()
+            return None, None
+        seq, pdu_len = _TRACE_HEADER.unpack_from(self.buf, self.pos)
+        if not self._fill(_TRACE_HEADER.size + pdu_len) and not final:
+            return None, None
+        start = self.pos + _TRACE_HEADER.size
+        end = min(start + pdu_len, len(self.buf))
+        self.pos = end
+        if self.memoryviews:
+            return seq, self.view[start:end]
+        return seq, self.buf[start:end]
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+        self.buf = ''
+        self.view = None
+        self.pos = 0
+
 class BulkProcessor(object):
     '''
     In bulk mode each per-cpu file is written as a series of records where the
@@ -447,72 +535,194 @@ class BulkProcessor(object):
     The headers are not aligned; they can start at any byte offset.
 
     We take on the responsibility of stitching together the bulk files and
-    providing the event blobs in-order.
+    providing the event blobs in-order.  We keep the next record of each file
+    in a heap keyed by sequence, so picking the next blob is O(log(cpus))
+    rather than a scan of every file, and we read each file in big chunks
+    (see BulkFileReader).  If memoryviews is true the blobs are memoryviews
+    instead of strings, which saves copying them when all you are going to
+    do is glue them together.
 
-    In theory at some point we might be able to do this in a realtime streaming
-    fashion by watching as the files get appended to or something along those
-    lines, but we don't do it right now.  We do try and keep our memory usage
-    down though.
+    This reads the files as they are; TailingBulkProcessor follows them while
+    staprun is still writing them.  We do try and keep our memory usage down
+    though.
 
     Use us like an iterator in a for loop...
     for blob in BulkProcessor('/tmp/dir_with_bulk/files'):
         print 'I got a blob!', blob
     '''
 
-    def __init__(self, path):
+    def __init__(self, path, memoryviews=False):
         '''
         We expect bulk_# files to be found in path.
         '''
-        self.files = []
-        self.next_seqs_by_file = []
-        self.next_blobs_by_file = []
+        self.readers = []
+        #: (seq, index of the reader, blob) of each reader's next record
+        self.heap = []
 
         i = 0
         while True:
             speculative_path = os.path.join(path, 'bulk_%d' % (i,))
             if not os.path.exists(speculative_path):
                 break
-            self.files.append(open(speculative_path, 'r'))
-            seq, blob = self._read_next(i)
-            self.next_seqs_by_file.append(seq)
-            self.next_blobs_by_file.append(blob)
+            reader = BulkFileReader(speculative_path, memoryviews)
+            self.readers.append(reader)
+            seq, blob = reader.read_next()
+            if seq is not None:
+                self.heap.append((seq, i, blob))
             i += 1
-
-    def _read_next(self, i):
-        '''
-        Read the next seq and blob packet for the file at the given index.  If
-        we encounter a problem we close the file and return None for both
-        values.
-        '''
-        try:
-            seq, pdu_len = struct.unpack('II', self.files[i].read(8))
-            blob = self.files[i].read(pdu_len)
-            return seq, blob
-        except:
-            self.files[i].close()
-            return None, None
+        heapq.heapify(self.heap)
 
     def __iter__(self):
         return self
 
     def next(self):
-        min_idx = 0
-        min_seq = self.next_seqs_by_file[0]
-        for i in range(1, len(self.next_seqs_by_file)):
-            seq = self.next_seqs_by_file[i]
-            if (seq is not None) and ((min_seq is None) or seq < min_seq):
-                min_idx = i
-                min_seq = seq
-        if min_seq is None:
+        heap = self.heap
+        if not heap:
             raise StopIteration
+        # (ties go to the lower-numbered file, same as ever)
+        min_seq, min_idx, min_blob = heap[0]
+        next_seq, next_blob = self.readers[min_idx].read_next()
+        if next_seq is None:
+            heapq.heappop(heap)
+        else:
+            heapq.heapreplace(heap, (next_seq, min_idx, next_blob))
+        return min_blob
 
-        min_blob = self.next_blobs_by_file[min_idx]
-        #print 'min_seq', min_seq, 'min_blob', min_blob
-        next_seq, next_blob = self._read_next(min_idx)
-        self.next_seqs_by_file[min_idx] = next_seq
-        self.next_blobs_by_file[min_idx] = next_blob
+def _iter_then(iterable, callback):
+    '''
+    Iterate over iterable and then call callback.
+    '''
+    for item in iterable:
+        yield item
+    callback()
 
-        return min_blob
+#: how long TailingBulkProcessor waits before looking at the files again
+TAIL_POLL_INTERVAL = 0.1
+#: how long TailingBulkProcessor holds blobs back waiting on a sequence
+#:  number that may never show up
+TAIL_GAP_TIMEOUT = 5.0
+
+class TailingBulkProcessor(BulkProcessor):
+    '''
+    A BulkProcessor that follows the bulk files while staprun is still
+    writing them, so that post-processing can get going during the trace
+    instead of after it.  When we run out of blobs we wait for more, until
+    the done threading.Event gets set to say that staprun is done.
+
+    staprun appends each CPU's records to its file as it drains that CPU's
+    buffer, so a file that has nothing more for us right now can still get
+    records that belong before the ones the other files have given us.  So
+    we hold the lowest pending blob back until one of these is true:
+
+    - its sequence number is the one after the last blob we handed out (the
+      sequence numbers count up across all the CPUs),
+    - every file still being written has a record pending, so nothing lower
+      can turn up (the watermark),
+    - we have been waiting TAIL_GAP_TIMEOUT seconds, in which case we assume
+      the sequence numbers in between got dropped, or
+    - done is set, so everything there is to read is in the files.
+
+    We start counting from the lowest sequence number pending once we have
+    looked at every file there is.  A blob that turns up after we have
+    handed out a higher sequence number (because we gave up waiting for it)
+    would be out of order, so we drop it with a warning instead.
+
+    Bulk files that show up after we start get picked up as we go.
+    '''
+
+    def __init__(self, path, done, memoryviews=False,
+                 poll_interval=TAIL_POLL_INTERVAL,
+                 gap_timeout=TAIL_GAP_TIMEOUT):
+        self.path = path
+        self.done = done
+        self.memoryviews = memoryviews
+        self.poll_interval = poll_interval
+        self.gap_timeout = gap_timeout
+        self.readers = []
+        #: (seq, index of the reader, blob) of each reader's next record
+        self.heap = []
+        #: indices of the open readers that have no record in the heap
+        self.idle = set()
+        #: the sequence number after the last blob we handed out
+        self.next_seq = None
+        #: when we started holding back the lowest blob, if we are
+        self.held_since = None
+        self._add_new_files()
+
+    def _add_new_files(self):
+        while True:
+            speculative_path = os.path.join(self.path,
+                                            'bulk_%d' % (len(self.readers),))
+            if not os.path.exists(speculative_path):
+                break
+            self.idle.add(len(self.readers))
+            self.readers.append(BulkFileReader(speculative_path,
+                                               self.memoryviews))
+
+    def _read_idle(self, final):
+        '''
+        See if the readers without a pending record have one now.
+        '''
+        for i in list(self.idle):
+            reader = self.readers[i]
+            seq, blob = reader.read_next(final)
+            if seq is not None:
+                heapq.heappush(self.heap, (seq, i, blob))
+                self.idle.discard(i)
+            elif reader.closed:
+                self.idle.discard(i)
+
+    def _gap_timed_out(self):
+        now = time.time()
+        if self.held_since is None:
+            self.held_since = now
+        return now - self.held_since >= self.gap_timeout
+
+    def _wait_for_blob(self):
+        '''
+        Wait until the lowest pending blob can be handed out.
+
+        @returns False once there are no blobs left and there will be no more
+        '''
+        heap = self.heap
+        while True:
+            if heap and (not self.idle or heap[0][0] == self.next_seq):
+                return True
+            # (look before reading so that we read whatever got written
+            #  before done got set)
+            final = self.done.isSet()
+            self._add_new_files()
+            self._read_idle(final)
+            if heap:
+                if self.next_seq is None:
+                    self.next_seq = heap[0][0]
+                if final or not self.idle or heap[0][0] == self.next_seq:
+                    return True
+                if self._gap_timed_out():
+                    return True
+            elif final:
+                return False
+            time.sleep(self.poll_interval)
+
+    def next(self):
+        heap = self.heap
+        while True:
+            if not self._wait_for_blob():
+                raise StopIteration
+            min_seq, min_idx, min_blob = heapq.heappop(heap)
+            self.held_since = None
+            next_seq, next_blob = self.readers[min_idx].read_next(False)
+            if next_seq is None:
+                self.idle.add(min_idx)
+            else:
+                heapq.heappush(heap, (next_seq, min_idx, next_blob))
+            if self.next_seq is not None and min_seq < self.next_seq:
+                sys.stderr.write('Dropping bulk record %d from %s; it showed '
+                                 'up after we gave up waiting on it.\n' %
+                                 (min_seq, self.readers[min_idx].path))
+                continue
+            self.next_seq = min_seq + 1
+            return min_blob
 
 # STAP_BIN_DIR = '/usr/bin'
 STAP_BIN_DIR = '/local/code/systemtap/bin'
@@ -526,6 +736,15 @@ class SystemtapDriverThing(object):
 
     def __init__(self):
         self.stap_include_dirs = []
+        self.preload_symbols = False
+        self.use_symbol_daemon = False
+        self.postprocess_jobs = None
+        self.cache_records = True
+        self.jank_threshold = None
+        self.profile_stages = False
+        self.profile_python = False
+        self.live_postprocess = False
+        self.processed_live = False
 
     def _build_parser(self):
         parser = optparse.OptionParser(usage=self.usage)
@@ -543,6 +762,61 @@ class SystemtapDriverThing(object):
                           help='Specify a base output directory.',
                           dest='output_base_dir',
                           default='/tmp/mozperfish')
+        parser.add_option('--preload-symbols',
+                          help='Load the symbols of all mapped binaries in ' +
+                               'parallel at the start of post-processing.',
+                          dest='preload_symbols', action='store_true',
+                          default=False)
+        parser.add_option('--preload-filter',
+                          help='Only preload symbols for binaries whose ' +
+                               'path matches this regular expression. ' +
+                               'Implies --preload-symbols.',
+                          dest='preload_filter',
+                          default=None)
+        parser.add_option('--symbol-daemon',
+                          help='Symbolize using the symdaemon.py daemon if ' +
+                               'one is running, to share symbol tables ' +
+                               'with other post-processing jobs.',
+                          dest='symbol_daemon', action='store_true',
+                          default=False)
+        parser.add_option('--jobs', type='int',
+                          help='Number of processes post-processing may ' +
+                               'use, if it knows how.  Defaults to the ' +
+                               'number of CPUs.',
+                          dest='jobs', default=None)
+        parser.add_option('--no-record-cache',
+                          help='Do not save the demuxed and symbolized ' +
+                               'records in the trace directory for later ' +
+                               're-runs (or use the ones already there), ' +
+                               'if post-processing knows how.',
+                          dest='cache_records', action='store_false',
+                          default=True)
+        parser.add_option('--jank-threshold', type='float',
+                          help='Report event-loop events that take longer ' +
+                               'than this many milliseconds, if ' +
+                               'post-processing knows how.',
+                          dest='jank_threshold', default=None)
+        parser.add_option('--profile-stages',
+                          help='Time each stage of post-processing and ' +
+                               'write the numbers to the trace directory, ' +
+                               'if post-processing knows how.',
+                          dest='profile_stages', action='store_true',
+                          default=False)
+        parser.add_option('--profile-python',
+                          help='Also dump cProfile stats of ' +
+                               'post-processing to the trace directory. ' +
+                               'Implies --profile-stages.',
+                          dest='profile_python', action='store_true',
+                          default=False)
+        parser.add_option('--live',
+                          help='Merge the bulk files (and, for ' +
+                               'mozperfish, split the records up by ' +
+                               'thread) while the trace is still running, ' +
+                               'following them as staprun writes them.  ' +
+                               'Decoding, symbolizing and rebuilding the ' +
+                               'threads still happen after the trace ends.',
+                          dest='live_postprocess', action='store_true',
+                          default=False)
         
 
         return parser
@@ -716,6 +990,17 @@ class SystemtapDriverThing(object):
         if options.rerunpath:
             options.mode = 'process'
         self.mode = options.mode
+        if options.preload_filter:
+            self.preload_symbols = options.preload_filter
+        else:
+            self.preload_symbols = options.preload_symbols
+        self.use_symbol_daemon = options.symbol_daemon
+        self.postprocess_jobs = options.jobs
+        self.cache_records = options.cache_records
+        self.jank_threshold = options.jank_threshold
+        self.profile_stages = options.profile_stages
+        self.profile_python = options.profile_python
+        self.live_postprocess = options.live_postprocess
 
         # -- Translate modes to actions
         if self.mode == 'build':
@@ -752,14 +1037,15 @@ class SystemtapDriverThing(object):
             self.run(chewer, args)
 
         # -- Process
-        if self.doProcess:
+        # (unless it already happened while we were running)
+        if self.doProcess and not self.processed_live:
             # If we are in 'process' mode, the output directory is explicitly
             #  told to us, which is important because there is no other way
             #  we can remotely figure this out correctly.  (Which is also why
             #  we clobber this way down here.)
             if self.mode == 'process':
                 chewer.context.output_dir = options.rerunpath
-            self.post_process(chewer, self.run_pid)
+            self.post_process(chewer)
         return 0
 
 
@@ -845,6 +1131,8 @@ class SystemtapDriverThing(object):
         
         Currently we need:
         - the maps file that tells us about the memory map
+
+        (Later changes to the maps are captured by the MapsLogger in run.)
         '''
         shutil.copyfile(os.path.join(self.proc_dir, 'maps'),
                         os.path.join(self.context.output_dir, 'maps'))
@@ -938,6 +1226,7 @@ class SystemtapDriverThing(object):
                                 stdin=subprocess.PIPE,
                                 stdout=subprocess.PIPE,
                                 stderr=subprocess.STDOUT)
+        live = None
         try:
             # - wait for 'stap' to successfully load the stuff
             # (make the stdout non-blocking)
@@ -991,6 +1280,20 @@ class SystemtapDriverThing(object):
             print '!!! Hit control-C to terminate the tapscript'
             sys.stdout.flush()
 
+            # Keep track of libraries that get mapped in (or out) while we
+            #  run so post-processing can symbolize them.  Trace times are
+            #  relative to when the probes went live, which is about now.
+            maps_logger = addrsymfilt.MapsLogger(
+                pid, os.path.join(chewer.context.output_dir, 'maps-log'))
+            maps_logger.mark_epoch()
+            maps_logger.poll(force=True)
+
+            # With --live, post-process the bulk files as they get written.
+            if self.live_postprocess and self.doProcess:
+                if '-b' in chewer.stap_build_args:
+                    live = self._start_live_post_process(chewer)
+                else:
+                    print '!!! not in bulk mode; post-processing afterwards'
 
             # wait for something to die off doing our own communicate()
             #  style loop to make sure the stap invocation does not clog
@@ -1006,8 +1309,15 @@ class SystemtapDriverThing(object):
                 except Exception, e:
                     pass
 
-                dead_pid, dead_status = os.waitpid(-1, os.WNOHANG)
+                # (only wait on our own kids; live post-processing can have
+                #  processes of its own)
+                dead_pid = dead_status = 0
+                if kid_pid:
+                    dead_pid, dead_status = os.waitpid(kid_pid, os.WNOHANG)
+                if dead_pid == 0 and pope.poll() is not None:
+                    dead_pid, dead_status = pope.pid, pope.returncode
                 if dead_pid == 0:
+                    maps_logger.poll()
                     time.sleep(0.1)
                 elif dead_pid == kid_pid:
                     print '!!! Happy conclusion!'
@@ -1032,12 +1342,77 @@ class SystemtapDriverThing(object):
             if kid_pid:
                 os.kill(kid_pid, 9)
 
-    def post_process(self, chewer, pid):
+        if live:
+            self._finish_live_post_process(live)
+
+    def _start_live_post_process(self, chewer):
+        '''
+        Start post-processing in a thread that follows the bulk files while
+        staprun writes them (see TailingBulkProcessor).  Only what consumes
+        the blobs as they come runs during the trace; for mozperfish that is
+        merging them and splitting them up by thread.  A thread cannot be
+        rebuilt until all of its records are in, and symbolizing needs the
+        whole maps-log, so the rest waits for the trace to end.
+
+        @returns what to hand _finish_live_post_process once staprun is done
+        '''
+        trace_done = threading.Event()
+        errors = []
+        def live_post_process():
+            try:
+                self.post_process(chewer, trace_done)
+            except:
+                errors.append(sys.exc_info())
+        thread = threading.Thread(target=live_post_process,
+                                  name='live post-processing')
+        # (if we bail out, do not wait around for it)
+        thread.setDaemon(True)
+        thread.start()
+        return trace_done, thread, errors
+
+    def _finish_live_post_process(self, live):
+        '''
+        Tell the live post-processing that the trace is over and wait for it
+        to finish up.
+        '''
+        trace_done, thread, errors = live
+        print '!!! waiting for live post-processing to finish'
+        sys.stdout.flush()
+        trace_done.set()
+        # (a join without a timeout would not let control-C through)
+        while thread.isAlive():
+            thread.join(0.5)
+        if errors:
+            exc_type, exc_value, exc_tb = errors[0]
+            raise exc_type, exc_value, exc_tb
+        self.processed_live = True
+
+    def post_process(self, chewer, trace_done=None):
+        '''
+        Post-process the trace in the output directory.  If trace_done is not
+        None, the trace is still running and we follow the bulk files until
+        that threading.Event gets set.
+        '''
         if chewer.postprocess_script:
             trace_dir = chewer.context.output_dir
             # provide it with the address sym filter; assuming required.
-            procinfo = addrsymfilt.ProcInfo(pid,
-                                            os.path.join(trace_dir, 'maps'))
+            # (if preloading, the symbols load while we decode the trace)
+            if self.use_symbol_daemon:
+                procinfo_class = symdaemon.DaemonProcInfo
+            else:
+                procinfo_class = addrsymfilt.ProcInfo
+            # (no pid: even if the process is still around, its maps now are
+            #  not what they were during the trace; the maps-log has those)
+            procinfo = procinfo_class(None, os.path.join(trace_dir, 'maps'),
+                                      preload=self.preload_symbols)
+            # and anything that got mapped in later on (which, if the trace
+            #  is still running, we can only know once it is done)
+            maps_log_dir = os.path.join(trace_dir, 'maps-log')
+            def load_maps_log():
+                if os.path.isdir(maps_log_dir):
+                    procinfo.load_maps_log(maps_log_dir)
+            if trace_done is None:
+                load_maps_log()
 
             # first look in the directory the input .stp file came from
             search_path = [
@@ -1056,8 +1431,26 @@ class SystemtapDriverThing(object):
                     fp.close()
 
             if module:
-                bulkproc = BulkProcessor(trace_dir)
                 modproc = module.Processor()
+                memoryviews = getattr(modproc, 'accepts_memoryviews', False)
+                if trace_done is None:
+                    bulkproc = BulkProcessor(trace_dir, memoryviews)
+                else:
+                    bulkproc = _iter_then(
+                        TailingBulkProcessor(trace_dir, trace_done,
+                                             memoryviews),
+                        load_maps_log)
+                if (self.postprocess_jobs is not None and
+                        hasattr(modproc, 'jobs')):
+                    modproc.jobs = self.postprocess_jobs
+                if hasattr(modproc, 'cache_records'):
+                    modproc.cache_records = self.cache_records
+                if (self.jank_threshold is not None and
+                        hasattr(modproc, 'jank_threshold')):
+                    modproc.jank_threshold = self.jank_threshold
+                if hasattr(modproc, 'profile_stages'):
+                    modproc.profile_stages = self.profile_stages
+                    modproc.profile_python = self.profile_python
                 modproc.process(trace_dir, bulkproc, procinfo)
 
 class MozMain(SystemtapDriverThing):
@@ -0,0 +1,169 @@
+# MPL/GPL/LGPL licensed
+#
+# On-demand C++ demangling for addrsymfilt.
+#
+# A trace only ever touches a tiny fraction of the symbols in something like
+#  libxul, so rather than have nm demangle every last one of them up front we
+#  keep the mangled names around and demangle only the ones we hand out.
+#
+# We prefer libstdc++'s __cxa_demangle via ctypes since it avoids any IPC; if
+#  we cannot get at that we keep a single c++filt coprocess around and feed it
+#  batches of names.  Either way, results are cached.
+
+import ctypes, ctypes.util, os, subprocess
+
+#: keep each batch we write to c++filt well under the pipe buffer size so that
+#:  we can never block writing while c++filt blocks writing to us.
+MAX_BATCH_BYTES = 16 * 1024
+
+def looksMangled(name):
+    return name.startswith('_Z')
+
+class NativeDemangler(object):
+    '''
+    Demangles using __cxa_demangle out of libstdc++.  Construction raises
+    OSError/AttributeError if that is not available.
+    '''
+    def __init__(self):
+        libstdcxx = ctypes.CDLL(ctypes.util.find_library('stdc++') or
+                                'libstdc++.so.6')
+        # (getattr since we would otherwise get private name mangling)
+        self._cxa_demangle = getattr(libstdcxx, '__cxa_demangle')
+        self._cxa_demangle.restype = ctypes.c_void_p
+        self._cxa_demangle.argtypes = [ctypes.c_char_p, ctypes.c_void_p,
+                                       ctypes.c_void_p,
+                                       ctypes.POINTER(ctypes.c_int)]
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6')
+        self._free = libc.free
+        self._free.argtypes = [ctypes.c_void_p]
+
+    def demangleMany(self, names):
+        results = []
+        status = ctypes.c_int(0)
+        for name in names:
+            ptr = self._cxa_demangle(name, None, None, ctypes.byref(status))
+            if ptr:
+                results.append(ctypes.string_at(ptr))
+                self._free(ptr)
+            else:
+                results.append(name)
+        return results
+
+    def close(self):
+        pass
+
+class CxxfiltDemangler(object):
+    '''
+    Demangles by way of a long-lived c++filt process which we talk to a line
+    at a time.  (c++filt flushes its output after every line.)  Construction
+    raises OSError if there is no c++filt.
+
+    If we get forked (ex: by the thread rebuilding pool), the child starts its
+    own c++filt the first time it needs one rather than interleaving its
+    requests with everyone else's on the parent's pipes.
+    '''
+    def __init__(self, path='/usr/bin/c++filt'):
+        self.path = path
+        self._start()
+
+    def _start(self):
+        self.pid = os.getpid()
+        self.proc = subprocess.Popen([self.path], stdin=subprocess.PIPE,
+                                     stdout=subprocess.PIPE)
+
+    def demangleMany(self, names):
+        results = []
+        if self.pid != os.getpid():
+            # (closing our copies of the parent's pipes does not hurt it)
+            self.proc.stdin.close()
+            self.proc.stdout.close()
+            self._start()
+        proc = self.proc
+        i = 0
+        while i < len(names):
+            batch = []
+            batch_bytes = 0
+            while i < len(names) and (not batch or
+                                      batch_bytes < MAX_BATCH_BYTES):
+                batch.append(names[i])
+                batch_bytes += len(names[i]) + 1
+                i += 1
+            proc.stdin.write('\n'.join(batch) + '\n')
+            proc.stdin.flush()
+            for name in batch:
+                results.append(proc.stdout.readline().rstrip('\n'))
+        return results
+
+    def close(self):
+        if self.proc is not None:
+            self.proc.stdin.close()
+            # (only the process that started c++filt can wait on it)
+            if self.pid == os.getpid():
+                self.proc.wait()
+            self.proc = None
+
+class NullDemangler(object):
+    '''
+    What you get when there is no way to demangle anything.
+    '''
+    def demangleMany(self, names):
+        return list(names)
+
+    def close(self):
+        pass
+
+class Demangler(object):
+    '''
+    Caching front-end to whichever backend we could get going.
+    '''
+    def __init__(self, backend=None):
+        if backend is None:
+            backend = self._pickBackend()
+        self.backend = backend
+        #: mangled name => demangled name
+        self.cache = {}
+
+    def _pickBackend(self):
+        try:
+            return NativeDemangler()
+        except (OSError, AttributeError):
+            pass
+        try:
+            return CxxfiltDemangler()
+        except OSError:
+            return NullDemangler()
+
+    def demangle(self, name):
+        if not looksMangled(name):
+            return name
+        result = self.cache.get(name)
+        if result is None:
+            result = self.cache[name] = self.backend.demangleMany([name])[0]
+        return result
+
+    def demangleMany(self, names):
+        '''
+        Demangle a list of names, asking the backend about all the ones we have
+        not seen before in one batch.
+        '''
+        cache = self.cache
+        missing = [name for name in set(names)
+                   if looksMangled(name) and name not in cache]
+        if missing:
+            for name, result in zip(missing,
+                                    self.backend.demangleMany(missing)):
+                cache[name] = result
+        return [cache.get(name, name) for name in names]
+
+    def close(self):
+        self.backend.close()
+
+_shared_demangler = None
+def getDemangler():
+    '''
+    The process-wide Demangler everybody shares.
+    '''
+    global _shared_demangler
+    if _shared_demangler is None:
+        _shared_demangler = Demangler()
+    return _shared_demangler
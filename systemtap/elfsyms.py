@@ -0,0 +1,238 @@
+# MPL/GPL/LGPL licensed
+# Andrew Sutherland <asutherland@asutherland.org>
+#
+# Minimal in-process ELF reader; just enough to replace the 'readelf -l' and
+#  'nm' invocations addrsymfilt.BinaryInfo used to make.  We mmap the file and
+#  pull the PT_LOAD program headers and the .symtab/.dynsym symbol tables out
+#  directly.  We do not know anything about DWARF and we do not demangle; that
+#  is the caller's problem.
+#
+# Both 32-bit and 64-bit ELF files of either endianness are understood, which
+#  is more than we need but costs us nothing.
+
+import mmap, struct
+
+ELFMAG = '\x7fELF'
+ELFCLASS32 = 1
+ELFCLASS64 = 2
+ELFDATA2LSB = 1
+ELFDATA2MSB = 2
+
+PT_LOAD = 1
+PT_NOTE = 4
+
+SHT_SYMTAB = 2
+SHT_NOTE = 7
+SHT_DYNSYM = 11
+
+SHN_UNDEF = 0
+
+STT_SECTION = 3
+STT_FILE = 4
+
+NT_GNU_BUILD_ID = 3
+
+class ElfError(Exception):
+    pass
+
+class ElfFile(object):
+    '''
+    An mmap-backed view of an ELF file.  Everything is parsed on demand from
+    the mapping, so constructing us only costs us the header.
+
+    Use close() when done; we hold both a file descriptor and a mapping.
+    '''
+    def __init__(self, path):
+        self.path = path
+        self.mm = None
+        f = open(path, 'rb')
+        try:
+            try:
+                self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except (ValueError, mmap.error), e:
+                # (zero-length files cannot be mapped)
+                raise ElfError('%s: unable to map: %s' % (path, e))
+        finally:
+            f.close()
+
+        try:
+            self._parseHeader()
+        except:
+            self.close()
+            raise
+
+    def close(self):
+        if self.mm is not None:
+            self.mm.close()
+            self.mm = None
+
+    def _parseHeader(self):
+        mm = self.mm
+        if len(mm) < 16 or mm[0:4] != ELFMAG:
+            raise ElfError('%s: not an ELF file' % (self.path,))
+
+        elfclass = ord(mm[4])
+        elfdata = ord(mm[5])
+        if elfdata == ELFDATA2LSB:
+            endian = '<'
+        elif elfdata == ELFDATA2MSB:
+            endian = '>'
+        else:
+            raise ElfError('%s: bad EI_DATA %d' % (self.path, elfdata))
+
+        if elfclass == ELFCLASS64:
+            hdr = struct.Struct(endian + 'HHIQQQIHHHHHH')
+            self._phdr = struct.Struct(endian + 'IIQQQQQQ')
+            self._shdr = struct.Struct(endian + 'IIQQQQIIQQ')
+            self._sym = struct.Struct(endian + 'IBBHQQ')
+        elif elfclass == ELFCLASS32:
+            hdr = struct.Struct(endian + 'HHIIIIIHHHHHH')
+            self._phdr = struct.Struct(endian + 'IIIIIIII')
+            self._shdr = struct.Struct(endian + 'IIIIIIIIII')
+            self._sym = struct.Struct(endian + 'IIIBBH')
+        else:
+            raise ElfError('%s: bad EI_CLASS %d' % (self.path, elfclass))
+        self.is64 = (elfclass == ELFCLASS64)
+        self.endian = endian
+
+        if len(mm) < 16 + hdr.size:
+            raise ElfError('%s: truncated header' % (self.path,))
+        (e_type, e_machine, e_version, e_entry, self.phoff, self.shoff,
+         e_flags, e_ehsize, self.phentsize, self.phnum, self.shentsize,
+         self.shnum, self.shstrndx) = hdr.unpack_from(mm, 16)
+
+    def loadSegments(self):
+        '''
+        @returns a list of (offset, vaddr, filesz, memsz) tuples for each
+            PT_LOAD program header, in program header order.
+        '''
+        segments = []
+        mm = self.mm
+        phdr = self._phdr
+        for i in xrange(self.phnum):
+            fields = phdr.unpack_from(mm, self.phoff + i * self.phentsize)
+            if self.is64:
+                (p_type, p_flags, p_offset, p_vaddr, p_paddr,
+                 p_filesz, p_memsz, p_align) = fields
+            else:
+                (p_type, p_offset, p_vaddr, p_paddr,
+                 p_filesz, p_memsz, p_flags, p_align) = fields
+            if p_type == PT_LOAD:
+                segments.append((p_offset, p_vaddr, p_filesz, p_memsz))
+        return segments
+
+    def _programHeaders(self, wanted_type):
+        '''
+        @returns a list of (offset, filesz) for program headers of the given
+            type.
+        '''
+        results = []
+        mm = self.mm
+        phdr = self._phdr
+        for i in xrange(self.phnum):
+            fields = phdr.unpack_from(mm, self.phoff + i * self.phentsize)
+            if fields[0] != wanted_type:
+                continue
+            if self.is64:
+                results.append((fields[2], fields[5]))
+            else:
+                results.append((fields[1], fields[4]))
+        return results
+
+    def buildId(self):
+        '''
+        @returns the GNU build-id as a hex string, or None if the binary does
+            not have one.  We look at the SHT_NOTE sections and fall back to
+            the PT_NOTE segments for binaries without section headers.
+        '''
+        notes = [(sh_offset, sh_size) for
+                 sh_type, sh_offset, sh_size, sh_link, sh_entsize
+                 in self.sections() if sh_type == SHT_NOTE]
+        if not notes:
+            notes = self._programHeaders(PT_NOTE)
+
+        mm = self.mm
+        nhdr = struct.Struct(self.endian + 'III')
+        for offset, size in notes:
+            end = min(offset + size, len(mm))
+            while offset + nhdr.size <= end:
+                namesz, descsz, ntype = nhdr.unpack_from(mm, offset)
+                offset += nhdr.size
+                name_start = offset
+                offset += (namesz + 3) & ~3
+                desc_start = offset
+                offset += (descsz + 3) & ~3
+                if offset > end:
+                    break
+                if (ntype == NT_GNU_BUILD_ID and
+                        mm[name_start:name_start + namesz] == 'GNU\0'):
+                    return mm[desc_start:desc_start + descsz].encode('hex')
+        return None
+
+    def sections(self):
+        '''
+        @returns a list of (type, offset, size, link, entsize) tuples for
+            every section header, indexed by section number.
+        '''
+        sections = []
+        mm = self.mm
+        shdr = self._shdr
+        if self.shoff == 0:
+            return sections
+        if self.shoff + self.shnum * self.shentsize > len(mm):
+            raise ElfError('%s: truncated section headers' % (self.path,))
+        for i in xrange(self.shnum):
+            (sh_name, sh_type, sh_flags, sh_addr, sh_offset, sh_size,
+             sh_link, sh_info, sh_addralign, sh_entsize) = \
+                shdr.unpack_from(mm, self.shoff + i * self.shentsize)
+            sections.append((sh_type, sh_offset, sh_size, sh_link, sh_entsize))
+        return sections
+
+    def symbols(self):
+        '''
+        @returns an unsorted list of (address, name) tuples for all the defined,
+            named symbols in .symtab followed by those in .dynsym.  We skip
+            section and file symbols, much like 'nm --defined-only' does.
+            Names are exactly as found in the file, so C++ names are still
+            mangled.
+        '''
+        results = []
+        mm = self.mm
+        sections = self.sections()
+        sym = self._sym
+        symsize = sym.size
+        is64 = self.is64
+        # .symtab is the more complete table, so let its names win when both
+        #  tables name the same address (our callers keep the first dupe).
+        for wanted_type in (SHT_SYMTAB, SHT_DYNSYM):
+            for sh_type, sh_offset, sh_size, sh_link, sh_entsize in sections:
+                if sh_type != wanted_type:
+                    continue
+                if sh_link >= len(sections):
+                    raise ElfError('%s: bad symbol string table link' %
+                                   (self.path,))
+                str_offset, str_size = sections[sh_link][1:3]
+                strtab = mm[str_offset:str_offset + str_size]
+                strfind = strtab.find
+
+                entsize = sh_entsize or symsize
+                end = min(sh_offset + sh_size, len(mm))
+                # (the first symbol is always the null symbol)
+                for off in xrange(sh_offset + entsize, end - symsize + 1,
+                                  entsize):
+                    if is64:
+                        (st_name, st_info, st_other, st_shndx,
+                         st_value, st_size) = sym.unpack_from(mm, off)
+                    else:
+                        (st_name, st_value, st_size,
+                         st_info, st_other, st_shndx) = sym.unpack_from(mm, off)
+                    if st_shndx == SHN_UNDEF or not st_name:
+                        continue
+                    st_type = st_info & 0xf
+                    if st_type == STT_SECTION or st_type == STT_FILE:
+                        continue
+                    name_end = strfind('\0', st_name)
+                    if name_end == -1:
+                        name_end = len(strtab)
+                    results.append((st_value, strtab[st_name:name_end]))
+        return results
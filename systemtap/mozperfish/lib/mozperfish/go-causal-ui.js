@@ -48,6 +48,7 @@ require.def("mozperfish/go-causal-ui",
     "mozperfish/ui-misc",
     "mozperfish/ui-vis-chainlinks",
     "mozperfish/zing-blamer",
+    "mozperfish/perfdata-loader",
   ],
   function(
     exports,
@@ -60,7 +61,8 @@ require.def("mozperfish/go-causal-ui",
     _ui_zings,
     _ui_misc,
     _ui_vis_chainlinks,
-    mod_zing_blamer
+    mod_zing_blamer,
+    mod_loader
   ) {
 
 var wy = new wmsy.WmsyDomain({id: "go-causal-ui", domain: "mozperfish",
@@ -125,16 +127,17 @@ exports.chewAndShow = function(perfData) {
   binder.bind({type: "top-level", obj: rootObj});
 };
 
+/**
+ * Load and show the perf data.  We use the columnar perfdata.bin next to
+ *  jsonBlobPath if it is there since it loads much faster.
+ */
 exports.main = function(jsonBlobPath) {
-  var req = new XMLHttpRequest();
-  req.open("GET", jsonBlobPath, true);
-  req.addEventListener("load", function() {
-    if (req.status == 200)
-      exports.chewAndShow(JSON.parse(req.responseText));
+  mod_loader.loadPerfData(jsonBlobPath, function(perfData) {
+    if (perfData)
+      exports.chewAndShow(perfData);
     else
       console.error("failure getting the data");
-  }, false);
-  req.send(null);
+  });
 };
 
 }); // end require.def
@@ -0,0 +1,88 @@
+/* ***** BEGIN LICENSE BLOCK *****
+ * Version: MPL 1.1/GPL 2.0/LGPL 2.1
+ *
+ * The contents of this file are subject to the Mozilla Public License Version
+ * 1.1 (the "License"); you may not use this file except in compliance with
+ * the License. You may obtain a copy of the License at:
+ * http://www.mozilla.org/MPL/
+ *
+ * Software distributed under the License is distributed on an "AS IS" basis,
+ * WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+ * for the specific language governing rights and limitations under the
+ * License.
+ *
+ * The Original Code is Mozilla Messaging Code.
+ *
+ * The Initial Developer of the Original Code is
+ *   The Mozilla Foundation
+ * Portions created by the Initial Developer are Copyright (C) 2010
+ * the Initial Developer. All Rights Reserved.
+ *
+ * Contributor(s):
+ *   Andrew Sutherland <asutherland@asutherland.org>
+ *
+ * Alternatively, the contents of this file may be used under the terms of
+ * either the GNU General Public License Version 2 or later (the "GPL"), or
+ * the GNU Lesser General Public License Version 2.1 or later (the "LGPL"),
+ * in which case the provisions of the GPL or the LGPL are applicable instead
+ * of those above. If you wish to allow use of your version of this file only
+ * under the terms of either the GPL or the LGPL, and not to allow others to
+ * use your version of this file under the terms of the MPL, indicate your
+ * decision by deleting the provisions above and replace them with the notice
+ * and other provisions required by the GPL or the LGPL. If you do not delete
+ * the provisions above, a recipient may use your version of this file under
+ * the terms of any one of the MPL, the GPL or the LGPL.
+ *
+ * ***** END LICENSE BLOCK ***** */
+
+/**
+ * What the columnar perfdata.bin format looks like from JS: its name and
+ *  version (which have to match FORMAT_NAME and FORMAT_VERSION in
+ *  perfishcolumns.py), the array dtypes and the special i32 values.  Both
+ *  perfdata-loader.js and webface/perfission.html use this, so a format bump
+ *  only has to touch it and perfishcolumns.py.
+ *
+ * perfission.html does not use require, so if there is no require.def we
+ *  make ourselves the perfdataFormat global instead of a module.
+ **/
+
+(function(define) {
+define(function(exports) {
+
+exports.FORMAT_NAME = "mozperfish-columns";
+exports.FORMAT_VERSION = 6;
+
+exports.I32_ABSENT = -0x80000000;
+exports.I32_NULL = -0x7fffffff;
+exports.FLAG_CHILDREN = 0x80;
+
+// (no typed arrays means no columns, see manifestUsable)
+exports.ARRAY_TYPES = typeof(ArrayBuffer) == "undefined" ? {} : {
+  f64: Float64Array,
+  i32: Int32Array,
+  u8: Uint8Array,
+};
+
+function platformIsLittleEndian() {
+  return new Uint8Array(new Uint32Array([1]).buffer)[0] === 1;
+}
+
+/**
+ * Can we use the columns the manifest describes?  Not if it is some other
+ *  format or version, or if it or the platform is big-endian.
+ */
+exports.manifestUsable = function(manifest) {
+  return !!manifest && manifest.format == exports.FORMAT_NAME &&
+         manifest.version == exports.FORMAT_VERSION &&
+         !!manifest.littleEndian && typeof(ArrayBuffer) != "undefined" &&
+         platformIsLittleEndian();
+};
+
+});
+})(typeof(require) != "undefined" && require.def ?
+   function(factory) {
+     require.def("mozperfish/perfdata-format", ["exports"], factory);
+   } :
+   function(factory) {
+     factory(window.perfdataFormat = {});
+   });
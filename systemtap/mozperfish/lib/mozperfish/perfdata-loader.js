@@ -0,0 +1,603 @@
+/* ***** BEGIN LICENSE BLOCK *****
+ * Version: MPL 1.1/GPL 2.0/LGPL 2.1
+ *
+ * The contents of this file are subject to the Mozilla Public License Version
+ * 1.1 (the "License"); you may not use this file except in compliance with
+ * the License. You may obtain a copy of the License at:
+ * http://www.mozilla.org/MPL/
+ *
+ * Software distributed under the License is distributed on an "AS IS" basis,
+ * WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+ * for the specific language governing rights and limitations under the
+ * License.
+ *
+ * The Original Code is Mozilla Messaging Code.
+ *
+ * The Initial Developer of the Original Code is
+ *   The Mozilla Foundation
+ * Portions created by the Initial Developer are Copyright (C) 2010
+ * the Initial Developer. All Rights Reserved.
+ *
+ * Contributor(s):
+ *   Andrew Sutherland <asutherland@asutherland.org>
+ *
+ * Alternatively, the contents of this file may be used under the terms of
+ * either the GNU General Public License Version 2 or later (the "GPL"), or
+ * the GNU Lesser General Public License Version 2.1 or later (the "LGPL"),
+ * in which case the provisions of the GPL or the LGPL are applicable instead
+ * of those above. If you wish to allow use of your version of this file only
+ * under the terms of either the GPL or the LGPL, and not to allow others to
+ * use your version of this file under the terms of the MPL, indicate your
+ * decision by deleting the provisions above and replace them with the notice
+ * and other provisions required by the GPL or the LGPL. If you do not delete
+ * the provisions above, a recipient may use your version of this file under
+ * the terms of any one of the MPL, the GPL or the LGPL.
+ *
+ * ***** END LICENSE BLOCK ***** */
+
+/**
+ * Load the perfishpostproc output, preferring the columnar perfdata.bin (see
+ *  perfishcolumns.py for the layout) over perfdata.json.  The bin file gets
+ *  viewed in place with typed arrays, so the only real work is building the
+ *  event objects everyone else expects, which is a lot less work than
+ *  JSON.parse on the equivalent text.
+ *
+ * If the manifest is missing, too new, or the platform is big-endian, we fall
+ *  back to perfdata.json.
+ **/
+
+require.def("mozperfish/perfdata-loader",
+  [
+    "exports",
+    "mozperfish/perfdata-format",
+  ],
+  function(
+    exports,
+    mod_format
+  ) {
+
+var I32_ABSENT = mod_format.I32_ABSENT, I32_NULL = mod_format.I32_NULL;
+var FLAG_CHILDREN = mod_format.FLAG_CHILDREN;
+var ARRAY_TYPES = mod_format.ARRAY_TYPES;
+
+var LOD_KEYS = ["starts", "types", "busy", "count", "maxDuration",
+                "memDelta"];
+var MEVENT_KEYS = ["time", "kind", "source", "ptr", "size"];
+var HEAP_SECTIONS = {
+  curve: ["times", "minLive", "maxLive"],
+  histogram: ["source", "bucket", "count", "bytes"],
+  leaks: ["time", "tid", "source", "ptr", "size"],
+};
+
+function bisectLeft(arr, value) {
+  var lo = 0, hi = arr.length;
+  while (lo < hi) {
+    var mid = (lo + hi) >> 1;
+    if (arr[mid] < value)
+      lo = mid + 1;
+    else
+      hi = mid;
+  }
+  return lo;
+}
+
+function bisectRight(arr, value) {
+  var lo = 0, hi = arr.length;
+  while (lo < hi) {
+    var mid = (lo + hi) >> 1;
+    if (value < arr[mid])
+      hi = mid;
+    else
+      lo = mid + 1;
+  }
+  return lo;
+}
+
+/**
+ * Turn (ASCII, since python's json escapes everything else) bytes into a
+ *  string.
+ */
+function bytesToString(bytes) {
+  var chunks = [], CHUNK = 8192;
+  for (var i = 0; i < bytes.length; i += CHUNK) {
+    chunks.push(String.fromCharCode.apply(
+      null, bytes.subarray(i, Math.min(i + CHUNK, bytes.length))));
+  }
+  return chunks.join("");
+}
+
+/**
+ * View items [start, stop) of an [dtype, offset, length] array (all of it
+ *  by default) in the section of the bin file starting at base; JSON ones get
+ *  parsed.
+ */
+function viewArray(buffer, base, where, start, stop) {
+  var dtype = where[0], offset = base + where[1], length = where[2];
+  if (dtype == "json")
+    return JSON.parse(bytesToString(new Uint8Array(buffer, offset, length)));
+  start = start || 0;
+  if (stop === undefined || stop > length)
+    stop = length;
+  var type = ARRAY_TYPES[dtype];
+  return new type(buffer, offset + start * type.BYTES_PER_ELEMENT,
+                  stop - start);
+}
+
+/**
+ * Typed-array access to one thread's section of the bin file.
+ */
+function ThreadColumns(thread, buffer) {
+  this.thread = thread;
+  this.tid = thread.tid;
+  this.buffer = buffer;
+  this._strings = null;
+  this._extras = null;
+  this._lodLevels = null;
+}
+ThreadColumns.prototype = {
+  /**
+   * View items [start, stop) of one of our arrays; see viewArray.
+   */
+  array: function(where, start, stop) {
+    return viewArray(this.buffer, this.thread.offset, where, start, stop);
+  },
+
+  get strings() {
+    if (!this._strings)
+      this._strings = this.array(this.thread.strings);
+    return this._strings;
+  },
+
+  get extras() {
+    if (!this._extras)
+      this._extras = this.array(this.thread.extras);
+    return this._extras;
+  },
+
+  /**
+   * Build rows [lo, hi) (all of them by default) of the given table as
+   *  objects, without any children.
+   */
+  rows: function(name, lo, hi) {
+    var table = this.thread[name];
+    lo = lo || 0;
+    if (hi === undefined || hi > table.count)
+      hi = table.count;
+    var count = hi - lo;
+    var flags = this.array(table.flags, lo, hi), containers = table.containers;
+    var objs = new Array(count), i, bit;
+    for (i = 0; i < count; i++) {
+      var obj = objs[i] = {};
+      for (bit = 0; bit < containers.length; bit++) {
+        if (flags[i] & (1 << bit))
+          obj[containers[bit]] = {};
+      }
+    }
+
+    for (var iField = 0; iField < table.fields.length; iField++) {
+      var field = table.fields[iField], path = field.path;
+      var width = field.kind == "pair" ? 2 : 1, lookup = null, v;
+      // sparse fields list the rows they have values for
+      var rows = null, first = lo, last = hi;
+      if (field.rows) {
+        var allRows = this.array(field.rows);
+        first = bisectLeft(allRows, lo);
+        last = bisectLeft(allRows, hi);
+        rows = allRows.subarray(first, last);
+      }
+      var column = this.array(field.column, first * width, last * width);
+      var numValues = last - first;
+      var container = path.length > 1 ? path[0] : null,
+          key = path[path.length - 1];
+      var pairAbsent = field.column[0] == "i32" ? I32_ABSENT : NaN;
+      switch (field.kind) {
+        case "str":
+          lookup = this.strings;
+          break;
+        case "json":
+          lookup = this.extras;
+          break;
+      }
+      for (var j = 0; j < numValues; j++) {
+        switch (field.kind) {
+          case "i32":
+            v = column[j];
+            if (v === I32_ABSENT)
+              continue;
+            if (v === I32_NULL)
+              v = null;
+            break;
+          case "f64":
+            v = column[j];
+            if (v !== v)
+              continue;
+            break;
+          case "pair":
+            v = column[2 * j];
+            if (v === pairAbsent || v !== v)
+              continue;
+            v = [v, column[2 * j + 1]];
+            break;
+          default:
+            v = column[j];
+            if (v === -1)
+              continue;
+            v = lookup[v];
+            break;
+        }
+        i = rows ? rows[j] - lo : j;
+        if (container)
+          objs[i][container][key] = v;
+        else
+          objs[i][key] = v;
+      }
+    }
+    return objs;
+  },
+
+  /**
+   * Build the top-level events among rows [lo, hi) (all of them by default)
+   *  of the given table with their descendants hung off them.  If rowsOut
+   *  is provided, we push the row of each top-level event onto it.
+   */
+  tree: function(name, lo, hi, rowsOut) {
+    var table = this.thread[name];
+    lo = lo || 0;
+    var objs = this.rows(name, lo, hi), roots = [];
+    var flags = this.array(table.flags, lo, lo + objs.length),
+        parents = this.array(table.parent, lo, lo + objs.length);
+    for (var i = 0; i < objs.length; i++) {
+      var obj = objs[i];
+      if (flags[i] & FLAG_CHILDREN)
+        obj.children = [];
+      if (parents[i] < lo) {
+        roots.push(obj);
+        if (rowsOut)
+          rowsOut.push(lo + i);
+      }
+      else {
+        objs[parents[i] - lo].children.push(obj);
+      }
+    }
+    return roots;
+  },
+
+  /**
+   * Figure out which top-level events overlap the time range [t0, t1] using
+   *  the index (see IntervalIndex in perfishcolumns.py).  Returns the
+   *  positions in the index of those events, in order of start time; the
+   *  index's rows and rowEnds tell you the rows of events they span, which
+   *  is what you want if you are only going to fetch those bits of the bin
+   *  file.
+   */
+  overlapping: function(t0, t1) {
+    var index = this.thread.index;
+    var starts = this.array(index.starts), ends = this.array(index.ends),
+        maxEnds = this.array(index.maxEnds);
+    var lo = bisectLeft(maxEnds, t0), hi = bisectRight(starts, t1);
+    var hits = [];
+    for (var i = lo; i < hi; i++) {
+      if (ends[i] >= t0)
+        hits.push(i);
+    }
+    return hits;
+  },
+
+  /**
+   * Build the top-level events (with all their descendants) that overlap
+   *  the time range [t0, t1], in order of start time, without building
+   *  anything else.
+   */
+  eventsIn: function(t0, t1) {
+    var hits = this.overlapping(t0, t1);
+    var rows = this.array(this.thread.index.rows),
+        rowEnds = this.array(this.thread.index.rowEnds);
+    var spans = [], i;
+    for (i = 0; i < hits.length; i++)
+      spans.push([rows[hits[i]], rowEnds[hits[i]]]);
+    spans.sort(function(a, b) { return a[0] - b[0]; });
+
+    // build runs of adjacent events in one go
+    var eventsByRow = {}, runLo = null, runHi = null;
+    spans.push([null, null]);
+    for (i = 0; i < spans.length; i++) {
+      if (runHi !== null && spans[i][0] !== runHi) {
+        var runRows = [], runEvents = this.tree("events", runLo, runHi,
+                                                runRows);
+        for (var j = 0; j < runEvents.length; j++)
+          eventsByRow[runRows[j]] = runEvents[j];
+        runLo = null;
+      }
+      if (runLo === null)
+        runLo = spans[i][0];
+      runHi = spans[i][1];
+    }
+
+    var events = [];
+    for (i = 0; i < hits.length; i++)
+      events.push(eventsByRow[rows[hits[i]]]);
+    return events;
+  },
+
+  /**
+   * The level-of-detail summaries of the top-level events (see
+   *  perfishlod.py), finest first, as {width, starts, types, busy, count,
+   *  maxDuration, memDelta} with typed arrays for everything but the width.
+   */
+  get lodLevels() {
+    if (!this._lodLevels) {
+      var descs = this.thread.lod.levels, levels = this._lodLevels = [];
+      for (var i = 0; i < descs.length; i++) {
+        var level = {width: descs[i].width};
+        for (var j = 0; j < LOD_KEYS.length; j++)
+          level[LOD_KEYS[j]] = this.array(descs[i][LOD_KEYS[j]]);
+        levels.push(level);
+      }
+    }
+    return this._lodLevels;
+  },
+
+  /**
+   * The memory events as {time, kind, source, ptr, size} typed arrays; see
+   *  perfishheap.py.
+   */
+  get mevents() {
+    var mevents = {};
+    for (var i = 0; i < MEVENT_KEYS.length; i++) {
+      var key = MEVENT_KEYS[i];
+      mevents[key] = this.array(this.thread.mevents[key]);
+    }
+    return mevents;
+  },
+
+  /**
+   * Build this thread's entry in perfdata.json, plus its lodLevels as lod.
+   */
+  toJSONThread: function() {
+    var stackTable = this.thread.stackTable;
+    var prefixes = Array.prototype.slice.call(this.array(stackTable.prefix));
+    for (var i = 0; i < prefixes.length; i++) {
+      if (prefixes[i] === -1)
+        prefixes[i] = null;
+    }
+    var mevents = this.mevents;
+    for (var key in mevents)
+      mevents[key] = Array.prototype.slice.call(mevents[key]);
+    return {
+      tid: this.tid,
+      events: this.tree("events"),
+      levents: Array.prototype.slice.call(
+                 this.array(this.thread.levents)),
+      mevents: mevents,
+      frames: this.array(this.thread.frames),
+      stacks: {
+        prefix: prefixes,
+        frame: Array.prototype.slice.call(this.array(stackTable.frame)),
+      },
+      lod: this.lodLevels,
+    };
+  },
+};
+exports.ThreadColumns = ThreadColumns;
+
+/**
+ * Wrap the manifest and the contents of the bin file it describes.
+ */
+function PerfDataColumns(manifest, buffer) {
+  this.manifest = manifest;
+  this.buffer = buffer;
+  this.lastEventEndsAtTime = manifest.lastEventEndsAtTime;
+  this.threads = [];
+  for (var i = 0; i < manifest.threads.length; i++)
+    this.threads.push(new ThreadColumns(manifest.threads[i], buffer));
+}
+PerfDataColumns.prototype = {
+  /**
+   * The summaries of the whole heap (see perfishheap.py) as {curve,
+   *  histogram, leaks}, each of which is an object of typed arrays.
+   */
+  get heap() {
+    var heap = this.manifest.heap, result = {};
+    for (var section in HEAP_SECTIONS) {
+      var names = HEAP_SECTIONS[section], columns = result[section] = {};
+      for (var i = 0; i < names.length; i++)
+        columns[names[i]] = viewArray(this.buffer, heap.offset,
+                                      heap[section][names[i]]);
+    }
+    return result;
+  },
+
+  /**
+   * Build what JSON.parse would make of perfdata.json.
+   */
+  toJSONObj: function() {
+    var threads = [];
+    for (var i = 0; i < this.threads.length; i++)
+      threads.push(this.threads[i].toJSONThread());
+    return {
+      threads: threads,
+      lastEventEndsAtTime: this.lastEventEndsAtTime,
+    };
+  },
+};
+exports.PerfDataColumns = PerfDataColumns;
+
+/**
+ * Turn a thread's levents, which are the pre-order indices of the events
+ *  that make up the event-loop view, into the events themselves.  Events
+ *  that had something re-parented out from under them get (shallow) copies
+ *  that leave it out of their children; everything else is shared with the
+ *  events tree.
+ */
+function buildEventLoopView(events, leventIndices) {
+  var flat = [], parents = [], pending = [], i;
+  for (i = events.length - 1; i >= 0; i--)
+    pending.push([events[i], -1]);
+  while (pending.length) {
+    var item = pending.pop(), event = item[0], index = flat.length;
+    flat.push(event);
+    parents.push(item[1]);
+    var kids = event.children;
+    if (kids) {
+      for (i = kids.length - 1; i >= 0; i--)
+        pending.push([kids[i], index]);
+    }
+  }
+
+  // everything above a re-parented event needs a copy
+  var reparented = {}, kidsOf = {}, parent;
+  for (i = 0; i < leventIndices.length; i++) {
+    parent = parents[leventIndices[i]];
+    if (parent === -1)
+      continue;
+    reparented[leventIndices[i]] = true;
+    while (parent !== -1 && !(parent in kidsOf)) {
+      kidsOf[parent] = [];
+      parent = parents[parent];
+    }
+  }
+  for (i = 0; i < parents.length; i++) {
+    if (parents[i] in kidsOf)
+      kidsOf[parents[i]].push(i);
+  }
+
+  function view(index) {
+    if (!(index in kidsOf))
+      return flat[index];
+    var orig = flat[index], clone = {};
+    for (var key in orig)
+      clone[key] = orig[key];
+    var kids = kidsOf[index];
+    clone.children = [];
+    for (var j = 0; j < kids.length; j++) {
+      if (!(kids[j] in reparented))
+        clone.children.push(view(kids[j]));
+    }
+    return clone;
+  }
+  var levents = [];
+  for (i = 0; i < leventIndices.length; i++)
+    levents.push(view(leventIndices[i]));
+  return levents;
+}
+exports.buildEventLoopView = buildEventLoopView;
+
+/**
+ * Replace the stack ids in the data of a thread's events (see StackTable in
+ *  perfishpostproc.py) with the lists of frame names they stand for,
+ *  innermost first.  Events with the same stack share the list.
+ */
+function expandStacks(thread) {
+  var frames = thread.frames, prefixes = thread.stacks.prefix,
+      stackFrames = thread.stacks.frame, expanded = {};
+  function expand(stackId) {
+    if (stackId in expanded)
+      return expanded[stackId];
+    var names = expanded[stackId] = [];
+    while (stackId !== null) {
+      names.push(frames[stackFrames[stackId]]);
+      stackId = prefixes[stackId];
+    }
+    return names;
+  }
+  var pending = thread.events.slice();
+  while (pending.length) {
+    var event = pending.pop();
+    if (event.data && "stack" in event.data)
+      event.data.stack = expand(event.data.stack);
+    if (event.children) {
+      for (var i = 0; i < event.children.length; i++)
+        pending.push(event.children[i]);
+    }
+  }
+}
+exports.expandStacks = expandStacks;
+
+/**
+ * Pick the coarsest of a thread's lod levels whose buckets are no wider
+ *  than timePerPixel, returning null if there is none (or no levels at all,
+ *  as when we loaded perfdata.json), in which case just draw the events.
+ */
+exports.pickLODLevel = function(levels, timePerPixel) {
+  var best = null;
+  if (levels) {
+    for (var i = 0; i < levels.length; i++) {
+      if (levels[i].width <= timePerPixel)
+        best = levels[i];
+    }
+  }
+  return best;
+};
+
+function fetch(path, responseType, callback) {
+  var req = new XMLHttpRequest();
+  req.open("GET", path, true);
+  if (responseType)
+    req.responseType = responseType;
+  req.addEventListener("load", function() {
+    if (req.status == 200 || (req.status === 0 && req.response))
+      callback(responseType ? req.response : req.responseText);
+    else
+      callback(null);
+  }, false);
+  req.addEventListener("error", function() {
+    callback(null);
+  }, false);
+  req.send(null);
+}
+
+/**
+ * Load the columns described by the manifest at manifestPath, calling
+ *  callback with a PerfDataColumns or null if we cannot.
+ */
+exports.loadColumns = function(manifestPath, callback) {
+  fetch(manifestPath, null, function(text) {
+    var manifest = null;
+    try {
+      manifest = text && JSON.parse(text);
+    }
+    catch (ex) {
+    }
+    if (!mod_format.manifestUsable(manifest)) {
+      callback(null);
+      return;
+    }
+    var binPath = manifestPath.replace(/[^\/]*$/, manifest.binFile);
+    fetch(binPath, "arraybuffer", function(buffer) {
+      callback(buffer ? new PerfDataColumns(manifest, buffer) : null);
+    });
+  });
+};
+
+/**
+ * Load the perf data from next to jsonPath (ex: "perfdata.json"), calling
+ *  callback with what JSON.parse would have made of it (except that each
+ *  thread's levents are the events themselves, courtesy of
+ *  buildEventLoopView, the events' stacks are lists of frame names, courtesy
+ *  of expandStacks, and threads loaded from the columns have lod), or null
+ *  if we could not get it at all.
+ */
+exports.loadPerfData = function(jsonPath, callback) {
+  function gotPerfData(perfData) {
+    if (perfData) {
+      for (var i = 0; i < perfData.threads.length; i++) {
+        var thread = perfData.threads[i];
+        expandStacks(thread);
+        thread.levents = buildEventLoopView(thread.events, thread.levents);
+      }
+    }
+    callback(perfData);
+  }
+  var manifestPath = jsonPath.replace(/\.json$/, "-manifest.json");
+  exports.loadColumns(manifestPath, function(columns) {
+    if (columns) {
+      gotPerfData(columns.toJSONObj());
+      return;
+    }
+    fetch(jsonPath, null, function(text) {
+      gotPerfData(text ? JSON.parse(text) : null);
+    });
+  });
+};
+
+}); // end require.def
@@ -48,9 +48,11 @@
 require.def("mozperfish/pv-layout-timey",
   [
     "wmsy/opc/protovis",
+    "mozperfish/perfdata-loader",
   ],
   function(
-    pv
+    pv,
+    mod_loader
   ) {
 
 /**
@@ -83,6 +85,16 @@ pv.Layout.Timey = function() {
       .width(function (n) { return n.dx; })
       .height(function (n) { return n.dy; })
       ).parent = this;
+
+  // level-of-detail buckets we draw instead of the events when there are
+  //  more of them than we have pixels; see lod().
+  (this.bucket = new pv.Mark()
+      .data(function() { return that.buckets; })
+      .left(function (n) { return n.x; })
+      .top(function (n) { return n.y; })
+      .width(function (n) { return n.dx; })
+      .height(function (n) { return n.dy; })
+      ).parent = this;
 };
 
 pv.Layout.Timey.prototype = pv.extend(pv.Layout.Network)
@@ -117,6 +129,19 @@ pv.Layout.Timey.prototype.kind = function(v) {
   return this;
 };
 
+/**
+ * Set the function that maps a group to its level-of-detail summaries (a
+ *  thread's lod from perfdata-loader) or null if it has none.  When there
+ *  are more nodes than vertical pixels, we lay out the buckets of the
+ *  coarsest level that still fits the time each pixel covers instead, and
+ *  set summarized so that whoever is drawing the nodes knows to stop.  The
+ *  summaries are in wall clock time, so only set this if time is too.
+ */
+pv.Layout.Timey.prototype.lod = function(v) {
+  this._lod = v;
+  return this;
+};
+
 
 pv.Layout.Timey.prototype.defaults = new pv.Layout.Timey()
     .extend(pv.Layout.Network.prototype.defaults)
@@ -166,6 +191,51 @@ pv.Layout.Timey.prototype.buildImplied = function(s) {
   //console.log("groupSpan", groupSpan,
   //     "eventDisplace", eventDisplace.domain(), eventDisplace.range());
 
+  // level-of-detail buckets, laid out in a lane per event type within their
+  //  group.
+  var buckets = this.buckets = [], lodAccessor = this._lod;
+  this.summarized = false;
+  if (lodAccessor && nodes.length > h) {
+    var timeDomain = timeScale.domain();
+    var timePerPixel = (timeDomain[1] - timeDomain[0]) / h;
+    var groups = groupScale.domain(), types = {}, numTypes = 0, j;
+    for (i = 0; i < groups.length; i++) {
+      var level = mod_loader.pickLODLevel(lodAccessor(groups[i]),
+                                          timePerPixel);
+      if (!level)
+        continue;
+      this.summarized = true;
+      groupBase = groupScale(groups[i]);
+      for (j = 0; j < level.starts.length; j++) {
+        // (the gaps between events and events that took no time)
+        if (!level.busy[j])
+          continue;
+        var start = level.starts[j], type = level.types[j];
+        if (!(type in types))
+          types[type] = numTypes++;
+        var b = {
+          group: groups[i],
+          type: type,
+          start: start,
+          width: level.width,
+          busy: level.busy[j],
+          count: level.count[j],
+          maxDuration: level.maxDuration[j],
+          memDelta: level.memDelta[j],
+          x: groupBase + groupLeftOffset,
+          y: timeScale(start),
+        };
+        b.dy = Math.max(timeScale(start + level.width) - b.y, 1);
+        buckets.push(b);
+      }
+    }
+    var laneWidth = groupSpan / Math.max(numTypes, 1);
+    for (i = 0; i < buckets.length; i++) {
+      buckets[i].x += types[buckets[i].type] * laneWidth;
+      buckets[i].dx = laneWidth;
+    }
+  }
+
   var e;
   // nodes
   for (i = 0; i < nodes.length; i++) {
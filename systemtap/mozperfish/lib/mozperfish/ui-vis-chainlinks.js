@@ -476,7 +476,23 @@ wy.defineWidget({
         var pollStroke = pv.color("rgb(255, 255, 192)");
         var latencyFill = pv.color("rgba(255, 192, 192, 0.5)");
         var latencyStroke = pv.color("rgb(255, 192, 192)");
+        // when zoomed out too far to draw the events, the level-of-detail
+        //  buckets take their place; more opaque means busier.
+        var bucketColors = pv.Colors.category10();
+        graph.bucket.add(pv.Bar)
+          .fillStyle(function(b) {
+                       return bucketColors(b.type).alpha(
+                                Math.min(b.busy / b.width, 1));
+                     })
+          .title(function(b) {
+                   return "type " + b.type + ": " + b.count + " events, " +
+                          (100 * b.busy / b.width).toFixed(1) + "% busy, " +
+                          "longest " + b.maxDuration.toFixed(3) + "ms, " +
+                          b.memDelta + " bytes";
+                 });
+
         var zingBar = graph.zing.add(pv.Bar)
+          .visible(function() { return !graph.summarized; })
           .fillStyle(function(z) {
                        if (z.kind == "gc")
                          return gcFill;
@@ -499,7 +515,8 @@ wy.defineWidget({
                  });
       }
 
-      graph.link.add(pv.Line);
+      graph.link.add(pv.Line)
+        .visible(function() { return !graph.summarized; });
 
       function selectifyNode(d) {
         if (self.curSelected)
@@ -516,6 +533,7 @@ wy.defineWidget({
           selectedColor = pv.color("hsl(0, 100%, 50%)"),
           descendentColor = pv.color("hsl(0, 100%, 38%)");
       var nodeDot = graph.node.add(pv.Dot)
+        .visible(function() { return !graph.summarized; })
         .shape(function(d) {
                  if (d.mark)
                    return "square";
@@ -593,6 +611,11 @@ wy.defineWidget({
     _kindThread: function(d) {
       return d.event ? d.event.thread_idx : -1;
     },
+    _lodThread: function(threads) {
+      return function(thread_idx) {
+        return threads[thread_idx] ? threads[thread_idx].lod : null;
+      };
+    },
     _updateConfig: function(aReset) {
       var config = this.obj;
       switch (config.timebase) {
@@ -619,6 +642,15 @@ wy.defineWidget({
           break;
       }
 
+      // the level-of-detail summaries are per thread and in wall clock time
+      if (this.obj.layout === "timey") {
+        if (config.timebase !== "gseq" && config.majorgroup !== "cluster")
+          this.graph.lod(
+            this._lodThread(this.__context.chainer.perfishBlob.threads));
+        else
+          this.graph.lod(null);
+      }
+
       switch (config.minorgroup) {
         case "event":
           this.graph.kind(this._kindEventType);
@@ -0,0 +1,262 @@
+#!/usr/bin/python
+# MPL/GPL/LGPL licensed
+#
+# Usage: perfishbench.py [--runs N] [--records N] [--per-blob N] [--memory]
+#
+# Micro-benchmarks for perfishpostproc.  We make up a trace that looks like
+#  what mozperfish.stp spits out (trailing commas, native stacks, memory
+#  records, the occasional record split across lines) chopped up into blobs
+#  like the BulkProcessor hands us, and time decoding it.
+#
+# With --memory we instead run the whole Processor over the trace and report
+#  the peak memory use compared to building the entire output in memory and
+#  json.dump'ing it.  Each variant runs in its own process so that we get
+#  its own high-water mark.  (Linux carries the high-water mark across exec,
+#  so we also keep our own memory use down by writing the trace out from
+#  another process.)
+#
+
+import filecmp, json, optparse, os, os.path, random, resource, shutil
+import subprocess, sys, tempfile, time
+
+import perfishcolumns, perfishpostproc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..'))
+import addrsymfilt
+
+def synthesize_lines(count):
+    '''
+    Make up count records worth of lines, a few of which have been split
+    into a continuation line.
+    '''
+    rng = random.Random(0)
+    lines = []
+    t = 1000000
+    gseq = 0
+    while len(lines) < count:
+        tid = rng.choice((2001, 2002, 2003, 2004))
+        t += rng.randint(1000, 100000)
+        lines.append(
+            '{"tid":%d,"depth":null,"type":null,"mem":{'
+            '"je_small_alloc":[%d,%d],}}' % (tid, rng.randint(1, 50),
+                                             rng.randint(16, 4096)))
+        stack = ' '.join(['%x' % (0x7f0000000000 + rng.randint(0, 1 << 24),)
+                          for i in range(rng.randint(5, 30))])
+        # (a record that got split where the jsstack was printed)
+        lines.append(
+            '{"tid":%d,"gseq":%d,"depth":1,"type":4097,"time":%d,'
+            '"data":{"eventId":%d,"threadId":%d,"jsstack":null' %
+            (tid, gseq, t + 10, gseq, tid))
+        lines.append(',"stack":"%s"}}' % (stack,))
+        for i in range(rng.randint(0, 3)):
+            lines.append(
+                '{"tid":%d,"depth":1,"mtype":"alloc","time":%d,"data":'
+                '{"source":1,"ptr":%d,"size":%d}}' % (
+                    tid, t + 20 + i, rng.randint(0, 1 << 40),
+                    rng.randint(1, 4096)))
+        lines.append(
+            '{"tid":%d,"gseq":%d,"depth":0,"type":%d,"time":%d,'
+            '"duration":%d,"data":{"scriptName":":!vt:%x","scriptLine":0},'
+            '"mem":{"je_small_alloc":[%d,%d],"je_small_free":[%d,%d],}}' % (
+                tid, gseq + 1, rng.choice((0x1000, 7, 0x1030, 8192)), t,
+                rng.randint(100, 100000),
+                0x7f0000000000 + rng.randint(0, 1 << 24),
+                rng.randint(1, 50), rng.randint(16, 4096),
+                rng.randint(1, 50), rng.randint(16, 4096)))
+        gseq += 2
+    return lines
+
+def make_blobs(lines, per_blob):
+    return ['\n'.join(lines[i:i + per_blob]) + '\n'
+            for i in range(0, len(lines), per_blob)]
+
+def decode_per_line(blobs):
+    '''
+    What Processor.process used to do.
+    '''
+    records = []
+    accum_line = None
+    for blob in blobs:
+        for line in blob.splitlines():
+            if line[0] == ',' and accum_line:
+                line = accum_line + line
+                accum_line = None
+            elif line[0] != '{':
+                continue
+            line = line.replace(',}', '}')
+            if line[-1] != '}':
+                accum_line = line
+                continue
+            records.append(json.loads(line))
+    return records
+
+def decode_chunked(loads):
+    def decode(blobs):
+        records = []
+        decoder = perfishpostproc.RecordDecoder(loads)
+        for objs in decoder.iterChunks(blobs):
+            records.extend(objs)
+        return records
+    return decode
+
+def process_in_memory(srcdir, blobs, procinfo):
+    '''
+    What Processor.process used to do: chew every thread in one process and
+    json.dump the whole result at the end.
+    '''
+    context = perfishpostproc.ProcContext(srcdir, procinfo)
+    thread_procs = {}
+    obj = None
+    for objs in perfishpostproc.RecordDecoder().iterChunks(blobs):
+        perfishpostproc.symbolize_records(procinfo, objs)
+        for obj in objs:
+            tid = obj['tid']
+            if tid in thread_procs:
+                tproc = thread_procs[tid]
+            else:
+                tproc = thread_procs[tid] = perfishpostproc.ThreadProc(
+                                                context, tid)
+            tproc.chew(obj)
+    for tproc in thread_procs.values():
+        tproc.finalizeThread()
+    lastEventEndsAtTime = obj['time']
+    if 'duration' in obj:
+        lastEventEndsAtTime += obj['duration']
+    json_obj = {
+        'threads': [tp.build_json_obj() for tp in thread_procs.values()],
+        'lastEventEndsAtTime': lastEventEndsAtTime
+        }
+    f = open(os.path.join(context.outdir, 'perfdata.json'), 'w')
+    json.dump(json_obj, f)
+    f.close()
+
+def run_memory_variant(variant, trace_path, outdir):
+    '''
+    Process the trace at trace_path (a blob per line) the given way,
+    printing our peak RSS and that of our children in KiB.
+    '''
+    def blobs():
+        f = open(trace_path, 'r')
+        for line in f:
+            yield line
+        f.close()
+    procinfo = addrsymfilt.ProcInfo(None, symbol_cache=None)
+    stdout = sys.stdout
+    # (Processor is chatty)
+    sys.stdout = open(os.devnull, 'w')
+    if variant == 'in-memory':
+        process_in_memory(outdir, blobs(), procinfo)
+    else:
+        perfishpostproc.Processor(int(variant)).process(outdir, blobs(),
+                                                        procinfo)
+    sys.stdout = stdout
+    print resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, \
+          resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+
+def write_trace(num_records, trace_path):
+    f = open(trace_path, 'w')
+    f.write('\n'.join(synthesize_lines(num_records)))
+    f.write('\n')
+    f.close()
+
+def bench_memory(num_records):
+    tmpdir = tempfile.mkdtemp(prefix='perfishbench-')
+    try:
+        trace_path = os.path.join(tmpdir, 'trace')
+        subprocess.check_call([sys.executable, __file__, '--write-trace',
+                               '--records', str(num_records), trace_path])
+        print 'Peak memory processing %d records (%.1f MB)' % (
+            num_records, os.path.getsize(trace_path) / 1000000.0)
+
+        outputs = []
+        for label, variant in (('json.dump everything', 'in-memory'),
+                               ('streaming, 1 job', '1'),
+                               ('streaming, 4 jobs', '4')):
+            outdir = os.path.join(tmpdir, variant)
+            os.mkdir(outdir)
+            start = time.time()
+            proc = subprocess.Popen([sys.executable, __file__,
+                                     '--memory-variant', variant,
+                                     trace_path, outdir],
+                                    stdout=subprocess.PIPE)
+            self_kb, kids_kb = map(int, proc.communicate()[0].split())
+            elapsed = time.time() - start
+            print '  %-24s %8.1f MiB %8.1f MiB in children %8.2fs' % (
+                label, self_kb / 1024.0, kids_kb / 1024.0, elapsed)
+            outputs.append(os.path.join(outdir, 'out', 'perfdata.json'))
+        for output in outputs[1:]:
+            if not filecmp.cmp(outputs[0], output, False):
+                print '  Output differs!'
+        columns_dir = os.path.dirname(outputs[1])
+        print '  perfdata.json %.1f MB, perfdata.bin and manifest %.1f MB' % (
+            os.path.getsize(outputs[1]) / 1000000.0,
+            sum([os.path.getsize(os.path.join(columns_dir, fname))
+                 for fname in (perfishcolumns.BIN_NAME,
+                               perfishcolumns.MANIFEST_NAME)]) / 1000000.0)
+    finally:
+        shutil.rmtree(tmpdir, True)
+
+def main():
+    parser = optparse.OptionParser(
+        usage='usage: %prog [--runs N] [--records N] [--per-blob N] ' +
+              '[--memory]')
+    parser.add_option('--runs', type='int', dest='runs', default=3,
+                      help='Number of runs to take the best of.')
+    parser.add_option('--records', type='int', dest='records',
+                      default=500000,
+                      help='Number of lines in the synthetic trace.')
+    parser.add_option('--per-blob', type='int', dest='per_blob', default=1,
+                      help='Number of lines per blob.')
+    parser.add_option('--memory', dest='memory', action='store_true',
+                      default=False,
+                      help='Measure peak memory of the whole Processor.')
+    # (what --memory runs in subprocesses)
+    parser.add_option('--memory-variant', dest='memory_variant',
+                      default=None, help=optparse.SUPPRESS_HELP)
+    parser.add_option('--write-trace', dest='write_trace',
+                      action='store_true', default=False,
+                      help=optparse.SUPPRESS_HELP)
+    options, args = parser.parse_args()
+
+    if options.write_trace:
+        write_trace(options.records, args[0])
+        return 0
+    if options.memory_variant:
+        run_memory_variant(options.memory_variant, args[0], args[1])
+        return 0
+    if options.memory:
+        bench_memory(options.records)
+        return 0
+
+    blobs = make_blobs(synthesize_lines(options.records), options.per_blob)
+    num_bytes = sum([len(blob) for blob in blobs])
+
+    decoders = [('per-line', decode_per_line),
+                ('RecordDecoder', decode_chunked(json.loads))]
+    if perfishpostproc.fastjson is not json:
+        decoders.append(('RecordDecoder (%s)' %
+                         (perfishpostproc.fastjson.__name__,),
+                         decode_chunked(perfishpostproc.fastjson.loads)))
+
+    print 'Decoding %d blobs, %.1f MB (best of %d)' % (
+        len(blobs), num_bytes / 1000000.0, options.runs)
+    expected = None
+    for label, func in decoders:
+        best = None
+        for i in range(options.runs):
+            start = time.time()
+            records = func(blobs)
+            elapsed = time.time() - start
+            if best is None or elapsed < best:
+                best = elapsed
+        if expected is None:
+            expected = records
+        elif records != expected:
+            print '  %s decoded something different!' % (label,)
+        print '  %-28s %8.3fs %10.0f records/sec %7.1f MB/s' % (
+            label, best, len(records) / best, num_bytes / best / 1000000.0)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,149 @@
+# MPL/GPL/LGPL licensed
+#
+# Cache of the decoded, demuxed and symbolized records of a trace.
+#
+# Getting from the bulk_N files to records that ThreadProc.chew can eat means
+#  merging the per-CPU files, splitting the records up by thread, decoding
+#  their JSON and symbolizing their addresses, none of which changes when
+#  all we changed was the post-processing.  So the first time we process a
+#  trace we save each thread's records, demuxed and symbolized, in the trace
+#  directory, and 'chewchewwoowoo.py --re-run' starts from there.
+#
+# We keep the text of the records and the symbolized values rather than the
+#  decoded dicts and decode them again when we load them.  A dict that gets
+#  rebuilt from another one's items does not necessarily iterate its keys in
+#  the same order, and the key order ends up in perfdata.json, which should
+#  not depend on whether we used the cache.
+#
+# The cache lives in the chew-cache directory of the trace directory:
+#
+# - thread-TID: a series of marshal'ed (chunk, values) tuples, one per chunk
+#   of the thread's record lines that rebuildThread decoded, where values is
+#   the symbolized [(index of the record, key of its data, value)...] (see
+#   perfishpostproc.symbolized_values).  marshal is not a stable format, but
+#   it is fast, and a different python just means we start from the bulk
+#   files again.
+# - manifest.json: {version: CACHE_VERSION, python: "2.7",
+#   inputs: {name: [size, mtime]}, tids: [...], lastTid: 0}, where inputs
+#   covers the bulk files and the maps files that symbolization used and tids
+#   are in the order the threads showed up.  It gets written last, so a cache
+#   without one (or whose inputs have changed since) does not count.
+
+import json, marshal, os, os.path, shutil, sys
+
+CACHE_DIR_NAME = 'chew-cache'
+MANIFEST_NAME = 'manifest.json'
+#: bump when what the records look like by the time we cache them changes
+CACHE_VERSION = 2
+#: the python whose marshal format we are using
+PYTHON_VERSION = '%d.%d' % sys.version_info[:2]
+
+def input_stamps(trace_dir):
+    '''
+    @returns {name: [size, mtime]} for the files of the trace directory that
+        the cached records are derived from.
+    '''
+    names = []
+    i = 0
+    while os.path.exists(os.path.join(trace_dir, 'bulk_%d' % (i,))):
+        names.append('bulk_%d' % (i,))
+        i += 1
+    if os.path.exists(os.path.join(trace_dir, 'maps')):
+        names.append('maps')
+    maps_log_dir = os.path.join(trace_dir, 'maps-log')
+    if os.path.isdir(maps_log_dir):
+        names.extend([os.path.join('maps-log', fname)
+                      for fname in os.listdir(maps_log_dir)])
+    stamps = {}
+    for name in names:
+        st = os.stat(os.path.join(trace_dir, name))
+        stamps[name] = [st.st_size, st.st_mtime]
+    return stamps
+
+def write_records(f, chunk, values):
+    '''
+    Append a chunk of record lines and their symbolized values to a thread's
+    cache file.
+    '''
+    marshal.dump((chunk, values), f)
+
+def read_records(f):
+    '''
+    @returns the next (chunk, values) in a thread's cache file, or None once
+        there are no more.
+    '''
+    try:
+        return marshal.load(f)
+    except EOFError:
+        return None
+
+class RecordCache(object):
+    '''
+    The record cache of one trace directory.
+    '''
+    def __init__(self, trace_dir):
+        self.trace_dir = trace_dir
+        self.path = os.path.join(trace_dir, CACHE_DIR_NAME)
+
+    @classmethod
+    def for_trace(cls, trace_dir):
+        '''
+        @returns the RecordCache for the trace directory, or None if the
+            records are not coming from its bulk files (in which case we
+            have no way to tell whether a cache is up to date).
+        '''
+        if not os.path.exists(os.path.join(trace_dir, 'bulk_0')):
+            return None
+        return cls(trace_dir)
+
+    def thread_path(self, tid):
+        return os.path.join(self.path, 'thread-%d' % (tid,))
+
+    def load(self):
+        '''
+        @returns (tids in the order they showed up, tid of the last record)
+            if the cache is complete and up to date, otherwise None.
+        '''
+        try:
+            f = open(os.path.join(self.path, MANIFEST_NAME), 'r')
+        except IOError:
+            return None
+        try:
+            try:
+                manifest = json.load(f)
+            except ValueError:
+                return None
+        finally:
+            f.close()
+        if (manifest.get('version') != CACHE_VERSION or
+                manifest.get('python') != PYTHON_VERSION or
+                manifest.get('inputs') != input_stamps(self.trace_dir)):
+            return None
+        tids = manifest['tids']
+        for tid in tids:
+            if not os.path.isfile(self.thread_path(tid)):
+                return None
+        return tids, manifest['lastTid']
+
+    def start(self):
+        '''
+        Throw away whatever is in the cache so that we can fill it anew.
+        '''
+        shutil.rmtree(self.path, True)
+        os.mkdir(self.path)
+
+    def finish(self, tids, last_tid):
+        '''
+        Mark the cache as complete once every thread's file is written.
+        '''
+        manifest_path = os.path.join(self.path, MANIFEST_NAME)
+        f = open(manifest_path + '.tmp', 'w')
+        json.dump({
+            'version': CACHE_VERSION,
+            'python': PYTHON_VERSION,
+            'inputs': input_stamps(self.trace_dir),
+            'tids': tids,
+            'lastTid': last_tid,
+            }, f, sort_keys=True)
+        f.close()
+        os.rename(manifest_path + '.tmp', manifest_path)
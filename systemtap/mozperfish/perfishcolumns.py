@@ -0,0 +1,831 @@
+# MPL/GPL/LGPL licensed
+#
+# Columnar binary form of perfdata.json.
+#
+# perfdata.json is great until it is a few hundred megabytes and the web UI
+#  spends most of a minute in JSON.parse.  So alongside it we write out the
+#  same information as flat little-endian arrays that the UI can wrap in typed
+#  array views without parsing anything:
+#
+# - perfdata.bin: one section per thread and then one for the summaries of
+#   the heap, each section being a run of arrays (every one of them starting
+#   on an 8 byte boundary so that a Float64Array can view it in place).
+# - perfdata-manifest.json: a small JSON file saying where everything is.  It
+#   looks like so: {
+#     format: "mozperfish-columns", version: 6, littleEndian: true,
+#     binFile: "perfdata.bin",
+#     lastEventEndsAtTime: 0,
+#     threads: [
+#       {
+#         tid: 0,
+#         offset: 0, length: 0,  // (the thread's section of the bin file)
+#         strings: ARRAY,        // JSON list of the thread's strings
+#         extras: ARRAY,         // JSON list of values we had no column for
+#         // the native stacks (see StackTable in perfishpostproc.py): a
+#         //  JSON list of frame names and a prefix tree of stacks over them,
+#         //  -1 prefixes for outermost frames.  (perfdata.json calls the
+#         //  tree stacks: {prefix, frame}.)
+#         frames: ARRAY, stackTable: {prefix: ARRAY, frame: ARRAY},
+#         events: TABLE,
+#         levents: ARRAY,        // i32 rows of events, as in perfdata.json
+#         // the memory events, as perfishheap.MemEvents keeps them
+#         mevents: {count: 0, time: ARRAY, kind: ARRAY, source: ARRAY,
+#                   ptr: ARRAY, size: ARRAY},
+#         // the top-level events sorted by start time: their start and end
+#         //  times, the running maximum of the ends, and the rows of events
+#         //  that each one (and its descendants) spans.  See IntervalIndex.
+#         index: {starts: ARRAY, ends: ARRAY, maxEnds: ARRAY, rows: ARRAY,
+#                 rowEnds: ARRAY},
+#         // level-of-detail summaries of the top-level events, finest level
+#         //  first, each level's buckets factor times wider; see perfishlod.py
+#         lod: {factor: 4, levels: [
+#           {width: 16.0, starts: ARRAY, types: ARRAY, busy: ARRAY,
+#            count: ARRAY, maxDuration: ARRAY, memDelta: ARRAY}, ...]}
+#       },
+#       ... more threads ...
+#     ],
+#     // summaries of the whole heap over time; see perfishheap.py
+#     heap: {
+#       offset: 0, length: 0,
+#       curve: {times: ARRAY, minLive: ARRAY, maxLive: ARRAY},
+#       histogram: {source: ARRAY, bucket: ARRAY, count: ARRAY, bytes: ARRAY},
+#       leaks: {time: ARRAY, tid: ARRAY, source: ARRAY, ptr: ARRAY,
+#               size: ARRAY}
+#     }
+#   }
+#
+#   where ARRAY is [dtype, offset within the section, length] with
+#   dtype one of "f64", "i32", "u8" or "json" (UTF-8 JSON text, length in
+#   bytes), and TABLE is: {
+#     count: 0,
+#     // (tree tables only) pre-order depth and parent row, -1 for roots
+#     depth: ARRAY, parent: ARRAY,
+#     // bit i set if the row has containers[i] (and bit 7 for 'children')
+#     flags: ARRAY, containers: ["data", "mem"],
+#     fields: [{path: ["data", "scriptName"], kind: "str", column: ARRAY}, ...]
+#   }
+#
+# Each event is a row; every key of the event (or of its 'data' or 'mem'
+#  dicts) is a column, the kind of which we pick based on the values it has:
+#
+# - "i32": integers that fit; I32_ABSENT when the row lacks the key and
+#   I32_NULL when it is null (ex: the type of synthetic events).
+# - "f64": numbers; NaN when the row lacks the key.  If int is true the
+#   values were all integers.
+# - "str": index into the strings, -1 when absent.
+# - "pair": two numbers per row (the 'mem' counts), in an i32 column if
+#   they fit (I32_ABSENT when absent) and an f64 one otherwise (NaN).
+# - "json": index into the extras, -1 when absent.  (The extras are
+#   de-duplicated, so the ubiquitous null jsstack only gets stored once.)
+#
+# A field that most rows lack instead has a "rows" ARRAY listing the rows
+#  that have it and its column only holds their values.
+#
+# The tables hold exactly what perfdata.json does; read_perfdata turns them
+#  back into that object and lib/mozperfish/perfdata-loader.js does the same
+#  in the browser.
+
+import array, bisect, json, mmap, os, os.path, shutil, sys
+
+import perfishheap, perfishlod
+
+# (lib/mozperfish/perfdata-format.js has these for the JS side; keep it in step)
+FORMAT_NAME = 'mozperfish-columns'
+FORMAT_VERSION = 6
+
+MANIFEST_NAME = 'perfdata-manifest.json'
+BIN_NAME = 'perfdata.bin'
+
+I32_ABSENT = -0x80000000
+I32_NULL = -0x7fffffff
+I32_MAX = 0x7fffffff
+
+#: the dtypes of the arrays of a level of detail
+LOD_DTYPES = {'starts': 'f64', 'types': 'i32', 'busy': 'f64', 'count': 'i32',
+              'maxDuration': 'f64', 'memDelta': 'f64'}
+
+#: the dtypes of the memory event columns
+MEVENT_DTYPES = {'time': 'f64', 'kind': 'u8', 'source': 'i32', 'ptr': 'f64',
+                 'size': 'f64'}
+
+#: containers whose keys get their own columns, by flag bit
+CONTAINERS = ('data', 'mem')
+FLAG_CHILDREN = 0x80
+
+NAN = float('nan')
+
+_TYPECODES = {'f64': 'd', 'i32': 'i', 'u8': 'B'}
+_ITEMSIZES = {'f64': 8, 'i32': 4, 'u8': 1}
+
+def _is_number(v):
+    return isinstance(v, (int, long, float)) and not isinstance(v, bool)
+
+def _is_int(v):
+    return isinstance(v, (int, long)) and not isinstance(v, bool)
+
+class SectionWriter(object):
+    '''
+    Appends arrays to a file, keeping track of where they went.
+    '''
+    def __init__(self, f):
+        self.f = f
+        self.pos = 0
+
+    def _write(self, dtype, data, length):
+        where = [dtype, self.pos, length]
+        self.f.write(data)
+        self.pos += len(data)
+        if self.pos % 8:
+            pad = 8 - self.pos % 8
+            self.f.write('\0' * pad)
+            self.pos += pad
+        return where
+
+    def add_array(self, dtype, values):
+        arr = array.array(_TYPECODES[dtype], values)
+        if arr.itemsize != _ITEMSIZES[dtype]:
+            raise Exception('No %d byte array typecode for %s' %
+                            (_ITEMSIZES[dtype], dtype))
+        if sys.byteorder != 'little':
+            arr.byteswap()
+        return self._write(dtype, arr.tostring(), len(arr))
+
+    def add_json(self, obj):
+        text = json.dumps(obj)
+        return self._write('json', text, len(text))
+
+    def add_json_texts(self, texts):
+        '''
+        Add a JSON list given the JSON of each of its items.
+        '''
+        text = '[' + ', '.join(texts) + ']'
+        return self._write('json', text, len(text))
+
+class Interner(object):
+    '''
+    Hands out a small integer for each distinct key.
+    '''
+    def __init__(self):
+        self.ids = {}
+        self.items = []
+
+    def intern(self, key):
+        idx = self.ids.get(key)
+        if idx is None:
+            idx = self.ids[key] = len(self.items)
+            self.items.append(key)
+        return idx
+
+class ThreadTables(object):
+    '''
+    The string and extras tables shared by all of a thread's tables.
+    '''
+    def __init__(self):
+        self.strings = Interner()
+        self.extras = Interner()
+
+    def string_id(self, s):
+        return self.strings.intern(s)
+
+    def extra_id(self, value):
+        return self.extras.intern(json.dumps(value))
+
+class TableBuilder(object):
+    '''
+    Accumulates the rows of one table.  If tree is true, rows are events
+    whose 'children' are rows too.
+    '''
+    def __init__(self, tables, tree):
+        self.tables = tables
+        self.tree = tree
+        self.count = 0
+        self.depth = []
+        self.parent = []
+        self.flags = []
+        #: path => ([row...], [value...])
+        self.fields = {}
+
+    def _add_field(self, path, row, value):
+        field = self.fields.get(path)
+        if field is None:
+            field = self.fields[path] = ([], [])
+        field[0].append(row)
+        field[1].append(value)
+
+    def add_row(self, obj, depth=0, parent=-1):
+        row = self.count
+        self.count += 1
+        flags = 0
+        for key, value in obj.iteritems():
+            if key == 'children' and self.tree:
+                flags |= FLAG_CHILDREN
+            elif key in CONTAINERS and isinstance(value, dict):
+                flags |= 1 << CONTAINERS.index(key)
+                for subkey, subvalue in value.iteritems():
+                    self._add_field((key, subkey), row, subvalue)
+            else:
+                self._add_field((key,), row, value)
+        self.flags.append(flags)
+        if self.tree:
+            self.depth.append(depth)
+            self.parent.append(parent)
+        return row
+
+    def add_tree(self, roots):
+        '''
+        Add the given events and all their descendants in pre-order.
+        '''
+        for root in roots:
+            pending = [(root, 0, -1)]
+            while pending:
+                event, depth, parent = pending.pop()
+                row = self.add_row(event, depth, parent)
+                kids = event.get('children')
+                if kids:
+                    for i in xrange(len(kids) - 1, -1, -1):
+                        pending.append((kids[i], depth + 1, row))
+
+    def _encode(self, values):
+        '''
+        Pick the kind of column for the given values.
+
+        @returns (kind, dtype, number of array items per value, absent value,
+            whether the numbers were all integers, the encoded values)
+        '''
+        tables = self.tables
+        non_null = [v for v in values if v is not None]
+        has_null = len(non_null) != len(values)
+        if non_null and all([_is_number(v) for v in non_null]):
+            all_ints = all([_is_int(v) for v in non_null])
+            if all_ints and all([I32_NULL < v <= I32_MAX for v in non_null]):
+                return ('i32', 'i32', 1, I32_ABSENT, True,
+                        [I32_NULL if v is None else v for v in values])
+            if not has_null:
+                return ('f64', 'f64', 1, NAN, all_ints, values)
+        if not has_null:
+            if all([isinstance(v, basestring) for v in values]):
+                return ('str', 'i32', 1, -1, False,
+                        [tables.string_id(v) for v in values])
+            if all([isinstance(v, (list, tuple)) and len(v) == 2 and
+                    _is_number(v[0]) and _is_number(v[1])
+                    for v in values]):
+                flat = []
+                for v in values:
+                    flat.extend(v)
+                if all([_is_int(v) and I32_NULL < v <= I32_MAX
+                        for v in flat]):
+                    return ('pair', 'i32', 2, I32_ABSENT, True, flat)
+                return ('pair', 'f64', 2, NAN,
+                        all([_is_int(v) for v in flat]), flat)
+        return ('json', 'i32', 1, -1, False,
+                [tables.extra_id(v) for v in values])
+
+    def _write_field(self, writer, path, rows, values):
+        kind, dtype, width, absent, all_ints, encoded = self._encode(values)
+        desc = {'path': list(path), 'kind': kind}
+        if kind in ('f64', 'pair'):
+            desc['int'] = all_ints
+        # Keys that only some rows have (ex: the eventId of event loop
+        #  events) are cheaper to store as the list of rows that have them.
+        itemsize = _ITEMSIZES[dtype] * width
+        if len(rows) * (4 + itemsize) < self.count * itemsize:
+            desc['rows'] = writer.add_array('i32', rows)
+            desc['column'] = writer.add_array(dtype, encoded)
+            return desc
+        column = [absent] * (self.count * width)
+        for i, row in enumerate(rows):
+            column[row * width:(row + 1) * width] = \
+                encoded[i * width:(i + 1) * width]
+        desc['column'] = writer.add_array(dtype, column)
+        return desc
+
+    def write(self, writer):
+        '''
+        Write out our arrays, returning our TABLE description.
+        '''
+        desc = {
+            'count': self.count,
+            'containers': list(CONTAINERS),
+            'flags': writer.add_array('u8', self.flags),
+            }
+        if self.tree:
+            desc['depth'] = writer.add_array('i32', self.depth)
+            desc['parent'] = writer.add_array('i32', self.parent)
+        fields = []
+        for path in sorted(self.fields.keys()):
+            rows, values = self.fields.pop(path)
+            fields.append(self._write_field(writer, path, rows, values))
+        desc['fields'] = fields
+        return desc
+
+def write_thread(f, tid, events, levents, mevents, stack_table):
+    '''
+    Write the columns for one thread (given the same lists that go into its
+    perfdata.json entry, its MemEvents and its StackTable) to f, returning
+    the manifest
+    entry for the thread with offsets relative to the start of what we wrote.
+    '''
+    tables = ThreadTables()
+    writer = SectionWriter(f)
+    thread = {'tid': tid}
+    builder = TableBuilder(tables, True)
+    # index the top-level events by time, noting which rows each one spans
+    intervals = []
+    spans = []
+    for event in events:
+        row = builder.count
+        builder.add_tree([event])
+        spans.append((row, builder.count))
+        start = event['time']
+        intervals.append((start, start + (event.get('duration') or 0)))
+    thread['events'] = builder.write(writer)
+    order, index = IntervalIndex.build(intervals)
+    thread['index'] = {
+        'starts': writer.add_array('f64', index.starts),
+        'ends': writer.add_array('f64', index.ends),
+        'maxEnds': writer.add_array('f64', index.max_ends),
+        'rows': writer.add_array('i32', [spans[i][0] for i in order]),
+        'rowEnds': writer.add_array('i32', [spans[i][1] for i in order]),
+        }
+    levels = []
+    for level in perfishlod.build_pyramid(events):
+        desc = {'width': level['width']}
+        for key, dtype in sorted(LOD_DTYPES.items()):
+            desc[key] = writer.add_array(dtype, level[key])
+        levels.append(desc)
+    thread['lod'] = {
+        'factor': perfishlod.FACTOR,
+        'levels': levels,
+        }
+    # (events rows are in pre-order, so the levents indices are rows too)
+    thread['levents'] = writer.add_array('i32', levents)
+    thread['mevents'] = {'count': len(mevents)}
+    for name, dtype in sorted(MEVENT_DTYPES.items()):
+        thread['mevents'][name] = writer.add_array(dtype,
+                                                   getattr(mevents, name))
+
+    thread['frames'] = writer.add_json(stack_table.frames)
+    thread['stackTable'] = {
+        'prefix': writer.add_array('i32', stack_table.prefixes),
+        'frame': writer.add_array('i32', stack_table.stack_frames),
+        }
+
+    thread['strings'] = writer.add_json(tables.strings.items)
+    thread['extras'] = writer.add_json_texts(tables.extras.items)
+    thread['length'] = writer.pos
+    return thread
+
+def write_heap(f, threads, data):
+    '''
+    Write the summaries of the heap to f given the manifest entries of the
+    threads in data, returning the manifest entry for them with offsets
+    relative to the start of what we wrote.
+    '''
+    summary = perfishheap.summarize(
+        [(thread['tid'], ThreadColumns(thread, data, thread['offset']).mevents)
+         for thread in threads])
+    writer = SectionWriter(f)
+    heap = {}
+    for section, columns in perfishheap.SECTIONS:
+        heap[section] = {}
+        for name, dtype in columns:
+            heap[section][name] = writer.add_array(dtype,
+                                                   summary[section][name])
+    heap['length'] = writer.pos
+    return heap
+
+def write_perfdata_columns(outdir, thread_parts, lastEventEndsAtTime):
+    '''
+    Write perfdata.bin and its manifest given (path, manifest entry) for the
+    files written by write_thread, deleting them as we go.  The heap
+    summaries need every thread's memory events, so we work them out from
+    the threads' sections once they are all in perfdata.bin.
+    '''
+    threads = []
+    bin_path = os.path.join(outdir, BIN_NAME)
+    f = open(bin_path, 'w+b')
+    offset = 0
+    for part_path, thread in thread_parts:
+        part_file = open(part_path, 'rb')
+        shutil.copyfileobj(part_file, f, 1024 * 1024)
+        part_file.close()
+        os.unlink(part_path)
+        thread['offset'] = offset
+        offset += thread['length']
+        threads.append(thread)
+    f.flush()
+    if offset:
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    else:
+        data = ''
+    heap = write_heap(f, threads, data)
+    heap['offset'] = offset
+    if offset:
+        data.close()
+    f.close()
+
+    # (written last so that anyone who sees it can trust the bin file)
+    f = open(os.path.join(outdir, MANIFEST_NAME), 'w')
+    json.dump({
+        'format': FORMAT_NAME,
+        'version': FORMAT_VERSION,
+        'littleEndian': True,
+        'binFile': BIN_NAME,
+        'lastEventEndsAtTime': lastEventEndsAtTime,
+        'threads': threads,
+        'heap': heap,
+        }, f, sort_keys=True)
+    f.close()
+
+
+def load_manifest(outdir):
+    f = open(os.path.join(outdir, MANIFEST_NAME), 'r')
+    try:
+        manifest = json.load(f)
+    finally:
+        f.close()
+    if (manifest.get('format') != FORMAT_NAME or
+            manifest.get('version') != FORMAT_VERSION):
+        raise ValueError('%s is not a version %d manifest' %
+                         (MANIFEST_NAME, FORMAT_VERSION))
+    return manifest
+
+class IntervalIndex(object):
+    '''
+    Finds which of a bunch of intervals overlap a time range.  The intervals
+    are sorted by start; since we also keep the running maximum of their
+    ends, the ones that can overlap [t0, t1] are a contiguous run that we can
+    find by bisecting both.
+    '''
+    def __init__(self, starts, ends, max_ends):
+        self.starts = starts
+        self.ends = ends
+        self.max_ends = max_ends
+
+    @classmethod
+    def build(cls, intervals):
+        '''
+        @returns (the order to put the (start, end) intervals in, the
+            IntervalIndex of them in that order)
+        '''
+        order = sorted(xrange(len(intervals)), key=lambda i: intervals[i][0])
+        starts = [intervals[i][0] for i in order]
+        ends = [intervals[i][1] for i in order]
+        max_ends = []
+        max_end = float('-inf')
+        for end in ends:
+            if end > max_end:
+                max_end = end
+            max_ends.append(max_end)
+        return order, cls(starts, ends, max_ends)
+
+    def overlapping(self, t0, t1):
+        '''
+        @returns the (sorted) positions of the intervals that overlap
+            [t0, t1].
+        '''
+        lo = bisect.bisect_left(self.max_ends, t0)
+        hi = bisect.bisect_right(self.starts, t1)
+        ends = self.ends
+        return [i for i in xrange(lo, hi) if ends[i] >= t0]
+
+class SectionColumns(object):
+    '''
+    Read access to the arrays of a section of perfdata.bin, which starts at
+    base within data.  data can be a string or an mmap; we only look at the
+    bits we need.
+    '''
+    def __init__(self, data, base=0):
+        self.data = data
+        self.base = base
+
+    def array(self, where, start=0, stop=None):
+        '''
+        @returns items [start, stop) of the array (or the decoded JSON).
+        '''
+        dtype, offset, length = where
+        offset += self.base
+        if dtype == 'json':
+            return json.loads(self.data[offset:offset + length])
+        if stop is None or stop > length:
+            stop = length
+        itemsize = _ITEMSIZES[dtype]
+        arr = array.array(_TYPECODES[dtype])
+        arr.fromstring(self.data[offset + start * itemsize:
+                                 offset + stop * itemsize])
+        if sys.byteorder != 'little':
+            arr.byteswap()
+        return arr
+
+    def arrays(self, wheres):
+        '''
+        @returns dict of name => array given dict of name => ARRAY.
+        '''
+        return dict([(name, self.array(where))
+                     for name, where in wheres.iteritems()])
+
+class ThreadColumns(SectionColumns):
+    '''
+    Read access to one thread's arrays.
+    '''
+    def __init__(self, thread, data, base=0):
+        SectionColumns.__init__(self, data, base)
+        self.thread = thread
+        self.tid = thread['tid']
+        self._strings = None
+        self._extras = None
+        self._index = None
+        self._lod_levels = None
+
+    @property
+    def strings(self):
+        if self._strings is None:
+            self._strings = self.array(self.thread['strings'])
+        return self._strings
+
+    @property
+    def extras(self):
+        if self._extras is None:
+            self._extras = self.array(self.thread['extras'])
+        return self._extras
+
+    def field_values(self, field, lo, hi):
+        '''
+        @returns a list of (row - lo, value) for the rows in [lo, hi) that
+            have the field.
+        '''
+        kind = field['kind']
+        width = kind == 'pair' and 2 or 1
+        if 'rows' in field:
+            rows = self.array(field['rows'])
+            first = bisect.bisect_left(rows, lo)
+            last = bisect.bisect_left(rows, hi)
+            rows = [row - lo for row in rows[first:last]]
+        else:
+            first, last = lo, hi
+            rows = None
+        column = self.array(field['column'], first * width, last * width)
+
+        if kind == 'pair':
+            values = [[column[i], column[i + 1]]
+                      for i in xrange(0, len(column), 2)]
+            if field['column'][0] == 'i32':
+                absent = lambda v: v[0] == I32_ABSENT
+            else:
+                absent = lambda v: v[0] != v[0]
+                if field['int']:
+                    values = [v if absent(v) else [int(v[0]), int(v[1])]
+                              for v in values]
+        elif kind == 'f64' and field['int']:
+            values = [int(v) if v == v else v for v in column]
+        elif kind == 'str':
+            values = [self.strings[v] if v != -1 else v for v in column]
+        elif kind == 'json':
+            values = [self.extras[v] if v != -1 else v for v in column]
+        else:
+            values = list(column)
+
+        if rows is not None:
+            if kind == 'i32':
+                values = [None if v == I32_NULL else v for v in values]
+            return zip(rows, values)
+        # (a dense column; pick out the rows that actually have the field)
+        if kind == 'i32':
+            return [(row, None if v == I32_NULL else v)
+                    for row, v in enumerate(values) if v != I32_ABSENT]
+        elif kind == 'pair':
+            return [(row, v) for row, v in enumerate(values) if not absent(v)]
+        elif kind == 'f64':
+            return [(row, v) for row, v in enumerate(values) if v == v]
+        return [(row, v) for row, v in enumerate(values) if v != -1]
+
+    def column(self, name, path):
+        '''
+        @returns a list of the values of the given table's field at path
+            (ex: ('data', 'scriptName')) for every row, with None for the
+            rows that lack it.
+        '''
+        table = self.thread[name]
+        values = [None] * table['count']
+        for field in table['fields']:
+            if tuple(field['path']) == path:
+                for row, v in self.field_values(field, 0, table['count']):
+                    values[row] = v
+        return values
+
+    def rows(self, name, lo=0, hi=None):
+        '''
+        @returns rows [lo, hi) of the given table as dicts, without any
+            children.
+        '''
+        table = self.thread[name]
+        if hi is None or hi > table['count']:
+            hi = table['count']
+        flags = self.array(table['flags'], lo, hi)
+        containers = table['containers']
+        objs = []
+        for i in xrange(hi - lo):
+            obj = {}
+            for bit, container in enumerate(containers):
+                if flags[i] & (1 << bit):
+                    obj[container] = {}
+            objs.append(obj)
+        for field in table['fields']:
+            path = field['path']
+            if len(path) == 1:
+                key = path[0]
+                for row, v in self.field_values(field, lo, hi):
+                    objs[row][key] = v
+            else:
+                container, key = path
+                for row, v in self.field_values(field, lo, hi):
+                    objs[row][container][key] = v
+        return objs
+
+    def _tree_roots(self, name, lo, hi):
+        '''
+        @returns [(row, event)...] for the top-level events among rows
+            [lo, hi) of the given table, with their descendants in that range
+            hung off them.
+        '''
+        table = self.thread[name]
+        objs = self.rows(name, lo, hi)
+        flags = self.array(table['flags'], lo, hi)
+        parents = self.array(table['parent'], lo, hi)
+        roots = []
+        for i, obj in enumerate(objs):
+            if flags[i] & FLAG_CHILDREN:
+                obj['children'] = []
+            parent = parents[i]
+            if parent < lo:
+                roots.append((lo + i, obj))
+            else:
+                objs[parent - lo]['children'].append(obj)
+        return roots
+
+    def tree(self, name, lo=0, hi=None):
+        '''
+        @returns the top-level events of the given table (among rows [lo, hi),
+            which should start on a top-level event) with their descendants
+            hung off them, as in perfdata.json.
+        '''
+        return [obj for row, obj in self._tree_roots(name, lo, hi)]
+
+    @property
+    def index(self):
+        '''
+        (IntervalIndex of the top-level events, their rows, and the row after
+        each of their last descendants), all in order of start time.
+        '''
+        if self._index is None:
+            index = self.thread['index']
+            self._index = (IntervalIndex(self.array(index['starts']),
+                                         self.array(index['ends']),
+                                         self.array(index['maxEnds'])),
+                           self.array(index['rows']),
+                           self.array(index['rowEnds']))
+        return self._index
+
+    @property
+    def lod_levels(self):
+        '''
+        The level-of-detail summaries of the top-level events, finest first,
+        as {width: mS, starts: array, types: array, ...}.
+        '''
+        if self._lod_levels is None:
+            self._lod_levels = []
+            for desc in self.thread['lod']['levels']:
+                level = {'width': desc['width']}
+                for key in LOD_DTYPES:
+                    level[key] = self.array(desc[key])
+                self._lod_levels.append(level)
+        return self._lod_levels
+
+    def lod_level(self, time_per_pixel):
+        '''
+        @returns the coarsest level of detail whose buckets are no wider than
+            time_per_pixel mS, or None if we should just draw the events.
+        '''
+        levels = self.thread['lod']['levels']
+        i = perfishlod.pick_level([level['width'] for level in levels],
+                                  time_per_pixel)
+        if i is None:
+            return None
+        return self.lod_levels[i]
+
+    @property
+    def mevents(self):
+        '''
+        The memory events as dict of column => array; see
+        perfishheap.MemEvents.
+        '''
+        mevents = dict(self.thread['mevents'])
+        del mevents['count']
+        return self.arrays(mevents)
+
+    def events_in(self, t0, t1):
+        '''
+        @returns the top-level events (with all their descendants) that
+            overlap the time range [t0, t1], in order of start time.  We only
+            read the rows for those events.
+        '''
+        intervals, rows, row_ends = self.index
+        hits = intervals.overlapping(t0, t1)
+        # read runs of adjacent events in one go
+        spans = sorted([(rows[i], row_ends[i]) for i in hits])
+        events_by_row = {}
+        run_lo = run_hi = None
+        for lo, hi in spans + [(None, None)]:
+            if run_hi is not None and lo != run_hi:
+                for row, event in self._tree_roots('events', run_lo, run_hi):
+                    events_by_row[row] = event
+                run_lo = None
+            if run_lo is None:
+                run_lo = lo
+            run_hi = hi
+        return [events_by_row[rows[i]] for i in hits]
+
+    def json_obj(self):
+        '''
+        @returns this thread's entry in perfdata.json.
+        '''
+        stack_table = self.thread['stackTable']
+        mevents = {}
+        for name, column in self.mevents.iteritems():
+            if name in ('ptr', 'size'):
+                mevents[name] = [int(v) for v in column]
+            else:
+                mevents[name] = list(column)
+        return {
+            'tid': self.tid,
+            'events': self.tree('events'),
+            'levents': list(self.array(self.thread['levents'])),
+            'mevents': mevents,
+            'frames': self.array(self.thread['frames']),
+            'stacks': {
+                'prefix': [None if prefix == -1 else prefix
+                           for prefix in self.array(stack_table['prefix'])],
+                'frame': list(self.array(stack_table['frame'])),
+                },
+            }
+
+class PerfDataColumns(object):
+    '''
+    Read access to perfdata.bin.  We map it in and only look at the parts
+    we are asked about.
+    '''
+    def __init__(self, outdir):
+        self.outdir = outdir
+        self.manifest = load_manifest(outdir)
+        self.lastEventEndsAtTime = self.manifest['lastEventEndsAtTime']
+        self.tids = [thread['tid'] for thread in self.manifest['threads']]
+        self.threads_by_tid = dict([(thread['tid'], thread)
+                                    for thread in self.manifest['threads']])
+
+        f = open(os.path.join(outdir, self.manifest['binFile']), 'rb')
+        try:
+            if os.fstat(f.fileno()).st_size:
+                self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            else:
+                # (mmap will not map an empty file)
+                self.data = ''
+        finally:
+            f.close()
+
+    def thread(self, tid):
+        thread = self.threads_by_tid[tid]
+        return ThreadColumns(thread, self.data, thread['offset'])
+
+    def heap(self):
+        '''
+        @returns the summaries of the heap as {section: {column: array}};
+            see perfishheap.py.
+        '''
+        heap = self.manifest['heap']
+        section_columns = SectionColumns(self.data, heap['offset'])
+        return dict([(section, section_columns.arrays(heap[section]))
+                     for section, columns in perfishheap.SECTIONS])
+
+    def events_in(self, tid, t0, t1):
+        '''
+        @returns the top-level events of the given thread (with their
+            descendants) that overlap [t0, t1], in order of start time.
+        '''
+        return self.thread(tid).events_in(t0, t1)
+
+    def json_obj(self):
+        '''
+        @returns what json.load would make of perfdata.json.
+        '''
+        return {
+            'threads': [self.thread(tid).json_obj() for tid in self.tids],
+            'lastEventEndsAtTime': self.lastEventEndsAtTime
+            }
+
+    def close(self):
+        if not isinstance(self.data, str):
+            self.data.close()
+        self.data = None
+
+def read_perfdata(outdir):
+    return PerfDataColumns(outdir).json_obj()
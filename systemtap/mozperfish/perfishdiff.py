@@ -0,0 +1,291 @@
+#!/usr/bin/python
+# MPL/GPL/LGPL licensed
+#
+# Usage: perfishdiff.py [--z-score Z] [--limit N] [--json PATH]
+#                       OLD_OUTDIR NEW_OUTDIR
+#
+# Compare two runs of the same thing (ex: an xpcshell test before and after a
+#  patch) to see what got slower or hungrier.
+#
+# Thread ids and times change from run to run, so we match events up by
+#  where they happen instead: the type and scriptName (the symbolized script
+#  or vtable) of the event and of each of its ancestors.  For each such path
+#  we add up, over every thread, how many events there were, how long they
+#  took (inclusive of their children, in mS) and how many bytes they
+#  allocated themselves (the 'mem' counts mozperfish.stp attributes to them,
+#  reallocs counting their growth).
+#
+# A change counts if it is unlikely to be noise:
+#
+# - count: the difference in the number of events, treating each count as
+#   Poisson, is at least Z standard deviations.
+# - time and memory: Welch's t statistic for the difference in the mean
+#   duration (or bytes) per event is at least Z, or the count changed.
+#
+# Each kind of change is ranked by how much the total moved.  We
+#  only read the columns we need out of each perfdata.bin (see
+#  perfishcolumns.py) rather than loading either perfdata.json.  We use NumPy
+#  to add things up if it is installed and plain python if not.
+
+import json, math, optparse, sys
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+import perfishcolumns, perfishsummary
+
+#: how many standard deviations a change has to be to count
+DEFAULT_Z_SCORE = 3.0
+
+#: the per-path sums collect computes
+STAT_KEYS = ('count', 'time', 'timeSq', 'mem', 'memSq')
+
+def allocated_bytes(mem):
+    '''
+    @returns the bytes allocated given an event's 'mem' dict.
+    '''
+    total = 0
+    for key, value in mem.iteritems():
+        if key.endswith('_alloc') or key.endswith('_realloc'):
+            # (for reallocs, [count, bytes grown, bytes shrunk])
+            total += value[1]
+    return total
+
+def _thread_rows(thread):
+    '''
+    @returns (parent, type, scriptName, duration, bytes allocated) lists for
+        the thread's events.
+    '''
+    count = thread.thread['events']['count']
+    parents = thread.array(thread.thread['events']['parent'])
+    types = thread.column('events', ('type',))
+    names = thread.column('events', ('data', 'scriptName'))
+    durations = [duration or 0.0
+                 for duration in thread.column('events', ('duration',))]
+    mems = [{} for i in xrange(count)]
+    for field in thread.thread['events']['fields']:
+        path = field['path']
+        if len(path) == 2 and path[0] == 'mem':
+            for row, value in thread.field_values(field, 0, count):
+                mems[row][path[1]] = value
+    return parents, types, names, durations, map(allocated_bytes, mems)
+
+def _sums(node_ids, node_count, durations, mems):
+    '''
+    @returns a list of the STAT_KEYS sums per node.
+    '''
+    if numpy is not None:
+        node_ids = numpy.array(node_ids, dtype=numpy.int64)
+        durations = numpy.array(durations, dtype=numpy.float64)
+        mems = numpy.array(mems, dtype=numpy.float64)
+        columns = [numpy.bincount(node_ids, minlength=node_count).tolist()]
+        columns.extend([numpy.bincount(node_ids, weights=weights,
+                                       minlength=node_count).tolist()
+                        for weights in (durations, durations * durations,
+                                        mems, mems * mems)])
+        return zip(*columns)
+    sums = [[0, 0.0, 0.0, 0.0, 0.0] for i in xrange(node_count)]
+    for node, duration, mem in zip(node_ids, durations, mems):
+        stats = sums[node]
+        stats[0] += 1
+        stats[1] += duration
+        stats[2] += duration * duration
+        stats[3] += mem
+        stats[4] += mem * mem
+    return sums
+
+def collect(outdir):
+    '''
+    @returns {path: {STAT_KEYS...}} for the events of the perfdata.bin in
+        outdir, where a path is a tuple of (type, scriptName) from the
+        top-level event down to the event itself.  The synthetic events
+        between top-level events do not count.
+    '''
+    columns = perfishcolumns.PerfDataColumns(outdir)
+    try:
+        #: (parent node, type, scriptName) => node, for every thread
+        node_ids = {}
+        nodes = []
+        row_nodes = []
+        row_durations = []
+        row_mems = []
+        for tid in columns.tids:
+            parents, types, names, durations, mems = \
+                _thread_rows(columns.thread(tid))
+            # (rows are in pre-order, so parents come before their children)
+            thread_nodes = [-1] * len(types)
+            for row, event_type in enumerate(types):
+                if event_type is None:
+                    continue
+                parent = parents[row]
+                if parent != -1:
+                    parent = thread_nodes[parent]
+                key = (parent, event_type, names[row])
+                node = node_ids.get(key)
+                if node is None:
+                    node = node_ids[key] = len(nodes)
+                    nodes.append(key)
+                thread_nodes[row] = node
+                row_nodes.append(node)
+                row_durations.append(durations[row])
+                row_mems.append(mems[row])
+    finally:
+        columns.close()
+
+    paths = []
+    for parent, event_type, name in nodes:
+        if parent == -1:
+            path = ()
+        else:
+            path = paths[parent]
+        paths.append(path + ((event_type, name),))
+    sums = _sums(row_nodes, len(nodes), row_durations, row_mems)
+    return dict([(paths[node], dict(zip(STAT_KEYS, stats)))
+                 for node, stats in enumerate(sums)])
+
+def _welch(count1, total1, sq1, count2, total2, sq2):
+    '''
+    @returns Welch's t statistic for the difference between the means of
+        two samples given their counts, sums and sums of squares, or 0 if
+        either is too small to say anything about.
+    '''
+    if count1 < 2 or count2 < 2:
+        return 0.0
+    mean1 = total1 / count1
+    mean2 = total2 / count2
+    var1 = max(sq1 - total1 * mean1, 0.0) / (count1 - 1)
+    var2 = max(sq2 - total2 * mean2, 0.0) / (count2 - 1)
+    error = math.sqrt(var1 / count1 + var2 / count2)
+    if not error:
+        if mean1 == mean2:
+            return 0.0
+        return mean2 > mean1 and float('inf') or float('-inf')
+    return (mean2 - mean1) / error
+
+def _json_number(v):
+    '''
+    JSON has no infinity, so clamp.
+    '''
+    return max(min(v, sys.float_info.max), -sys.float_info.max)
+
+def _by_change(changes, key):
+    changes.sort(key=lambda change: (
+        -abs(change['new'][key] - change['old'][key]), change['path']))
+    return changes
+
+def diff(old, new, z_score=DEFAULT_Z_SCORE):
+    '''
+    @param old the collect() of the first run
+    @param new the collect() of the second run
+    @returns {zScore, count: [...], time: [...], memory: [...]} listing the
+        paths whose number of events, total time or memory allocated changed
+        meaningfully, biggest change first.
+    '''
+    empty = dict([(key, 0) for key in STAT_KEYS])
+    count_changes = []
+    time_changes = []
+    mem_changes = []
+    for path in set(old.keys()) | set(new.keys()):
+        o = old.get(path, empty)
+        n = new.get(path, empty)
+        count_z = (n['count'] - o['count']) / math.sqrt(o['count'] +
+                                                        n['count'])
+        time_z = _welch(o['count'], o['time'], o['timeSq'],
+                        n['count'], n['time'], n['timeSq'])
+        mem_z = _welch(o['count'], o['mem'], o['memSq'],
+                       n['count'], n['mem'], n['memSq'])
+        count_changed = abs(count_z) >= z_score
+        change = {
+            'path': [{'type': event_type,
+                      'name': perfishsummary.event_name(event_type),
+                      'scriptName': name}
+                     for event_type, name in path],
+            'old': {'count': o['count'], 'time': o['time'], 'mem': o['mem']},
+            'new': {'count': n['count'], 'time': n['time'], 'mem': n['mem']},
+            'countZ': _json_number(count_z),
+            'timeZ': _json_number(time_z),
+            'memZ': _json_number(mem_z),
+            }
+        if count_changed:
+            count_changes.append(change)
+        if n['time'] != o['time'] and (count_changed or
+                                       abs(time_z) >= z_score):
+            time_changes.append(change)
+        if n['mem'] != o['mem'] and (count_changed or abs(mem_z) >= z_score):
+            mem_changes.append(change)
+    return {
+        'zScore': z_score,
+        'count': _by_change(count_changes, 'count'),
+        'time': _by_change(time_changes, 'time'),
+        'memory': _by_change(mem_changes, 'mem'),
+        }
+
+def format_path(path):
+    return ' > '.join([step['scriptName'] and
+                       '%s (%s)' % (step['name'], step['scriptName']) or
+                       step['name']
+                       for step in path])
+
+def _change_table(title, changes, key, number_format, z_key, limit):
+    '''
+    @returns the lines of the table of the given changes in key.
+    '''
+    lines = ['%s, %d changes:' % (title, len(changes))]
+    rows = []
+    for change in changes[:limit]:
+        old = change['old'][key]
+        new = change['new'][key]
+        z = abs(change['countZ'])
+        if z_key:
+            z = max(z, abs(change[z_key]))
+        rows.append([format_path(change['path']),
+                     ('%+' + number_format[1:]) % (new - old,),
+                     number_format % (old,), number_format % (new,),
+                     '%.1f' % (z,)])
+    lines.extend(perfishsummary.format_table(
+        ['path', 'change', 'old', 'new', 'z'], rows))
+    return lines
+
+def format_diff(result, limit=None):
+    '''
+    @returns the diff as text tables, with at most limit rows per table if
+        limit is not None.
+    '''
+    lines = _change_table('Events', result['count'], 'count', '%d', None,
+                          limit)
+    lines.append('')
+    lines.extend(_change_table('Time (mS)', result['time'], 'time', '%.3f',
+                               'timeZ', limit))
+    lines.append('')
+    lines.extend(_change_table('Memory allocated (bytes)', result['memory'],
+                               'mem', '%d', 'memZ', limit))
+    return '\n'.join(lines) + '\n'
+
+def main():
+    parser = optparse.OptionParser(
+        usage='usage: %prog [--z-score Z] [--limit N] [--json PATH] ' +
+              'OLD_OUTDIR NEW_OUTDIR')
+    parser.add_option('--z-score', type='float', dest='z_score',
+                      default=DEFAULT_Z_SCORE,
+                      help='How many standard deviations a change has to ' +
+                           'be to count.')
+    parser.add_option('--limit', type='int', dest='limit', default=30,
+                      help='Number of changes of each kind to print.')
+    parser.add_option('--json', dest='json_path', default=None,
+                      help='Also write every change out as JSON here.')
+    options, args = parser.parse_args()
+    if len(args) != 2:
+        parser.error('need the old and new output directories')
+
+    result = diff(collect(args[0]), collect(args[1]), options.z_score)
+    sys.stdout.write(format_diff(result, options.limit).encode('utf-8'))
+    if options.json_path:
+        f = open(options.json_path, 'w')
+        json.dump(result, f, sort_keys=True)
+        f.close()
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,281 @@
+# MPL/GPL/LGPL licensed
+#
+# Whole-process heap summaries computed from every thread's memory events.
+#
+# mozperfish.stp reports each alloc, realloc and free as it happens.  There
+#  are a lot of them, so rather than keeping them as dicts each thread keeps
+#  them in MemEvents' typed columns, where a realloc is a KIND_REALLOC_FROM
+#  row for the old block followed by a KIND_REALLOC_TO row for the new one.
+#  Memory freed by one thread is often allocated by another, so we summarize
+#  all the threads' events together, in order of time, to come up with:
+#
+# - curve: the net bytes allocated since the trace started, as its minimum
+#   and maximum within each of up to CURVE_POINTS equal slices of the trace
+#   (only the slices with events in them).  Frees of memory allocated before
+#   the trace started count too, so this can go negative.
+# - histogram: how many allocations (and how many bytes) each source made of
+#   each size, by power of two: bucket b holds the sizes with a bit length of
+#   b, i.e. [2 ** (b - 1), 2 ** b).
+# - leaks: the blocks that were still allocated when the trace ended, in
+#   order of when they were allocated.
+#
+# We use NumPy if it is installed and plain python if not; the results are
+#  the same either way.
+
+import array
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+KIND_ALLOC = 0
+KIND_FREE = 1
+KIND_REALLOC_FROM = 2
+KIND_REALLOC_TO = 3
+
+#: the number of slices of the trace the curve has (at most) a point for
+CURVE_POINTS = 2048
+
+#: section => ((column, dtype)...) for what summarize returns
+SECTIONS = (
+    ('curve', (('times', 'f64'), ('minLive', 'f64'), ('maxLive', 'f64'))),
+    ('histogram', (('source', 'i32'), ('bucket', 'i32'), ('count', 'i32'),
+                   ('bytes', 'f64'))),
+    ('leaks', (('time', 'f64'), ('tid', 'i32'), ('source', 'i32'),
+               ('ptr', 'f64'), ('size', 'f64'))),
+    )
+
+#: (column, array typecode) of MemEvents
+COLUMNS = (('time', 'd'), ('kind', 'B'), ('source', 'i'), ('ptr', 'd'),
+           ('size', 'd'))
+
+class MemEvents(object):
+    '''
+    A thread's memory events as array-backed columns: time (mS), kind (one of
+    the KIND_* constants), source (the mozperfish.stp allocator id), ptr and
+    size.  Pointers and sizes are kept as doubles, which is exact for
+    anything below 2 ** 53.
+    '''
+    def __init__(self):
+        for name, typecode in COLUMNS:
+            setattr(self, name, array.array(typecode))
+
+    def __len__(self):
+        return len(self.time)
+
+    def _add_row(self, time, kind, source, ptr, size):
+        self.time.append(time)
+        self.kind.append(kind)
+        self.source.append(source)
+        self.ptr.append(ptr)
+        self.size.append(size)
+
+    def add(self, mtype, time, data):
+        '''
+        Add a memory record given its mtype, time and data.
+        '''
+        if mtype == 'alloc':
+            self._add_row(time, KIND_ALLOC, data['source'], data['ptr'],
+                          data['size'])
+        elif mtype == 'free':
+            self._add_row(time, KIND_FREE, data['source'], data['ptr'],
+                          data['size'])
+        elif mtype == 'realloc':
+            self._add_row(time, KIND_REALLOC_FROM, data['source'],
+                          data['oldptr'], data['oldsize'])
+            self._add_row(time, KIND_REALLOC_TO, data['source'],
+                          data['newptr'], data['newsize'])
+        else:
+            raise Exception('Unknown memory event type: %r' % (mtype,))
+
+    def columns(self):
+        '''
+        @returns dict of column => array
+        '''
+        return dict([(name, getattr(self, name))
+                     for name, typecode in COLUMNS])
+
+    def json_values(self, name):
+        '''
+        @returns a generator of the column's values as they go in
+            perfdata.json, where pointers and sizes are integers.
+        '''
+        column = getattr(self, name)
+        if name in ('ptr', 'size'):
+            return (int(v) for v in column)
+        return iter(column)
+
+def _concatenate(threads):
+    '''
+    @returns (tid of each row, dict of column => array of every thread's
+        rows, one thread after another).
+    '''
+    tids = []
+    columns = {}
+    for name, typecode in COLUMNS:
+        columns[name] = array.array(typecode)
+    for tid, thread_columns in threads:
+        for name, column in columns.iteritems():
+            column.extend(thread_columns[name])
+        tids.extend([tid] * len(thread_columns['time']))
+    return tids, columns
+
+def _curve_slices(times):
+    '''
+    @returns (start of the trace, width of each of the curve's slices)
+    '''
+    start = min(times)
+    width = (max(times) - start) / CURVE_POINTS
+    return start, width or 1.0
+
+def _summarize_python(tids, columns):
+    times = columns['time']
+    kinds = columns['kind']
+    sources = columns['source']
+    ptrs = columns['ptr']
+    sizes = columns['size']
+    order = sorted(xrange(len(times)), key=times.__getitem__)
+
+    start, width = _curve_slices(times)
+    curve_times = []
+    min_live = []
+    max_live = []
+    live = 0.0
+    last_slice = None
+    histogram = {}
+    #: ptr => position in order of the row that allocated it
+    allocated = {}
+    for pos, row in enumerate(order):
+        kind = kinds[row]
+        size = sizes[row]
+        ptr = ptrs[row]
+        if kind == KIND_ALLOC or kind == KIND_REALLOC_TO:
+            live += size
+            key = (sources[row], int(size).bit_length())
+            counts = histogram.get(key)
+            if counts is None:
+                counts = histogram[key] = [0, 0.0]
+            counts[0] += 1
+            counts[1] += size
+            if ptr:
+                allocated[ptr] = pos
+        else:
+            live -= size
+            allocated.pop(ptr, None)
+
+        curve_slice = min(int((times[row] - start) / width), CURVE_POINTS - 1)
+        if curve_slice != last_slice:
+            last_slice = curve_slice
+            curve_times.append(start + curve_slice * width)
+            min_live.append(live)
+            max_live.append(live)
+        elif live < min_live[-1]:
+            min_live[-1] = live
+        elif live > max_live[-1]:
+            max_live[-1] = live
+
+    keys = sorted(histogram.keys())
+    leak_rows = [order[pos] for pos in sorted(allocated.values())]
+    return {
+        'curve': {'times': curve_times, 'minLive': min_live,
+                  'maxLive': max_live},
+        'histogram': {
+            'source': [key[0] for key in keys],
+            'bucket': [key[1] for key in keys],
+            'count': [histogram[key][0] for key in keys],
+            'bytes': [histogram[key][1] for key in keys],
+            },
+        'leaks': {
+            'time': [times[row] for row in leak_rows],
+            'tid': [tids[row] for row in leak_rows],
+            'source': [sources[row] for row in leak_rows],
+            'ptr': [ptrs[row] for row in leak_rows],
+            'size': [sizes[row] for row in leak_rows],
+            },
+        }
+
+def _group_starts(*keys):
+    '''
+    @returns the positions where any of the (sorted) keys change, starting
+        with 0.
+    '''
+    changed = numpy.zeros(len(keys[0]), dtype=bool)
+    changed[:1] = True
+    for key in keys:
+        changed[1:] |= key[1:] != key[:-1]
+    return numpy.flatnonzero(changed)
+
+def _summarize_numpy(tids, columns):
+    times = numpy.frombuffer(columns['time'], dtype=numpy.float64)
+    kinds = numpy.frombuffer(columns['kind'], dtype=numpy.uint8)
+    sources = numpy.frombuffer(columns['source'], dtype=numpy.int32)
+    ptrs = numpy.frombuffer(columns['ptr'], dtype=numpy.float64)
+    sizes = numpy.frombuffer(columns['size'], dtype=numpy.float64)
+    tids = numpy.array(tids, dtype=numpy.int64)
+    order = numpy.argsort(times, kind='mergesort')
+    times, kinds, sources, ptrs, sizes, tids = [
+        column[order] for column in (times, kinds, sources, ptrs, sizes, tids)]
+    allocs = (kinds == KIND_ALLOC) | (kinds == KIND_REALLOC_TO)
+
+    live = numpy.cumsum(numpy.where(allocs, sizes, -sizes))
+    start, width = _curve_slices(times)
+    slices = numpy.minimum(((times - start) / width).astype(numpy.int64),
+                           CURVE_POINTS - 1)
+    firsts = _group_starts(slices)
+    curve = {
+        'times': start + slices[firsts] * width,
+        'minLive': numpy.minimum.reduceat(live, firsts),
+        'maxLive': numpy.maximum.reduceat(live, firsts),
+        }
+
+    alloc_sources = sources[allocs]
+    alloc_sizes = sizes[allocs]
+    # (the exponent frexp gives an integer is its bit length)
+    buckets = numpy.frexp(alloc_sizes)[1]
+    by_key = numpy.lexsort((buckets, alloc_sources))
+    alloc_sources = alloc_sources[by_key]
+    buckets = buckets[by_key]
+    firsts = _group_starts(alloc_sources, buckets)
+    histogram = {
+        'source': alloc_sources[firsts],
+        'bucket': buckets[firsts],
+        'count': numpy.diff(numpy.append(firsts, len(buckets))),
+        'bytes': numpy.add.reduceat(alloc_sizes[by_key], firsts),
+        }
+
+    # a block is still allocated if the last thing to happen to its ptr
+    #  allocated it
+    by_ptr = numpy.lexsort((numpy.arange(len(ptrs)), ptrs))
+    lasts = numpy.append(_group_starts(ptrs[by_ptr])[1:], len(ptrs)) - 1
+    lasts = by_ptr[lasts]
+    leaked = numpy.sort(lasts[allocs[lasts] & (ptrs[lasts] != 0)])
+    leaks = {
+        'time': times[leaked],
+        'tid': tids[leaked],
+        'source': sources[leaked],
+        'ptr': ptrs[leaked],
+        'size': sizes[leaked],
+        }
+
+    results = {'curve': curve, 'histogram': histogram, 'leaks': leaks}
+    for section in results.itervalues():
+        for name, column in section.items():
+            section[name] = column.tolist()
+    return results
+
+def summarize(threads):
+    '''
+    Summarize the memory events of every thread.
+
+    @param threads a list of (tid, dict of column => array) where the
+        columns are those of MemEvents.
+    @returns {section: {column: [value...]}} as described by SECTIONS.
+    '''
+    tids, columns = _concatenate(threads)
+    if not tids:
+        return dict([(section, dict([(name, []) for name, dtype in names]))
+                     for section, names in SECTIONS])
+    if numpy is not None:
+        return _summarize_numpy(tids, columns)
+    return _summarize_python(tids, columns)
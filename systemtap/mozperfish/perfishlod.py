@@ -0,0 +1,262 @@
+# MPL/GPL/LGPL licensed
+#
+# Level-of-detail summaries of a thread's events for the timeline UI.
+#
+# Once a trace runs for more than a few seconds there are far more events
+#  than there are pixels to draw them in, so we precompute a pyramid of
+#  time-bucketed summaries of the top-level events and the UI draws those
+#  when it is zoomed out.
+#
+# Level 0 has buckets BASE_WIDTH mS wide and each level's buckets are FACTOR
+#  times wider than the last.  Buckets start at multiples of their width (not
+#  at the start of the thread) so that the buckets of different threads line
+#  up and each bucket is exactly FACTOR buckets of the level below.  We keep
+#  adding levels until everything fits in one bucket.  Levels with at least
+#  as many buckets as there are events are no cheaper to draw than the events
+#  themselves, so we skip those: the first level is the finest one that
+#  spans the thread in fewer buckets than it has events.
+#
+# A level only has entries for the (bucket, event type) pairs that have
+#  something in them, sorted by bucket start and then type.  Each entry has:
+#
+# - busy: how much of the bucket events of that type spent running.  Events
+#   that span buckets get split between them.
+# - count: the number of events of that type that started in the bucket.
+# - maxDuration: the longest of those events.
+# - memDelta: the bytes allocated minus the bytes freed by those events and
+#   all their descendants.
+#
+# The synthetic events that fill the gaps between top-level events have a
+#  type of NULL_TYPE.  They count and have memory deltas, but they are not
+#  busy.
+#
+# We use NumPy to build the buckets if it is installed and plain python if
+#  not; the results are the same either way (give or take floating point
+#  rounding).
+
+import math
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+#: the width of level 0's buckets, in mS
+BASE_WIDTH = 1.0
+#: how many times wider each level's buckets are than the last's
+FACTOR = 4
+
+#: the type of synthetic events (the same as perfishcolumns.I32_NULL so that
+#:  the types can be written out as they are)
+NULL_TYPE = -0x7fffffff
+
+#: the per-entry values of a level, besides its bucket starts and types
+SUMMARY_KEYS = ('busy', 'count', 'maxDuration', 'memDelta')
+
+def mem_delta(mem):
+    '''
+    @returns the net bytes allocated given an event's 'mem' dict.
+    '''
+    delta = 0
+    for key, value in mem.iteritems():
+        if key.endswith('_alloc'):
+            delta += value[1]
+        elif key.endswith('_free'):
+            delta -= value[1]
+        elif key.endswith('_realloc'):
+            # [count, bytes grown, bytes shrunk]
+            delta += value[1] - value[2]
+    return delta
+
+def summarize_events(events):
+    '''
+    @returns a list of (start, duration, type, memDelta) for the given
+        top-level events, with memDelta covering their descendants too.
+    '''
+    summaries = []
+    for event in events:
+        delta = 0
+        pending = [event]
+        while pending:
+            e = pending.pop()
+            mem = e.get('mem')
+            if mem:
+                delta += mem_delta(mem)
+            kids = e.get('children')
+            if kids:
+                pending.extend(kids)
+        start = event['time']
+        event_type = event.get('type')
+        if event_type is None:
+            event_type = NULL_TYPE
+        summaries.append((start, event.get('duration') or 0, event_type,
+                          delta))
+    return summaries
+
+def _last_bucket(start, end, width):
+    '''
+    @returns the bucket an event ends in; an event that ends right on a
+        bucket boundary does not make it into the next bucket.
+    '''
+    last = int(math.ceil(end / width)) - 1
+    first = int(math.floor(start / width))
+    if last < first:
+        return first
+    return last
+
+def first_width(summaries):
+    '''
+    @returns the width of the first level worth having for the given
+        summaries.
+    '''
+    lo = min([s[0] for s in summaries])
+    hi = max([s[0] + s[1] for s in summaries])
+    width = BASE_WIDTH
+    while True:
+        first = math.floor(lo / width)
+        last = math.floor(hi / width)
+        if last == first or last - first + 1 < len(summaries):
+            return width
+        width *= FACTOR
+
+def _build_python(summaries, width):
+    '''
+    @returns the levels as lists of (bucket, type, busy, count, maxDuration,
+        memDelta) tuples.
+    '''
+    entries = {}
+    for start, duration, event_type, delta in summaries:
+        end = start + duration
+        bucket = int(math.floor(start / width))
+        entry = entries.get((bucket, event_type))
+        if entry is None:
+            entry = entries[(bucket, event_type)] = [0.0, 0, 0.0, 0]
+        entry[1] += 1
+        if duration > entry[2]:
+            entry[2] = duration
+        entry[3] += delta
+        if event_type == NULL_TYPE:
+            continue
+        last = _last_bucket(start, end, width)
+        entry[0] += min(end, (bucket + 1) * width) - start
+        for b in xrange(bucket + 1, last + 1):
+            entry = entries.get((b, event_type))
+            if entry is None:
+                entry = entries[(b, event_type)] = [0.0, 0, 0.0, 0]
+            entry[0] += min(end, (b + 1) * width) - b * width
+
+    levels = []
+    while entries:
+        levels.append(sorted([key + tuple(value)
+                              for key, value in entries.iteritems()]))
+        if len(set([bucket for bucket, event_type in entries])) <= 1:
+            break
+        coarser = {}
+        for (bucket, event_type), value in entries.iteritems():
+            key = (bucket // FACTOR, event_type)
+            entry = coarser.get(key)
+            if entry is None:
+                coarser[key] = list(value)
+            else:
+                entry[0] += value[0]
+                entry[1] += value[1]
+                if value[2] > entry[2]:
+                    entry[2] = value[2]
+                entry[3] += value[3]
+        entries = coarser
+    return levels
+
+def _group(buckets, types, busy, count, max_duration, delta):
+    '''
+    Merge the entries with the same bucket and type, sorting them by bucket
+    and then type.
+    '''
+    order = numpy.lexsort((types, buckets))
+    buckets, types = buckets[order], types[order]
+    new_group = numpy.ones(len(order), dtype=bool)
+    new_group[1:] = (buckets[1:] != buckets[:-1]) | (types[1:] != types[:-1])
+    firsts = numpy.flatnonzero(new_group)
+    return (buckets[firsts], types[firsts],
+            numpy.add.reduceat(busy[order], firsts),
+            numpy.add.reduceat(count[order], firsts),
+            numpy.maximum.reduceat(max_duration[order], firsts),
+            numpy.add.reduceat(delta[order], firsts))
+
+def _build_numpy(summaries, width):
+    starts = numpy.array([s[0] for s in summaries], dtype=numpy.float64)
+    durations = numpy.array([s[1] for s in summaries], dtype=numpy.float64)
+    ends = starts + durations
+    types = numpy.array([s[2] for s in summaries], dtype=numpy.int64)
+    deltas = numpy.array([s[3] for s in summaries], dtype=numpy.float64)
+
+    firsts = numpy.floor(starts / width).astype(numpy.int64)
+    lasts = numpy.ceil(ends / width).astype(numpy.int64) - 1
+    lasts = numpy.maximum(lasts, firsts)
+    # (synthetic events are not busy, so they only need their first bucket)
+    lasts[types == NULL_TYPE] = firsts[types == NULL_TYPE]
+
+    # an entry for every bucket every event touches, with the event's
+    #  count, duration and memory going in its first bucket
+    spans = lasts - firsts + 1
+    which = numpy.repeat(numpy.arange(len(summaries)), spans)
+    offsets = (numpy.arange(len(which)) -
+               numpy.repeat(numpy.cumsum(spans) - spans, spans))
+    buckets = firsts[which] + offsets
+    first_bucket = offsets == 0
+    busy = (numpy.minimum(ends[which], (buckets + 1) * width) -
+            numpy.maximum(starts[which], buckets * width))
+    busy[types[which] == NULL_TYPE] = 0.0
+    grouped = _group(buckets, types[which], busy,
+                     first_bucket.astype(numpy.int64),
+                     numpy.where(first_bucket, durations[which], 0.0),
+                     numpy.where(first_bucket, deltas[which], 0.0))
+
+    levels = []
+    while True:
+        levels.append(zip(*[column.tolist() for column in grouped]))
+        buckets = grouped[0]
+        if len(buckets) == 0 or buckets[0] == buckets[-1]:
+            break
+        grouped = _group(buckets // FACTOR, *grouped[1:])
+    return levels
+
+def build_pyramid(events):
+    '''
+    Build the levels for the given top-level events.
+
+    @returns a list of levels, finest first, each being {width: mS,
+        starts: [...], types: [...], busy: [...], count: [...],
+        maxDuration: [...], memDelta: [...]}.
+    '''
+    summaries = summarize_events(events)
+    if not summaries:
+        return []
+    width = first_width(summaries)
+    if numpy is not None:
+        raw_levels = _build_numpy(summaries, width)
+    else:
+        raw_levels = _build_python(summaries, width)
+
+    levels = []
+    for entries in raw_levels:
+        level = {'width': width,
+                 'starts': [entry[0] * width for entry in entries],
+                 'types': [entry[1] for entry in entries]}
+        for i, key in enumerate(SUMMARY_KEYS):
+            level[key] = [entry[i + 2] for entry in entries]
+        # (NumPy hands us floats for the memory deltas)
+        level['memDelta'] = [int(v) for v in level['memDelta']]
+        levels.append(level)
+        width *= FACTOR
+    return levels
+
+def pick_level(widths, time_per_pixel):
+    '''
+    @returns the index of the coarsest level whose buckets are no wider than
+        a pixel, or None if even the finest level's are.
+    '''
+    best = None
+    for i, width in enumerate(widths):
+        if width <= time_per_pixel:
+            best = i
+    return best
@@ -8,14 +8,95 @@
 #     threads: [
 #       {
 #         events: [],
-#         mevents: []
+#         // the event-loop view of events; see ThreadProc.levents
+#         levents: [],
+#         // the thread's memory events as columns; see perfishheap.MemEvents
+#         mevents: {time: [], kind: [], source: [], ptr: [], size: []},
+#         // the thread's native stacks, which events' data.stack refer to by
+#         //  index; see StackTable
+#         frames: [],
+#         stacks: {prefix: [], frame: []}
 #       },
 #       ... more threads ...
 #     ],
 #     lastEventEndsAtTime: 0,
 #   }
+# - The same thing in columnar binary form, perfdata.bin, along with
+#   perfdata-manifest.json to say what is where.  See perfishcolumns.py.
+#   This also has level-of-detail summaries of each thread for the timeline
+#   UI; see perfishlod.py.  And summaries of the heap as a whole; see
+#   perfishheap.py.
+# - Latency statistics per event type and script, and the event-loop events
+#   that took too long, in summary.json and summary.txt.  See
+#   perfishsummary.py.  To compare the outputs of two runs, see
+#   perfishdiff.py.
+# - If asked, how long each stage of all this took, in the trace directory;
+#   see perfishprofile.py.
+#
+# Along the way we save the demuxed and symbolized records of each thread in
+#  the trace directory so that processing the trace again can skip straight
+#  to decoding and chewing them; see perfishcache.py.
+
+import array, gc, json, multiprocessing, os, os.path, shutil, tempfile
+
+import perfishcache, perfishcolumns, perfishheap, perfishprofile
+import perfishsummary
+
+# Decoding the trace is where we spend most of our time, so use a faster JSON
+#  decoder if one is installed.  (They all raise ValueError subclasses.)
+try:
+    import ujson as fastjson
+except ImportError:
+    try:
+        import simplejson as fastjson
+    except ImportError:
+        fastjson = json
+
+#: how many list items write_json_list encodes at a time
+JSON_BATCH_SIZE = 1000
 
-import json, os, os.path
+def write_json_list(f, items):
+    '''
+    Write what json.dump would make of list(items) to f without ever having
+    the whole list (or its JSON) in memory, as long as items is a generator.
+    '''
+    f.write('[')
+    batch = []
+    first = True
+    for item in items:
+        batch.append(item)
+        if len(batch) >= JSON_BATCH_SIZE:
+            if not first:
+                f.write(', ')
+            f.write(json.dumps(batch)[1:-1])
+            first = False
+            batch = []
+    if batch:
+        if not first:
+            f.write(', ')
+        f.write(json.dumps(batch)[1:-1])
+    f.write(']')
+
+def write_json_skeleton(f, skeleton, part_writers):
+    '''
+    Write what json.dump would make of skeleton to f, except that the value
+    of each key in part_writers (which should be [] in skeleton) gets written
+    by calling part_writers[key](f) instead.  This lets us write a big object
+    a piece at a time while json still decides what order the keys go in.
+    '''
+    text = json.dumps(skeleton)
+    places = []
+    for key, writer in part_writers.items():
+        marker = '%s: []' % (json.dumps(key),)
+        places.append((text.index(marker) + len(marker) - 2, writer))
+    places.sort()
+    pos = 0
+    for idx, writer in places:
+        f.write(text[pos:idx])
+        writer(f)
+        # (skip the [] placeholder)
+        pos = idx + 2
+    f.write(text[pos:])
 
 class ProcContext(object):
     '''
@@ -25,6 +106,8 @@ class ProcContext(object):
     def __init__(self, srcdir, procinfo):
         self.srcdir = srcdir
         self.procinfo = procinfo
+        #: times the stages of processing (if enabled)
+        self.profiler = perfishprofile.StageProfiler()
 
         self.outdir = os.path.join(srcdir, 'out')
         if not os.path.exists(self.outdir):
@@ -47,18 +130,182 @@ class ProcContext(object):
                     os.symlink(src_file, dest_link)
                 
 
-    def write_results_file(self, json_obj):
+    def write_results_file(self, thread_paths, lastEventEndsAtTime):
+        '''
+        Write out perfdata.json given files holding each thread's JSON (as
+        written by ThreadProc.write_json), deleting them as we go.  The result
+        is exactly what json.dump would have made of the whole thing.
+        '''
+        def write_threads(f):
+            f.write('[')
+            for i, thread_path in enumerate(thread_paths):
+                if i:
+                    f.write(', ')
+                thread_file = open(thread_path, 'r')
+                shutil.copyfileobj(thread_file, f, 1024 * 1024)
+                thread_file.close()
+                os.unlink(thread_path)
+            f.write(']')
+
         path = os.path.join(self.outdir, 'perfdata.json')
         f = open(path, 'w')
-        json.dump(json_obj, f)
+        write_json_skeleton(f, {
+            'threads': [],
+            'lastEventEndsAtTime': lastEventEndsAtTime
+            }, {'threads': write_threads})
         f.close()
 
+    def write_columns_file(self, thread_columns, lastEventEndsAtTime):
+        '''
+        Write out perfdata.bin and its manifest given (path, manifest entry)
+        for each thread's columns (as written by ThreadProc.write_columns),
+        deleting the files as we go.
+        '''
+        perfishcolumns.write_perfdata_columns(self.outdir, thread_columns,
+                                              lastEventEndsAtTime)
+
+class StackTable(object):
+    '''
+    A thread's symbolized native stacks, kept the way sampling profilers keep
+    theirs: a table of distinct frame names plus a prefix tree of stacks,
+    where each stack is a frame and the stack of its callers (its prefix,
+    None for the outermost frame).  Events' data['stack'] is the id of their
+    innermost stack in the tree, so each distinct stack is stored once.
+    '''
+    def __init__(self):
+        #: frame names by frame id
+        self.frames = []
+        #: frame name => frame id
+        self.frame_ids = {}
+        #: the prefix (-1 for none) and frame of each stack, by stack id
+        self.prefixes = array.array('i')
+        self.stack_frames = array.array('i')
+        #: (prefix + 1) << 32 | frame => stack id
+        self.stack_ids = {}
+
+    def _frame_id(self, name):
+        frame = self.frame_ids.get(name)
+        if frame is None:
+            frame = self.frame_ids[name] = len(self.frames)
+            self.frames.append(name)
+        return frame
+
+    def add_stack(self, names):
+        '''
+        Add the given (symbolized, innermost frame first) stack.
+
+        @returns its stack id
+        '''
+        frames = [self._frame_id(name) for name in names]
+        stack_ids = self.stack_ids
+        prefixes = self.prefixes
+        stack_frames = self.stack_frames
+        stack = -1
+        for frame in reversed(frames):
+            key = (stack + 1) << 32 | frame
+            prefix = stack
+            stack = stack_ids.get(key)
+            if stack is None:
+                stack = stack_ids[key] = len(prefixes)
+                prefixes.append(prefix)
+                stack_frames.append(frame)
+        return stack
+
+    def finish(self):
+        '''
+        Forget the lookup tables we only need for adding stacks.
+        '''
+        self.frame_ids = self.stack_ids = None
+
+    def json_obj(self):
+        '''
+        @returns {frames: [name...], stacks: {prefix: [...], frame: [...]}}
+        '''
+        return {
+            'frames': self.frames,
+            'stacks': {
+                'prefix': [None if prefix == -1 else prefix
+                           for prefix in self.prefixes],
+                'frame': self.stack_frames.tolist()
+                }
+            }
+
+def expand_stacks(thread):
+    '''
+    Replace the stack ids in the data of the events of a thread's entry in
+    perfdata.json with their frame names, as we used to output them.
+    '''
+    frames = thread['frames']
+    prefixes = thread['stacks']['prefix']
+    stack_frames = thread['stacks']['frame']
+    expanded = {}
+    def expand(stack_id):
+        names = expanded.get(stack_id)
+        if names is None:
+            names = expanded[stack_id] = []
+            while stack_id is not None:
+                names.append(frames[stack_frames[stack_id]])
+                stack_id = prefixes[stack_id]
+        return names
+    pending = list(thread['events'])
+    while pending:
+        event = pending.pop()
+        data = event.get('data')
+        if data and 'stack' in data:
+            data['stack'] = list(expand(data['stack']))
+        kids = event.get('children')
+        if kids:
+            pending.extend(kids)
+
 EV_EVENT_LOOP = 0x1000
 # socket ready events happen as part of a (nested) event loop
 EV_SOCK_READY = 0x1030
 
 REPARENTING_EVENTS = set([EV_EVENT_LOOP, EV_SOCK_READY])
 
+def build_event_loop_view(events, levent_indices):
+    '''
+    Turn a thread's levents as they appear in perfdata.json (pre-order indices
+    into events) back into the events themselves, as ThreadProc used to
+    output them.  Events that had something re-parented out from under them
+    are copied so that we can leave it out of their children; everything else
+    is the original event.
+    '''
+    flat = []
+    parents = []
+    pending = [(event, -1) for event in reversed(events)]
+    while pending:
+        event, parent = pending.pop()
+        index = len(flat)
+        flat.append(event)
+        parents.append(parent)
+        kids = event.get('children')
+        if kids:
+            for i in xrange(len(kids) - 1, -1, -1):
+                pending.append((kids[i], index))
+
+    reparented = set([index for index in levent_indices
+                      if parents[index] != -1])
+    # everything above a re-parented event needs a copy
+    kids_of = {}
+    for index in reparented:
+        parent = parents[index]
+        while parent != -1 and parent not in kids_of:
+            kids_of[parent] = []
+            parent = parents[parent]
+    for index, parent in enumerate(parents):
+        if parent in kids_of:
+            kids_of[parent].append(index)
+
+    def view(index):
+        if index not in kids_of:
+            return flat[index]
+        clone = flat[index].copy()
+        clone['children'] = [view(kid) for kid in kids_of[index]
+                             if kid not in reparented]
+        return clone
+    return [view(index) for index in levent_indices]
+
 class ThreadProc(object):
     '''
     Tracks per-thread information.
@@ -84,50 +331,114 @@ class ThreadProc(object):
         #   inside an existing event loop invocation) as top-level.  Because
         #   we are still using a native stack, re-parented events will be
         #   entirely contained time-wise by a preceding event.
-        #  This is computed by transforming the contents of events as a
-        #   post-processing pass.
+        #  Rather than copying the events to make this view, it is a list of
+        #   the events themselves; the re-parented ones are listed in
+        #   reparented and are to be left out of their parents' children.  In
+        #   the output, it is the pre-order indices of the events within the
+        #   events tree (see build_event_loop_view).
+        #  This is computed by _derive_event_loop_events as a post-processing
+        #   pass.
         self.levents = None
+        #: the pre-order indices of the levents
+        self.levent_indices = None
+        #: id()s of the events in levents that are not top-level
+        self.reparented = None
         #: memory events; exist outside of the structured event perspective
-        self.mevents = []
+        self.mevents = perfishheap.MemEvents()
+        #: the native stacks of our events
+        self.stack_table = StackTable()
 
     def _derive_event_loop_events(self):
-        self.levents = levents = []
+        levents = self.levents = []
+        indices = self.levent_indices = []
+        reparented = self.reparented = set()
+        # (a list so that visit can bump it)
+        next_index = [0]
 
-        def transform_event(event, isTop=False):
+        def visit(event, collect):
             '''
-            Copy the event and its children; if a child should be reparented to
-            the top-level, contribute it to levents instead of the event we are
-            currently processing.
+            Number the event and its descendants in pre-order; if collect,
+            re-parent the descendants that should be to the top-level.
+            @returns the event's index
             '''
-            clone = event.copy()
-            if isTop:
-                levents.append(clone)
-            # bail if it has no children and so there is nothing more to do
-            if ('children' not in event) or (len(event['children']) == 0):
-                return clone
-            # clone the children, handling reparenting as needed
-            clone['children'] = clone_kids = []
-            for kid_event in event['children']:
-                if kid_event['type'] in REPARENTING_EVENTS:
-                    levents.append(transform_event(kid_event))
-                else:
-                    clone_kids.append(transform_event(kid_event))
-            return clone
+            index = next_index[0]
+            next_index[0] += 1
+            for kid_event in event.get('children', ()):
+                kid_index = visit(kid_event, collect)
+                if collect and kid_event['type'] in REPARENTING_EVENTS:
+                    levents.append(kid_event)
+                    indices.append(kid_index)
+                    reparented.add(id(kid_event))
+            return index
 
         for top_level_event in self.events:
-            # skip synthetic inter-space events
+            # skip synthetic inter-space events (but count them)
             if top_level_event['type'] is None:
+                visit(top_level_event, False)
                 continue
-            transform_event(top_level_event, True)
+            # (the top-level event goes before anything re-parented out of it)
+            levents.append(top_level_event)
+            indices.append(next_index[0])
+            visit(top_level_event, True)
+
+    def levent_children(self, event):
+        '''
+        @returns the children of the event in the event-loop view.
+        '''
+        return [kid for kid in event.get('children', ())
+                if id(kid) not in self.reparented]
 
     def build_json_obj(self):
         self._derive_event_loop_events()
-        return {
+        obj = {
             'tid': self.tid,
             'events': self.events,
-            'levents': self.levents,
-            'mevents': self.mevents
+            'levents': self.levent_indices,
+            'mevents': dict([(name, list(self.mevents.json_values(name)))
+                             for name, typecode in perfishheap.COLUMNS])
+            }
+        obj.update(self.stack_table.json_obj())
+        return obj
+
+    def write_columns(self, f):
+        '''
+        Write our columnar form to f, returning our entry for the manifest.
+        '''
+        if self.levent_indices is None:
+            self._derive_event_loop_events()
+        return perfishcolumns.write_thread(f, self.tid, self.events,
+                                           self.levent_indices, self.mevents,
+                                           self.stack_table)
+
+    def write_json(self, f):
+        '''
+        Write exactly what json.dump would make of build_json_obj() to f, but
+        a piece at a time, and then forget our events.
+        '''
+        if self.levent_indices is None:
+            self._derive_event_loop_events()
+        skeleton = {
+            'tid': self.tid,
+            'events': [],
+            'levents': [],
+            'mevents': []
             }
+        skeleton.update(self.stack_table.json_obj())
+        mevents_skeleton = {}
+        mevents_writers = {}
+        for name, typecode in perfishheap.COLUMNS:
+            mevents_skeleton[name] = []
+            mevents_writers[name] = lambda f, name=name: write_json_list(
+                f, self.mevents.json_values(name))
+        write_json_skeleton(f, skeleton, {
+            'events': lambda f: write_json_list(f, self.events),
+            'levents': lambda f: write_json_list(f, self.levent_indices),
+            'mevents': lambda f: write_json_skeleton(f, mevents_skeleton,
+                                                     mevents_writers)
+            })
+        self.events = self.levents = self.mevents = None
+        self.levent_indices = self.reparented = None
+        self.stack_table = None
 
     def chew(self, obj):
         ## this is getting out of control, need to normalize by:
@@ -152,7 +463,7 @@ class ThreadProc(object):
         # - figure out the type of event...
         if 'mtype' in obj:
             # it's a memory event!
-            self.mevents.append(obj)
+            self.mevents.add(obj['mtype'], obj['time'], obj['data'])
             return
 
         if obj_depth is None:
@@ -165,17 +476,9 @@ class ThreadProc(object):
             obj['duration'] *= 0.000001
 
         data = obj['data']
-        # - perform address translation on potentially affected fields
-        if 'scriptName' in data and data['scriptName'].startswith(':!'):
-            data['scriptName'] = \
-                self.context.procinfo.transformString(data['scriptName'])
-        if ('callerScriptName' in data and
-                data['callerScriptName'].startswith(':!')):
-            data['callerScriptName'] = \
-                self.context.procinfo.transformString(data['callerScriptName'])
-        if ('stack' in data):
-            data['stack'] =  self.context.procinfo.transformStackString(
-                                 data['stack'])
+        # (symbolize_records already symbolized the stack)
+        if 'stack' in data:
+            data['stack'] = self.stack_table.add_stack(data['stack'])
 
         # - add fields...
         obj['children'] = ()
@@ -218,63 +521,594 @@ class ThreadProc(object):
             if not (len(self.stack) == 1 and len(self.stack[0][1]) == 0):
                 print 'Thread', self.tid, 'still has stack contents!:'
                 print repr(self.stack)
+        self.stack_table.finish()
+
+
+#: how many bytes worth of blobs RecordDecoder.iterChunks decodes at once
+DECODE_CHUNK_SIZE = 256 * 1024
+
+class RecordDecoder(object):
+    '''
+    Turns the blobs mozperfish.stp hands us into decoded record dicts (or just
+    the lines of the complete records, if you ask for completeLines).
+
+    Each record is a line of JSON, except that the probes leave trailing
+    commas in objects (',}') and a record can get split across lines (the
+    continuation line starts with ',') or across blobs.  The common case is a
+    blob full of complete records, which we decode in one go by turning the
+    whole blob into a JSON array; anything else goes line by line, but we
+    still decode each blob's records in a single call.
+
+    Bulk mode tends to give us a blob per probe firing, so iterChunks glues
+    runs of blobs together to get the most out of that.
+    '''
+    def __init__(self, loads=None):
+        self.loads = loads or fastjson.loads
+        #: the incomplete start of a record we are waiting on the rest of
+        self.accum_line = None
+
+    def _iterJoined(self, blobs, chunk_size):
+        '''
+        Glue the blobs together into around chunk_size bytes at a time.  We
+        only glue together blobs that end in a newline so that we see the
+        same lines we would have seen a blob at a time.  The blobs can be
+        strings or memoryviews (see Processor.accepts_memoryviews); this is
+        where they get copied.
+        '''
+        pending = bytearray()
+        for blob in blobs:
+            pending += blob
+            if len(pending) >= chunk_size or blob[-1:] != '\n':
+                yield str(pending)
+                pending = bytearray()
+        if pending:
+            yield str(pending)
+
+    def iterChunks(self, blobs, chunk_size=DECODE_CHUNK_SIZE):
+        '''
+        Decode the given blobs around chunk_size bytes at a time, yielding a
+        list of records for each chunk.
+        '''
+        for chunk in self._iterJoined(blobs, chunk_size):
+            yield self.decode(chunk)
+
+    def iterLineChunks(self, blobs, chunk_size=DECODE_CHUNK_SIZE):
+        '''
+        Like iterChunks, but yields lists of record lines instead.
+        '''
+        for chunk in self._iterJoined(blobs, chunk_size):
+            yield self.completeLines(chunk)
+
+    def _splitTail(self, blob):
+        '''
+        Prepend any record we were waiting on the rest of and split blob into
+        (body, tail) where body ends with the last complete line and the tail
+        is whatever follows it.
+        '''
+        if self.accum_line is not None:
+            if blob.startswith('{'):
+                print 'Ignoring incomplete line:', self.accum_line.rstrip()
+            else:
+                blob = self.accum_line + blob
+            self.accum_line = None
 
+        if blob.endswith('}\n'):
+            return blob, ''
+        cut = blob.rfind('}\n') + 2
+        if cut == 1:
+            cut = 0
+        return blob[:cut], blob[cut:]
+
+    def _stitchBody(self, body):
+        '''
+        If every line of body is a record once we glue the continuation lines
+        onto the lines before them, return the glued text.  Otherwise, return
+        None and leave it to _stitchLines.
+        '''
+        # (a ',' line after a line that is already complete gets ignored)
+        if '}\n,' in body:
+            return None
+        stitched = body.replace('\n,', ',').replace(',}', '}')
+        num_lines = stitched.count('\n')
+        if (num_lines and stitched[0] == '{' and
+                stitched.count('}\n') == num_lines and
+                stitched.count('\n{') == num_lines - 1):
+            return stitched
+        return None
+
+    def decode(self, blob):
+        '''
+        @returns a list of the records completed by this blob.
+        '''
+        body, tail = self._splitTail(blob)
+        stitched = self._stitchBody(body)
+        objs = None
+        if stitched is not None:
+            try:
+                objs = self._loadArray(stitched[:-1].replace('\n', ','))
+                if len(objs) != stitched.count('\n'):
+                    objs = None
+            except ValueError:
+                pass
+        if objs is None:
+            # (let _decodeLines find and complain about any bad line)
+            objs = self._decodeLines(
+                self._stitchLines(body.replace(',}', '}')))
+        if tail:
+            objs.extend(self._decodeLines(
+                self._stitchLines(tail.replace(',}', '}'))))
+        return objs
+
+    def completeLines(self, blob):
+        '''
+        @returns a list of the (fixed up, but undecoded) lines of the records
+            completed by this blob.
+        '''
+        body, tail = self._splitTail(blob)
+        stitched = self._stitchBody(body)
+        if stitched is not None:
+            lines = stitched[:-1].split('\n')
+        else:
+            lines = self._stitchLines(body.replace(',}', '}'))
+        if tail:
+            lines.extend(self._stitchLines(tail.replace(',}', '}')))
+        return lines
+
+    def _stitchLines(self, blob):
+        '''
+        @returns a list of the complete record lines in blob, gluing
+            continuation lines onto whatever preceded them.
+        '''
+        lines = []
+        accum_line = self.accum_line
+        for line in blob.splitlines():
+            if not line:
+                continue
+            if line[0] != '{' and accum_line:
+                line = (accum_line + line).replace(',}', '}')
+                accum_line = None
+            elif line[0] != '{':
+                print 'Ignoring line:', line.rstrip()
+                continue
+            elif accum_line:
+                print 'Ignoring incomplete line:', accum_line.rstrip()
+                accum_line = None
+            if line[-1] != '}':
+                accum_line = line
+                continue
+            lines.append(line)
+        self.accum_line = accum_line
+        return lines
+
+    def _loadArray(self, text):
+        '''
+        Decode a comma-separated run of records.  The cycle collector keeps
+        re-walking every record we have decoded so far as we allocate new ones,
+        which more than doubles the cost of decoding.  Records cannot have
+        cycles, so we switch it off while we decode.
+        '''
+        gc_was_enabled = gc.isenabled()
+        gc.disable()
+        try:
+            return self.loads('[' + text + ']')
+        finally:
+            if gc_was_enabled:
+                gc.enable()
+
+    def _decodeLines(self, lines):
+        if not lines:
+            return []
+        try:
+            objs = self._loadArray(','.join(lines))
+            if len(objs) == len(lines):
+                return objs
+        except ValueError:
+            pass
+        # something is wrong with one of the lines; figure out which.
+        objs = []
+        for line in lines:
+            try:
+                objs.append(self.loads(line))
+            except Exception, e:
+                print 'BIG TROUBLE IN LITTLE STRING:', line
+                raise e
+        return objs
+
+def tidOfLine(line):
+    '''
+    Pull the tid out of a record line without decoding the whole thing; the
+    probes always print it first.
+    '''
+    if line.startswith('{"tid":'):
+        idx_comma = line.find(',', 7)
+        if idx_comma != -1:
+            return line[7:idx_comma]
+    return str(json.loads(line)['tid'])
+
+#: the keys of a record's data whose values symbolize_records translates
+SYMBOLIZED_KEYS = ('scriptName', 'callerScriptName', 'stack')
+
+def symbolized_values(objs):
+    '''
+    @returns [(index of the record, key, value)...] for the values of the
+        SYMBOLIZED_KEYS in the data of a chunk of records.
+    '''
+    values = []
+    for i, obj in enumerate(objs):
+        data = obj.get('data')
+        if not data:
+            continue
+        for key in SYMBOLIZED_KEYS:
+            if key in data:
+                values.append((i, key, data[key]))
+    return values
+
+def symbolize_records(procinfo, objs):
+    '''
+    Symbolize the addresses in a chunk of a thread's decoded records in
+    place: the ':!' script names get translated and the stacks become lists
+    of symbol names (innermost first), all of the chunk's stacks in one
+    batch.
+    '''
+    stack_datas = []
+    time = None
+    for obj in objs:
+        if 'time' in obj:
+            time = obj['time']
+        data = obj.get('data')
+        if not data:
+            continue
+        if 'scriptName' in data and data['scriptName'].startswith(':!'):
+            data['scriptName'] = procinfo.transformString(data['scriptName'])
+        if ('callerScriptName' in data and
+                data['callerScriptName'].startswith(':!')):
+            data['callerScriptName'] = \
+                procinfo.transformString(data['callerScriptName'])
+        if 'stack' in data:
+            stack_datas.append(data)
+    # pick up anything that got mapped in by now before doing the stacks
+    if time is not None:
+        # (integer nS => float mS, like ThreadProc.chew)
+        procinfo.advance_maps_to(time * 0.000001)
+    if stack_datas:
+        stacks = procinfo.transformStackStrings([data['stack']
+                                                 for data in stack_datas])
+        for data, names in zip(stack_datas, stacks):
+            data['stack'] = names
+
+def _iter_spooled_records(procinfo, spool_path, cache_path, profiler):
+    '''
+    Decode and symbolize the records in a thread's spool file a chunk at a
+    time, saving each chunk and its symbolized_values to the record cache at
+    cache_path (if not None) too.
+    '''
+    decoder = RecordDecoder()
+    f = open(spool_path, 'r')
+    cache_file = None
+    try:
+        if cache_path is not None:
+            cache_file = open(cache_path, 'wb', 1024 * 1024)
+        while True:
+            chunk = f.read(DECODE_CHUNK_SIZE)
+            if not chunk:
+                break
+            if not chunk.endswith('\n'):
+                chunk += f.readline()
+            t = profiler.clock()
+            objs = decoder.decode(chunk)
+            t = profiler.lap('decode', t, len(objs), len(chunk))
+            symbolize_records(procinfo, objs)
+            t = profiler.lap('symbolize', t, len(objs))
+            if cache_file is not None:
+                perfishcache.write_records(cache_file, chunk,
+                                           symbolized_values(objs))
+                profiler.lap('cache-write', t, len(objs))
+            yield objs
+    finally:
+        f.close()
+        if cache_file is not None:
+            cache_file.close()
+
+def _iter_cached_records(cache_path, profiler):
+    '''
+    Load the (already demuxed and symbolized) records of a thread from the
+    record cache a chunk at a time.  We decode each chunk again rather than
+    caching the decoded dicts so that their keys come out in the same order
+    as a fresh decode gives them (and so the same perfdata.json).
+    '''
+    decoder = RecordDecoder()
+    f = open(cache_path, 'rb', 1024 * 1024)
+    try:
+        while True:
+            # (like RecordDecoder._loadArray, the cycle collector only slows
+            #  us down here)
+            gc_was_enabled = gc.isenabled()
+            gc.disable()
+            t = profiler.clock()
+            try:
+                cached = perfishcache.read_records(f)
+            finally:
+                if gc_was_enabled:
+                    gc.enable()
+            if cached is None:
+                break
+            chunk, values = cached
+            t = profiler.lap('cache-load', t, 0, len(chunk))
+            objs = decoder.decode(chunk)
+            for i, key, value in values:
+                objs[i]['data'][key] = value
+            profiler.lap('decode', t, len(objs), len(chunk))
+            yield objs
+    finally:
+        f.close()
+
+#: the ProcContext that rebuildThread uses; set before forking the pool.
+_worker_context = None
+
+def rebuildThread(work):
+    '''
+    Decode, symbolize, and chew all the records of a thread from its spool
+    file (or load them from the record cache and just chew them) and write
+    the thread's JSON and columns out next to the spool file, returning
+    (tid, JSON file path, end time of its last record, (cache hits, misses,
+    evictions) racked up along the way, (columns file path, columns manifest
+    entry), the StageProfiler stages).  This runs in a pool process (or
+    in-process when we only have one job).
+
+    work is (tid, spool file path, record cache file path or None, whether
+    to read from the record cache rather than write to it).
+    '''
+    tid, spool_path, cache_path, from_cache = work
+    context = _worker_context
+    profiler = context.profiler.child()
+    prof = profiler.start_python_profile()
+    try:
+        result = _rebuild_thread(context, profiler, tid, spool_path,
+                                 cache_path, from_cache)
+    finally:
+        profiler.stop_python_profile(prof, 'thread-%d' % (tid,))
+    return result + (profiler.stages,)
+
+def _rebuild_thread(context, profiler, tid, spool_path, cache_path,
+                    from_cache):
+    procinfo = context.procinfo
+    cache = procinfo.translation_cache
+    cache_stats = (cache.hits, cache.misses, cache.evictions)
+    # (later threads get the address space from the start of the trace too)
+    saved_maps = procinfo.save_maps()
+
+    tproc = ThreadProc(context, tid)
+    if from_cache:
+        chunks = _iter_cached_records(cache_path, profiler)
+    else:
+        chunks = _iter_spooled_records(procinfo, spool_path, cache_path,
+                                       profiler)
+    obj = None
+    for objs in chunks:
+        t = profiler.clock()
+        for obj in objs:
+            tproc.chew(obj)
+        profiler.lap('chew', t, len(objs))
+    t = profiler.clock()
+    tproc.finalizeThread()
+    t = profiler.lap('chew', t)
+    tproc._derive_event_loop_events()
+    t = profiler.lap('derive', t, len(tproc.levents))
+
+    end_time = obj['time']
+    if 'duration' in obj:
+        end_time += obj['duration']
+    columns_path = spool_path + '.cols'
+    f = open(columns_path, 'wb', 1024 * 1024)
+    try:
+        columns = tproc.write_columns(f)
+    finally:
+        f.close()
+    json_path = spool_path + '.json'
+    f = open(json_path, 'w', 1024 * 1024)
+    try:
+        tproc.write_json(f)
+    finally:
+        f.close()
+    profiler.lap('write-thread', t, columns['events']['count'],
+                 os.path.getsize(columns_path) + os.path.getsize(json_path))
+
+    procinfo.restore_maps(saved_maps)
+    return (tid, json_path, end_time,
+            (cache.hits - cache_stats[0], cache.misses - cache_stats[1],
+             cache.evictions - cache_stats[2]),
+            (columns_path, columns))
+
+#: how many rows of each summary table Processor prints
+SUMMARY_PRINT_LIMIT = 20
 
 class Processor(object):
+    def __init__(self, jobs=None, cache_records=True,
+                 jank_threshold=perfishsummary.DEFAULT_JANK_THRESHOLD,
+                 profile_stages=False, profile_python=False):
+        #: how many processes to rebuild threads in; None for one per CPU
+        self.jobs = jobs
+        #: whether to keep the demuxed and symbolized records in the trace
+        #:  directory (see perfishcache.py) and use them if they are there
+        self.cache_records = cache_records
+        #: event-loop events longer than this many mS count as jank
+        self.jank_threshold = jank_threshold
+        #: whether to time the stages of processing; see perfishprofile.py
+        self.profile_stages = profile_stages
+        #: whether to run cProfile too (which implies profile_stages)
+        self.profile_python = profile_python
+        #: the streamer can hand us memoryviews instead of strings
+        self.accepts_memoryviews = True
+
     def process(self, srcdir, streamer, procinfo):
         '''
-        Each thread handles its own processing; we just need to create them
-        as needed and close them out when we run out of events.
+        Process the trace in srcdir, timing the stages if asked.
+        '''
+        profile_dir = None
+        if self.profile_python:
+            profile_dir = os.path.join(srcdir,
+                                       perfishprofile.PYTHON_PROFILE_DIR_NAME)
+        profiler = perfishprofile.StageProfiler(
+            self.profile_stages or self.profile_python, profile_dir)
+        start = profiler.clock()
+        prof = profiler.start_python_profile()
+        try:
+            cached = self._process(srcdir, streamer, procinfo, profiler)
+        finally:
+            profiler.stop_python_profile(prof, 'main')
+        if profiler.enabled:
+            obj = profiler.json_obj(
+                profiler.clock() - start, jobs=self.jobs or
+                multiprocessing.cpu_count(), cached=bool(cached),
+                inputBytes=sum([size for size, mtime in
+                                perfishcache.input_stamps(srcdir).values()]))
+            profiler.write(srcdir, obj)
+            print perfishprofile.format_profile(obj)
+
+    def _process(self, srcdir, streamer, procinfo, profiler):
+        '''
+        Each thread handles its own processing, so we do this in two passes.
+        First we split the records up into a spool file per thread, then we
+        have a pool of processes rebuild each thread from its spool file, and
+        then we stitch the results together.
+
+        If the record cache is up to date, we skip the first pass (and the
+        decoding and symbolizing) and the pool rebuilds each thread from the
+        cache instead.
+
+        @returns whether we used the record cache
         '''
+        global _worker_context
         context = ProcContext(srcdir, procinfo)
+        context.profiler = profiler
+        record_cache = None
+        cached = None
+        if self.cache_records:
+            record_cache = perfishcache.RecordCache.for_trace(srcdir)
+        if record_cache:
+            cached = record_cache.load()
+
+        spool_dir = tempfile.mkdtemp(prefix='spool-', dir=srcdir)
+        try:
+            if cached:
+                print 'Using the cached records in', record_cache.path
+                tids, last_tid = cached
+                work = [(tid, os.path.join(spool_dir, 'thread-%d' % (tid,)),
+                         record_cache.thread_path(tid), True)
+                        for tid in tids]
+                work_size = lambda x: os.path.getsize(x[2])
+            else:
+                t = profiler.clock()
+                tids, last_tid, spool_paths = self._demux(
+                    profiler.timed_blobs('bulk', streamer), spool_dir)
+                # (the time the BulkProcessor took is its own stage)
+                profiler.add('demux', profiler.clock() - t -
+                             profiler.seconds('bulk'),
+                             0, profiler.stages.get('bulk', (0, 0, 0))[2])
+                if record_cache:
+                    record_cache.start()
+                work = [(tid, spool_paths[tid],
+                         record_cache and record_cache.thread_path(tid),
+                         False)
+                        for tid in tids]
+                work_size = lambda x: os.path.getsize(x[1])
+            # (biggest first, so that the stragglers are the quick ones)
+            work.sort(key=work_size, reverse=True)
 
-        thread_procs = {}
-
-        obj = None
-
-        # eat the lines
-        accum_line = None
-        for blob in streamer:
-            for line in blob.splitlines():
-                if line[0] == ',' and accum_line:
-                    line = accum_line + line
-                    accum_line = None
-                elif line[0] != '{':
-                    print 'Ignoring line:', line.rstrip()
-                    continue
-                # transform trailing stuff... (json does not like!)
-                line = line.replace(',}', '}')
-                if line[-1] != '}':
-                    accum_line = line
-                    continue
+            jobs = self.jobs or multiprocessing.cpu_count()
+            _worker_context = context
+            results = {}
+            if jobs > 1 and len(work) > 1:
+                # the pool processes get the symbols we have loaded so far
+                #  (which they do not need if everything is symbolized)
+                if not cached:
+                    procinfo.finish_preload()
+                pool = multiprocessing.Pool(min(jobs, len(work)))
                 try:
-                    obj = json.loads(line)
-                except Exception, e:
-                    print 'BIG TROUBLE IN LITTLE STRING:', line
-                    raise e
-
-                tid = obj['tid']
-                if tid in thread_procs:
-                    tproc = thread_procs[tid]
-                else:
-                    tproc = thread_procs[tid] = ThreadProc(context, tid)
+                    for result in pool.imap_unordered(rebuildThread, work):
+                        results[result[0]] = result
+                        profiler.merge(result[5])
+                finally:
+                    pool.terminate()
+                cache = procinfo.translation_cache
+                for result in results.values():
+                    cache.hits += result[3][0]
+                    cache.misses += result[3][1]
+                    cache.evictions += result[3][2]
+            else:
+                for item in work:
+                    result = rebuildThread(item)
+                    results[result[0]] = result
+                    profiler.merge(result[5])
+            _worker_context = None
 
-                tproc.chew(obj)
-        for thread in thread_procs.values():
-            thread.finalizeThread()
+            # (same order we always used: a dict populated as the tids showed
+            #  up)
+            thread_paths = {}
+            for tid in tids:
+                thread_paths[tid] = results[tid][1]
+            lastEventEndsAtTime = results[last_tid][2]
 
-        lastEventEndsAtTime = obj['time']
-        if 'duration' in obj:
-            lastEventEndsAtTime += obj['duration']
+            t = profiler.clock()
+            context.write_results_file(thread_paths.values(),
+                                       lastEventEndsAtTime)
+            context.write_columns_file(
+                [results[tid][4] for tid in thread_paths.keys()],
+                lastEventEndsAtTime)
+            profiler.lap('write-output', t, 0,
+                         os.path.getsize(os.path.join(context.outdir,
+                                                      'perfdata.json')) +
+                         os.path.getsize(os.path.join(
+                             context.outdir, perfishcolumns.BIN_NAME)))
+            if record_cache and not cached:
+                record_cache.finish(tids, last_tid)
+        finally:
+            shutil.rmtree(spool_dir, True)
+        context.symlink_web_files_to_output_dir()
 
-        # tell the thread procs we have no more lines
-        thread_objs = [tp.build_json_obj() for tp in thread_procs.values()]
-        json_obj = {
-            'threads': thread_objs,
-            'lastEventEndsAtTime': lastEventEndsAtTime
-            }
+        t = profiler.clock()
+        summary = perfishsummary.write_summary(context.outdir,
+                                               self.jank_threshold)
+        profiler.lap('summary', t)
+        print perfishsummary.format_summary(summary, SUMMARY_PRINT_LIMIT)
 
-        context.write_results_file(json_obj)
-        context.symlink_web_files_to_output_dir()
-            
-            
+        print 'Address translation cache:', \
+            procinfo.translation_cache.describe()
+        return cached
+
+    def _demux(self, streamer, spool_dir):
+        '''
+        Split the records out into a spool file per thread.
+
+        @returns (tids in the order they showed up, the tid of the last
+            record, dict of tid => spool file path)
+        '''
+        tids = []
+        last_tid = None
+        spool_files = {}
+        spool_paths = {}
+        tids_by_str = {}
+        decoder = RecordDecoder()
+        for lines in decoder.iterLineChunks(streamer):
+            if not lines:
+                continue
+            lines_by_tid = {}
+            for line in lines:
+                tid_str = tidOfLine(line)
+                tid_lines = lines_by_tid.get(tid_str)
+                if tid_lines is None:
+                    tid_lines = lines_by_tid[tid_str] = []
+                    if tid_str not in spool_files:
+                        tids_by_str[tid_str] = tid = int(tid_str)
+                        tids.append(tid)
+                        spool_paths[tid] = path = os.path.join(
+                            spool_dir, 'thread-%d' % (tid,))
+                        spool_files[tid_str] = open(path, 'w', 1024 * 1024)
+                tid_lines.append(line)
+            last_tid = tid_str
+            for tid_str, tid_lines in lines_by_tid.iteritems():
+                tid_lines.append('')
+                spool_files[tid_str].write('\n'.join(tid_lines))
+        for f in spool_files.values():
+            f.close()
+        return tids, tids_by_str[last_tid], spool_paths
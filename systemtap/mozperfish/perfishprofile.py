@@ -0,0 +1,251 @@
+# MPL/GPL/LGPL licensed
+#
+# Where the time goes when we post-process a trace.
+#
+# With 'chewchewwoowoo.py --profile-stages', Processor times each stage of
+#  the pipeline:
+#
+# - bulk: the BulkProcessor merging the per-CPU bulk files into blobs.
+# - demux: splitting the blobs into lines and spooling them per thread.
+# - cache-load: loading a thread's records from the record cache (instead of
+#   symbolize and cache-write; they still get decoded); see perfishcache.py.
+# - decode: RecordDecoder turning a thread's lines into record dicts.
+# - symbolize: ProcInfo translating the addresses in them.
+# - cache-write: saving the symbolized records to the record cache.
+# - chew: ThreadProc.chew rebuilding the thread's events.
+# - derive: ThreadProc._derive_event_loop_events.
+# - write-thread: writing each thread's columns and JSON.
+# - write-output: stitching those together into perfdata.json and
+#   perfdata.bin.
+# - summary: perfishsummary.py.
+#
+# For each we report the seconds it took, how many records (or blobs, for
+#  bulk) and bytes it got through and how fast, and the peak RSS: the largest
+#  high-water mark (ru_maxrss) of the processes running it, as of the end of
+#  the stage.  The threads get rebuilt in a pool of processes, so with more
+#  than one job the seconds of those stages are summed across processes and
+#  can add up to more than the wall-clock time.
+#
+# The results go in stage-profile.json in the trace directory, and get
+#  appended as a line to stage-profile-history.json there so that we can
+#  see how things trend from one run to the next.  With --profile-python we
+#  also run cProfile over the main process and each thread rebuild and dump
+#  the stats in the stage-profile directory (main.prof, thread-TID.prof) for
+#  pstats or your favorite viewer.
+
+import cProfile, errno, json, os, os.path, resource, time
+
+import perfishsummary
+
+PROFILE_NAME = 'stage-profile.json'
+HISTORY_NAME = 'stage-profile-history.json'
+PYTHON_PROFILE_DIR_NAME = 'stage-profile'
+
+#: the stages in the order they (first) happen
+STAGES = ('bulk', 'demux', 'cache-load', 'decode', 'symbolize', 'cache-write',
+          'chew', 'derive', 'write-thread', 'write-output', 'summary')
+
+def peak_rss():
+    '''
+    @returns the high-water mark of our RSS so far in KiB.
+    '''
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+class StageProfiler(object):
+    '''
+    Accumulates the time, records, bytes and peak RSS of each stage.  When
+    not enabled, everything is a no-op so that callers need not check.
+    '''
+    def __init__(self, enabled=False, python_profile_dir=None):
+        self.enabled = enabled
+        #: where to dump cProfile stats, or None to not run cProfile
+        self.python_profile_dir = python_profile_dir
+        #: stage => [seconds, records, bytes, peak RSS]
+        self.stages = {}
+        #: the process whose cProfile is running, if any
+        self._python_profile_pid = None
+
+    def child(self):
+        '''
+        @returns a fresh StageProfiler for a thread rebuild, whose stages
+            get merged back into ours.
+        '''
+        profiler = StageProfiler(self.enabled, self.python_profile_dir)
+        profiler._python_profile_pid = self._python_profile_pid
+        return profiler
+
+    def clock(self):
+        if not self.enabled:
+            return 0
+        return time.time()
+
+    def add(self, name, seconds, records=0, nbytes=0):
+        if not self.enabled:
+            return
+        stats = self.stages.get(name)
+        if stats is None:
+            stats = self.stages[name] = [0.0, 0, 0, 0]
+        stats[0] += seconds
+        stats[1] += records
+        stats[2] += nbytes
+        stats[3] = max(stats[3], peak_rss())
+
+    def lap(self, name, start, records=0, nbytes=0):
+        '''
+        Charge the time since start (from clock or an earlier lap) to the
+        stage.
+
+        @returns the clock now, for the next lap
+        '''
+        if not self.enabled:
+            return 0
+        now = time.time()
+        self.add(name, now - start, records, nbytes)
+        return now
+
+    def seconds(self, name):
+        stats = self.stages.get(name)
+        return stats and stats[0] or 0.0
+
+    def merge(self, stages):
+        '''
+        Fold in the stages of a child().
+        '''
+        for name, (seconds, records, nbytes, rss) in stages.iteritems():
+            stats = self.stages.get(name)
+            if stats is None:
+                stats = self.stages[name] = [0.0, 0, 0, 0]
+            stats[0] += seconds
+            stats[1] += records
+            stats[2] += nbytes
+            stats[3] = max(stats[3], rss)
+
+    def timed_blobs(self, name, blobs):
+        '''
+        @returns an iterator over blobs that charges the time spent getting
+            each one to the stage.
+        '''
+        if not self.enabled:
+            return blobs
+        return self._timed_blobs(name, blobs)
+
+    def _timed_blobs(self, name, blobs):
+        blobs = iter(blobs)
+        clock = time.time
+        seconds = 0.0
+        count = 0
+        nbytes = 0
+        try:
+            while True:
+                start = clock()
+                try:
+                    blob = blobs.next()
+                except StopIteration:
+                    break
+                seconds += clock() - start
+                count += 1
+                nbytes += len(blob)
+                yield blob
+        finally:
+            self.add(name, seconds, count, nbytes)
+
+    def start_python_profile(self):
+        '''
+        Start cProfile if we were asked to and it is not already running in
+        this process.
+
+        @returns the cProfile.Profile to hand to stop_python_profile
+        '''
+        if (self.python_profile_dir is None or
+                self._python_profile_pid == os.getpid()):
+            return None
+        self._python_profile_pid = os.getpid()
+        prof = cProfile.Profile()
+        prof.enable()
+        return prof
+
+    def stop_python_profile(self, prof, name):
+        '''
+        Stop the cProfile start_python_profile started (if it did) and dump
+        its stats as name.prof.
+        '''
+        if prof is None:
+            return
+        prof.disable()
+        self._python_profile_pid = None
+        try:
+            os.makedirs(self.python_profile_dir)
+        except OSError, e:
+            # (the pool processes race to make it)
+            if e.errno != errno.EEXIST:
+                raise
+        prof.dump_stats(os.path.join(self.python_profile_dir, name + '.prof'))
+
+    def json_obj(self, wall_seconds, **extra):
+        '''
+        @returns the stage-profile.json object: {time, wallSeconds,
+            peakRss, stages: [{name, seconds, records, bytes, recordsPerSec,
+            bytesPerSec, peakRss}...]} plus whatever extra says.
+        '''
+        names = [name for name in STAGES if name in self.stages]
+        names.extend(sorted([name for name in self.stages
+                             if name not in STAGES]))
+        stages = []
+        for name in names:
+            seconds, records, nbytes, rss = self.stages[name]
+            stages.append({
+                'name': name,
+                'seconds': seconds,
+                'records': records,
+                'bytes': nbytes,
+                'recordsPerSec': seconds and records / seconds or None,
+                'bytesPerSec': seconds and nbytes / seconds or None,
+                'peakRss': rss,
+                })
+        obj = {
+            'time': time.time(),
+            'wallSeconds': wall_seconds,
+            'peakRss': max([peak_rss()] +
+                           [stats[3] for stats in self.stages.values()]),
+            'stages': stages,
+            }
+        obj.update(extra)
+        return obj
+
+    def write(self, trace_dir, obj):
+        '''
+        Write the json_obj to stage-profile.json and append it to the history.
+        '''
+        f = open(os.path.join(trace_dir, PROFILE_NAME), 'w')
+        json.dump(obj, f, sort_keys=True)
+        f.close()
+        f = open(os.path.join(trace_dir, HISTORY_NAME), 'a')
+        f.write(json.dumps(obj, sort_keys=True) + '\n')
+        f.close()
+
+def _rate(value):
+    if not value:
+        return '-'
+    return '%.1f' % (value,)
+
+def format_profile(obj):
+    '''
+    @returns the json_obj as a text table.
+    '''
+    rows = []
+    for stage in obj['stages']:
+        rows.append([
+            stage['name'],
+            '%.3f' % (stage['seconds'],),
+            '%d' % (stage['records'],),
+            _rate(stage['recordsPerSec']),
+            '%.1f' % (stage['bytes'] / 1048576.0,),
+            _rate(stage['bytesPerSec'] and stage['bytesPerSec'] / 1048576.0),
+            '%.1f' % (stage['peakRss'] / 1024.0,),
+            ])
+    lines = ['Stages (%.3fs wall-clock, peak RSS %.1f MiB):' % (
+                 obj['wallSeconds'], obj['peakRss'] / 1024.0)]
+    lines.extend(perfishsummary.format_table(
+        ['stage', 'seconds', 'records', 'records/s', 'MiB', 'MiB/s',
+         'peak RSS MiB'], rows))
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,264 @@
+# MPL/GPL/LGPL licensed
+#
+# Latency statistics and a jank report for a processed trace.
+#
+# Finding the slow runnables, timers and input events in the raw event tree
+#  means clicking around the UI, so once perfdata.bin is written we boil it
+#  down to:
+#
+# - types: for each event type, how many events there were, how long they
+#   took (nearest-rank p50/p90/p99 and the max, in mS) and the total time
+#   spent in them.  Events without a duration (ex: scheduling a runnable)
+#   count as taking no time.  Times are inclusive of nested events, so the
+#   totals of different types can overlap.
+# - scripts: the same for each (symbolized) scriptName, which is the vtable
+#   of the native runnables and timers and the script of the JS ones.
+# - jank: the top-level event-loop events (see ThreadProc.levents) that took
+#   longer than the jank threshold, longest first.
+#
+# These go in summary.json in the output directory, and as text tables in
+# summary.txt.  We use NumPy if it is installed and plain python if not; the
+# results are the same either way (give or take the floating point rounding
+# of the totals).
+
+import json, os.path
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+import perfishcolumns
+
+SUMMARY_NAME = 'summary.json'
+SUMMARY_TEXT_NAME = 'summary.txt'
+
+#: event-loop events longer than this (in mS) are jank
+DEFAULT_JANK_THRESHOLD = 50.0
+
+PERCENTILES = (50, 90, 99)
+
+#: (the same as eventNameMap in lib/mozperfish/ui-repr.js)
+EVENT_NAMES = {
+    5: 'Timer Installed',
+    6: 'Timer Cleared',
+    7: 'Timer Fired',
+    11: 'Log Message',
+    17: 'Garbage Collection',
+    4096: 'Runnable Executed',
+    4097: 'Runnable Scheduled',
+    4128: 'Input Ready',
+    4129: 'Input Pump',
+    4144: 'Socket Transport Ready',
+    4145: 'Socket Transport Attached',
+    4146: 'Socket Transport Detached',
+    4160: 'XPConnect calling JS',
+    4161: 'Native calling JS',
+    4192: 'Proxied Call',
+    8192: 'Latency Notification',
+    }
+
+def event_name(event_type):
+    return EVENT_NAMES.get(event_type, 'Unknown Event: #%d' % (event_type,))
+
+def _rank(p, count):
+    '''
+    @returns the index of the nearest-rank p-th percentile of count sorted
+        values.
+    '''
+    return (p * count + 99) // 100 - 1
+
+def _group_stats_python(keys, durations):
+    '''
+    @returns {key: (count, total, p50, p90, p99, max)} over the durations of
+        each key.
+    '''
+    by_key = {}
+    for key, duration in zip(keys, durations):
+        values = by_key.get(key)
+        if values is None:
+            values = by_key[key] = []
+        values.append(duration)
+    stats = {}
+    for key, values in by_key.iteritems():
+        values.sort()
+        count = len(values)
+        total = 0.0
+        for value in values:
+            total += value
+        stats[key] = ((count, total) +
+                      tuple([values[_rank(p, count)] for p in PERCENTILES]) +
+                      (values[-1],))
+    return stats
+
+def _group_stats_numpy(keys, durations):
+    keys = numpy.array(keys, dtype=numpy.int64)
+    durations = numpy.array(durations, dtype=numpy.float64)
+    if not len(keys):
+        return {}
+    order = numpy.lexsort((durations, keys))
+    keys = keys[order]
+    durations = durations[order]
+    new_group = numpy.ones(len(keys), dtype=bool)
+    new_group[1:] = keys[1:] != keys[:-1]
+    firsts = numpy.flatnonzero(new_group)
+    counts = numpy.diff(numpy.append(firsts, len(keys)))
+    columns = [counts, numpy.add.reduceat(durations, firsts)]
+    for p in PERCENTILES:
+        columns.append(durations[firsts + _rank(p, counts)])
+    columns.append(durations[firsts + counts - 1])
+    return dict(zip(keys[firsts].tolist(),
+                    zip(*[column.tolist() for column in columns])))
+
+def group_stats(keys, durations):
+    '''
+    @returns {key: (count, total, p50, p90, p99, max)} given parallel lists
+        of integer keys and durations.
+    '''
+    if numpy is not None:
+        return _group_stats_numpy(keys, durations)
+    return _group_stats_python(keys, durations)
+
+def _stat_dict(stats):
+    count, total, p50, p90, p99, max_duration = stats
+    return {'count': count, 'busy': total, 'p50': p50, 'p90': p90,
+            'p99': p99, 'max': max_duration}
+
+def summarize(columns, jank_threshold=DEFAULT_JANK_THRESHOLD):
+    '''
+    Summarize the events of a PerfDataColumns.
+
+    @returns the summary.json object described above.
+    '''
+    type_keys = []
+    type_durations = []
+    script_ids = {}
+    script_names = []
+    script_keys = []
+    script_durations = []
+    jank = []
+    for tid in columns.tids:
+        thread = columns.thread(tid)
+        types = thread.column('events', ('type',))
+        durations = [duration or 0.0
+                     for duration in thread.column('events', ('duration',))]
+        names = thread.column('events', ('data', 'scriptName'))
+        for row in xrange(len(types)):
+            event_type = types[row]
+            # (skip the synthetic events between the top-level ones)
+            if event_type is None:
+                continue
+            type_keys.append(event_type)
+            type_durations.append(durations[row])
+            name = names[row]
+            if name is not None:
+                script = script_ids.get(name)
+                if script is None:
+                    script = script_ids[name] = len(script_names)
+                    script_names.append(name)
+                script_keys.append(script)
+                script_durations.append(durations[row])
+
+        times = None
+        for row in thread.array(thread.thread['levents']):
+            if durations[row] > jank_threshold:
+                if times is None:
+                    times = thread.column('events', ('time',))
+                jank.append({
+                    'tid': tid,
+                    'time': times[row],
+                    'duration': durations[row],
+                    'type': types[row],
+                    'name': event_name(types[row]),
+                    'scriptName': names[row],
+                    })
+
+    type_stats = []
+    for event_type, stats in group_stats(type_keys,
+                                         type_durations).iteritems():
+        entry = _stat_dict(stats)
+        entry['type'] = event_type
+        entry['name'] = event_name(event_type)
+        type_stats.append(entry)
+    type_stats.sort(key=lambda entry: (-entry['busy'], entry['type']))
+    script_stats = []
+    for script, stats in group_stats(script_keys,
+                                     script_durations).iteritems():
+        entry = _stat_dict(stats)
+        entry['scriptName'] = script_names[script]
+        script_stats.append(entry)
+    script_stats.sort(key=lambda entry: (-entry['busy'], entry['scriptName']))
+    jank.sort(key=lambda entry: (-entry['duration'], entry['tid'],
+                                 entry['time']))
+    return {
+        'jankThreshold': jank_threshold,
+        'types': type_stats,
+        'scripts': script_stats,
+        'jank': jank,
+        }
+
+def format_table(headings, rows):
+    '''
+    @returns the lines of a text table, the first column left-aligned and
+        the rest right-aligned.
+    '''
+    rows = [headings] + rows
+    widths = [max([len(row[i]) for row in rows])
+              for i in xrange(len(headings))]
+    lines = []
+    for row in rows:
+        cells = [row[0].ljust(widths[0])]
+        cells.extend([cell.rjust(width)
+                      for cell, width in zip(row[1:], widths[1:])])
+        lines.append('  '.join(cells).rstrip())
+    return lines
+
+def _stat_cells(entry):
+    return ['%d' % (entry['count'],), '%.3f' % (entry['busy'],)] + \
+           ['%.3f' % (entry[key],) for key in ('p50', 'p90', 'p99', 'max')]
+
+def format_summary(summary, limit=None):
+    '''
+    @returns the summary as text tables, with at most limit rows per table
+        if limit is not None.
+    '''
+    stat_headings = ['count', 'busy mS', 'p50', 'p90', 'p99', 'max']
+    lines = ['Event types:']
+    lines.extend(format_table(['type'] + stat_headings,
+                        [['%s (%d)' % (entry['name'], entry['type'])] +
+                         _stat_cells(entry)
+                         for entry in summary['types'][:limit]]))
+    lines.extend(['', 'Scripts:'])
+    lines.extend(format_table(['scriptName'] + stat_headings,
+                        [[entry['scriptName']] + _stat_cells(entry)
+                         for entry in summary['scripts'][:limit]]))
+    lines.extend(['', 'Event-loop events over %g mS: %d' % (
+                      summary['jankThreshold'], len(summary['jank']))])
+    if summary['jank']:
+        lines.extend(format_table(['type', 'tid', 'time mS', 'duration mS',
+                             'scriptName'],
+                            [[entry['name'], '%d' % (entry['tid'],),
+                              '%.3f' % (entry['time'],),
+                              '%.3f' % (entry['duration'],),
+                              entry['scriptName'] or '']
+                             for entry in summary['jank'][:limit]]))
+    return '\n'.join(lines) + '\n'
+
+def write_summary(outdir, jank_threshold=DEFAULT_JANK_THRESHOLD):
+    '''
+    Write summary.json and summary.txt for the perfdata.bin in outdir.
+
+    @returns the summary
+    '''
+    columns = perfishcolumns.PerfDataColumns(outdir)
+    try:
+        summary = summarize(columns, jank_threshold)
+    finally:
+        columns.close()
+    f = open(os.path.join(outdir, SUMMARY_NAME), 'w')
+    json.dump(summary, f, sort_keys=True)
+    f.close()
+    f = open(os.path.join(outdir, SUMMARY_TEXT_NAME), 'w')
+    f.write(format_summary(summary).encode('utf-8'))
+    f.close()
+    return summary
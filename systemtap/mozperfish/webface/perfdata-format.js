@@ -0,0 +1 @@
+../lib/mozperfish/perfdata-format.js
\ No newline at end of file
@@ -0,0 +1,189 @@
+#!/usr/bin/python
+# MPL/GPL/LGPL licensed
+#
+# Usage: symbench.py [--runs N] [--symbols N] [--frames N] BINARY
+#
+# Micro-benchmarks for addrsymfilt.  We compare the cold symbol-load time of
+#  BinaryInfo using our in-process ELF reader against the old readelf/nm
+#  subprocess path, and the warm load time out of the symcache.  Point it at
+#  something big like libxul.so.
+#
+# We also report the memory used by a synthetic table of --symbols symbols
+#  as the old list of (addr, symname, rawname) tuples versus a SymbolTable.
+#
+# Finally, we symbolize a synthetic workload of --frames stack frames against
+#  a made-up address space one address at a time and in one batch.
+#
+
+import optparse, random, shutil, sys, tempfile, time
+
+import addrsymfilt, elfsyms, symcache
+
+class SubprocessBinaryInfo(addrsymfilt.BinaryInfo):
+    '''
+    BinaryInfo that pretends it cannot read ELF files so that we always take
+    the readelf/nm fallback path.
+    '''
+    def _readElfSymbols(self):
+        raise elfsyms.ElfError('forcing the subprocess path')
+
+def time_cold_load(cls, path, runs, symbolCache=None):
+    '''
+    Load the symbols of a fresh BinaryInfo of the given class `runs` times,
+    returning (best time, symbol count).
+    '''
+    best = None
+    count = 0
+    for i in range(runs):
+        binary = cls(path, symbolCache)
+        start = time.time()
+        binary._loadSymbols()
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+        count = len(binary.symbols)
+    return best, count
+
+def bench_load(path, runs):
+    print 'Cold symbol load of', path, '(best of %d)' % (runs,)
+    for label, cls in (('readelf/nm', SubprocessBinaryInfo),
+                       ('elfsyms', addrsymfilt.BinaryInfo)):
+        elapsed, count = time_cold_load(cls, path, runs)
+        print '  %-12s %8.3fs %8d symbols' % (label, elapsed, count)
+
+    cachedir = tempfile.mkdtemp(prefix='symbench-')
+    try:
+        cache = symcache.SymbolCache(cachedir)
+        # populate...
+        time_cold_load(addrsymfilt.BinaryInfo, path, 1, cache)
+        elapsed, count = time_cold_load(addrsymfilt.BinaryInfo, path, runs,
+                                        cache)
+        print '  %-12s %8.3fs %8d symbols' % ('symcache', elapsed, count)
+    finally:
+        shutil.rmtree(cachedir, True)
+
+def synthesize_symbols(count):
+    '''
+    Make up a sorted list of (addr, demangled name) that looks vaguely like
+    what a big C++ binary gives us.
+    '''
+    rng = random.Random(0)
+    classes = ['ns%sImpl%d' % (word, i)
+               for i in range(count // 20 + 1)
+               for word in ('Msg', 'Folder', 'Runnable')]
+    methods = ['Init', 'Run', 'GetFolder', 'OnStopRequest', 'QueryInterface',
+               'AddRef', 'Release', 'Notify']
+    args = ['()', '(nsISupports*, unsigned int)',
+            '(nsIRequest*, nsISupports*, unsigned int)',
+            '(nsACString_internal const&, bool*)']
+    rawsyms = []
+    addr = 0x10000
+    for i in range(count):
+        addr += rng.randint(8, 400)
+        name = '%s::%s%s' % (rng.choice(classes), rng.choice(methods),
+                             rng.choice(args))
+        rawsyms.append((addr, name))
+    return rawsyms
+
+def deep_sizeof(obj, seen):
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, (list, tuple)):
+        for kid in obj:
+            size += deep_sizeof(kid, seen)
+    return size
+
+def bench_memory(count):
+    rawsyms = synthesize_symbols(count)
+    # what _loadSymbols used to build
+    tuples = [(addr, addrsymfilt.cleanSymbolName(name), name)
+              for addr, name in rawsyms]
+    table = addrsymfilt.SymbolTable.fromSorted(rawsyms)
+    table_size = (sys.getsizeof(table.addrs) +
+                  sys.getsizeof(table.nameOffsets) +
+                  sys.getsizeof(table.names))
+    print 'Memory for %d symbols' % (count,)
+    print '  %-12s %8.1f MiB' % ('tuples',
+                                 deep_sizeof(tuples, set()) / 1048576.0)
+    print '  %-12s %8.1f MiB' % ('SymbolTable', table_size / 1048576.0)
+
+def synthesize_procinfo(num_binaries, symbols_per_binary):
+    '''
+    Make up a ProcInfo with num_binaries mapped binaries that have synthetic
+    symbol tables, returning (procinfo, list of interesting addresses).
+    '''
+    procinfo = addrsymfilt.ProcInfo(None, symbol_cache=None)
+    rng = random.Random(1)
+    addrs = []
+    base = 0x7f0000000000
+    for i in range(num_binaries):
+        binary = addrsymfilt.BinaryInfo('/synthetic/lib%d.so' % (i,))
+        rawsyms = synthesize_symbols(symbols_per_binary)
+        binary.symbols = addrsymfilt.SymbolTable.fromSorted(rawsyms)
+        size = rawsyms[-1][0] + 0x1000
+        procinfo.ranges.append((base, base + size, 0, binary))
+        for j in range(200):
+            addrs.append(base + rng.choice(rawsyms)[0] + rng.randint(0, 7))
+        base += size + 0x100000
+    return procinfo, addrs
+
+def bench_stacks(num_frames, runs):
+    rng = random.Random(2)
+    stack_depth = 20
+    procinfo, addrs = synthesize_procinfo(50, 20000)
+    # stacks reuse return addresses heavily; skew towards the front
+    stacks = []
+    for i in range(num_frames // stack_depth):
+        stacks.append(' '.join(
+            ['%x' % (addrs[int(rng.paretovariate(1.2)) % len(addrs)],)
+             for j in range(stack_depth)]))
+
+    def one_at_a_time():
+        for s in stacks:
+            [procinfo._normalizeHexAddress(hexaddr, 'raw', None)
+             for hexaddr in s.split(' ')]
+    def memoized():
+        for s in stacks:
+            procinfo.transformStackString(s)
+    def batched():
+        procinfo.transformStackStrings(stacks)
+
+    print 'Symbolizing %d frames in %d stacks (best of %d)' % (
+        len(stacks) * stack_depth, len(stacks), runs)
+    for label, func in (('per-address', one_at_a_time),
+                        ('memoized', memoized),
+                        ('batched', batched)):
+        best = None
+        for i in range(runs):
+            procinfo.translation_cache = addrsymfilt.LRUCache(65536)
+            start = time.time()
+            func()
+            elapsed = time.time() - start
+            if best is None or elapsed < best:
+                best = elapsed
+        print '  %-12s %8.3fs' % (label, best)
+
+def main():
+    parser = optparse.OptionParser(
+        usage='usage: %prog [--runs N] [--symbols N] [--frames N] BINARY')
+    parser.add_option('--runs', type='int', dest='runs', default=3,
+                      help='Number of runs to take the best of.')
+    parser.add_option('--symbols', type='int', dest='symbols',
+                      default=200000,
+                      help='Size of the synthetic table for memory numbers.')
+    parser.add_option('--frames', type='int', dest='frames', default=1000000,
+                      help='Number of frames in the synthetic stack workload.')
+    options, args = parser.parse_args()
+    if len(args) != 1:
+        parser.print_usage()
+        return 1
+
+    bench_load(args[0], options.runs)
+    bench_memory(options.symbols)
+    bench_stacks(options.frames, options.runs)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
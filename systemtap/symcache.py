@@ -0,0 +1,227 @@
+# MPL/GPL/LGPL licensed
+#
+# Persistent on-disk cache of addrsymfilt.BinaryInfo symbol tables.
+#
+# Every addrsymfilt/chewchewwoowoo run used to rebuild the symbol table for
+#  libxul.so from scratch even though it had not changed since the last
+#  dozen runs.  Now we keep one compact pre-sorted file per binary in a cache
+#  directory, keyed on the GNU build-id (or the path/size/mtime when there is
+#  no build-id).  The file is laid out so we can mmap it and be done:
+#
+#   header: magic, offset adjustment, symbol count, name blob size
+#   addrs: count 64-bit addresses, sorted
+#   name offsets: count 32-bit offsets into the name blob
+#   name blob: nul-terminated (still mangled) names
+#
+# This is exactly the layout of addrsymfilt.SymbolTable, so loading amounts to
+#  copying the two arrays out and handing over the mapping for the names.
+#
+# Everything is little-endian.  We evict least-recently-used files (by mtime,
+#  which we bump on every hit) once the directory exceeds its size budget.
+
+import array, hashlib, mmap, os, os.path, struct, sys, tempfile
+
+import elfsyms
+
+CACHE_MAGIC = 'ASYMCAC3'
+HEADER = struct.Struct('<8sqQQ')
+ADDR_SIZE = 8
+OFFSET_SIZE = 4
+
+DEFAULT_MAX_BYTES = 1024 * 1024 * 1024
+
+def _new_array(typecodes, itemsize, values=()):
+    '''
+    Make an array holding values, picking the first of the given typecodes
+    with the right size (array has no fixed-width codes).
+    '''
+    for code in typecodes:
+        try:
+            arr = array.array(code)
+        except ValueError:
+            # (no 'Q' before python 3.3)
+            continue
+        if arr.itemsize == itemsize:
+            arr.extend(values)
+            return arr
+    raise Exception('No array typecode of size %d' % (itemsize,))
+
+def _typed_array(typecodes, itemsize, data):
+    '''
+    Make an array out of little-endian data; see _new_array.
+    '''
+    arr = _new_array(typecodes, itemsize)
+    arr.fromstring(data)
+    if sys.byteorder != 'little':
+        arr.byteswap()
+    return arr
+
+def _little_endian_bytes(typecodes, itemsize, values):
+    '''
+    The inverse of _typed_array: values packed little-endian at itemsize.
+    '''
+    arr = _new_array(typecodes, itemsize, values)
+    if sys.byteorder != 'little':
+        arr.byteswap()
+    return arr.tostring()
+
+def _read_table(path):
+    '''
+    Map a cache file, returning (offsetAdjustment, addrs, nameOffsets, mapping,
+    blob offset in mapping).  Raises ValueError if the file is busted.
+    '''
+    f = open(path, 'rb')
+    try:
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    finally:
+        f.close()
+
+    if len(mm) < HEADER.size:
+        raise ValueError('truncated cache file')
+    magic, offsetAdjustment, count, blob_size = HEADER.unpack_from(mm, 0)
+    if magic != CACHE_MAGIC:
+        raise ValueError('bad cache magic')
+    addrs_start = HEADER.size
+    offs_start = addrs_start + count * ADDR_SIZE
+    blob_start = offs_start + count * OFFSET_SIZE
+    if blob_start + blob_size != len(mm):
+        raise ValueError('cache file size mismatch')
+
+    addrs = _typed_array('LQ', ADDR_SIZE, mm[addrs_start:offs_start])
+    nameOffsets = _typed_array('IL', OFFSET_SIZE, mm[offs_start:blob_start])
+    return offsetAdjustment, addrs, nameOffsets, mm, blob_start
+
+class SymbolCache(object):
+    '''
+    A directory of cached symbol tables with LRU eviction by total size.
+    '''
+    def __init__(self, cachedir, max_bytes=DEFAULT_MAX_BYTES):
+        self.cachedir = cachedir
+        self.max_bytes = max_bytes
+
+    @classmethod
+    def default(cls):
+        '''
+        The cache everybody gets unless they ask otherwise; lives in
+        $ADDRSYMFILT_CACHE_DIR or ~/.cache/addrsymfilt.  Setting
+        ADDRSYMFILT_CACHE_DIR to the empty string disables caching, in which
+        case we return None.
+        '''
+        cachedir = os.environ.get('ADDRSYMFILT_CACHE_DIR')
+        if cachedir is None:
+            cachedir = os.path.join(
+                os.environ.get('XDG_CACHE_HOME',
+                               os.path.expanduser('~/.cache')),
+                'addrsymfilt')
+        elif not cachedir:
+            return None
+        return cls(cachedir)
+
+    def keyFor(self, path):
+        '''
+        Figure out the cache key for the binary at path, returning None if we
+        cannot even stat it.
+        '''
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        try:
+            elf = elfsyms.ElfFile(path)
+            try:
+                build_id = elf.buildId()
+            finally:
+                elf.close()
+        except (elfsyms.ElfError, IOError):
+            build_id = None
+        if build_id:
+            return 'id-' + build_id
+        stat_str = '%s\0%d\0%d' % (os.path.abspath(path), st.st_size,
+                                   int(st.st_mtime))
+        return 'st-' + hashlib.sha1(stat_str).hexdigest()
+
+    def _pathFor(self, key):
+        return os.path.join(self.cachedir, key + '.syms')
+
+    def load(self, key):
+        '''
+        @returns (offsetAdjustment, addrs, nameOffsets, names, namesBase) as
+            addrsymfilt.SymbolTable wants them for the key, or None if we do
+            not have one (or it is busted, in which case we also get rid of
+            it).
+        '''
+        if key is None:
+            return None
+        path = self._pathFor(key)
+        if not os.path.isfile(path):
+            return None
+        try:
+            table = _read_table(path)
+        except (ValueError, EnvironmentError, mmap.error):
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+            return None
+        # we are the most recently used now
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+        return table
+
+    def store(self, key, offsetAdjustment, addrs, nameOffsets, names):
+        '''
+        Write out a symbol table (sorted addresses, offsets into the names
+        string) for the given key and then evict anything that no longer fits.
+        Failures are not fatal; it is just a cache.
+        '''
+        if key is None:
+            return
+        try:
+            if not os.path.isdir(self.cachedir):
+                os.makedirs(self.cachedir)
+            fd, tmp_path = tempfile.mkstemp(dir=self.cachedir,
+                                            suffix='.tmp')
+            f = os.fdopen(fd, 'wb')
+            try:
+                f.write(HEADER.pack(CACHE_MAGIC, offsetAdjustment,
+                                    len(addrs), len(names)))
+                f.write(_little_endian_bytes('LQ', ADDR_SIZE, addrs))
+                f.write(_little_endian_bytes('IL', OFFSET_SIZE, nameOffsets))
+                f.write(names)
+            finally:
+                f.close()
+            os.rename(tmp_path, self._pathFor(key))
+        except EnvironmentError, e:
+            sys.stderr.write('Unable to write symbol cache for %s: %s\n' %
+                             (key, e))
+            return
+        self.evict()
+
+    def evict(self):
+        '''
+        Remove the least recently used cache files until we are under our
+        size budget.
+        '''
+        entries = []
+        total = 0
+        for fname in os.listdir(self.cachedir):
+            if not fname.endswith('.syms'):
+                continue
+            path = os.path.join(self.cachedir, fname)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, path))
+            total += st.st_size
+        entries.sort()
+        for mtime, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.unlink(path)
+            except OSError:
+                continue
+            total -= size
@@ -0,0 +1,457 @@
+#!/usr/bin/python
+# MPL/GPL/LGPL licensed
+#
+# Usage: symdaemon.py [--socket PATH] [--idle-timeout SECS]
+#
+# A long-lived symbolization daemon for when we are running a bunch of
+#  post-processing jobs (ex: 'chewchewwoowoo.py --re-run' over every test in a
+#  suite) at the same time.  Without it, every job loads its own copy of the
+#  symbol tables for the exact same binaries; with it, the daemon loads each
+#  binary once and the jobs send it batches of addresses over a Unix domain
+#  socket.
+#
+# DaemonProcInfo is the client side; it is a drop-in ProcInfo that hands its
+#  binaries' translation requests to the daemon.  If there is no daemon (or it
+#  goes away mid-run) we just quietly symbolize in-process like ProcInfo always
+#  did.
+#
+# The wire protocol is a 4-byte big-endian length followed by a marshal'ed
+#  tuple, in both directions.  We use marshal rather than JSON because it is
+#  fast and keeps our symbol names as plain strings; both ends are this same
+#  module, so its lack of a stable format does not matter.  marshal is not
+#  safe to use on untrusted data, though, so the default socket lives in a
+#  directory only we can get at, the socket is only accessible to its owner,
+#  and the client refuses to talk to a daemon run by anyone but us (checking
+#  the peer's credentials where we can and the socket's owner otherwise).
+#  Requests:
+#
+#   ('open', path) => handle for the binary at path, which we key on the
+#       file's identity so a rebuilt binary gets new symbols.
+#   ('translate', handle, [(addr, offset)...], raw) => the result of
+#       BinaryInfo.translateAddresses.
+#   ('preload', [handle...]) => True, and we load their symbols in the
+#       background.
+#
+# Responses are (True, result) or (False, error message).
+
+import errno, marshal, optparse, os, os.path, re, socket, stat, struct, sys
+import tempfile, threading, time
+import SocketServer
+
+import addrsymfilt, symcache
+
+LENGTH = struct.Struct('>I')
+
+#: the (pid, uid, gid) SO_PEERCRED gives us; python 2 does not know the
+#:  option's number, so we supply the Linux one ourselves
+PEERCRED = struct.Struct('3i')
+if hasattr(socket, 'SO_PEERCRED'):
+    SO_PEERCRED = socket.SO_PEERCRED
+elif sys.platform.startswith('linux'):
+    SO_PEERCRED = 17
+else:
+    SO_PEERCRED = None
+
+class DaemonError(Exception):
+    pass
+
+def _privateDir(path):
+    '''
+    Make sure path is a directory that only we can get at, creating it if
+    need be.  Someone else may have gotten there first, so we check what we
+    find rather than trusting it.
+
+    @returns path
+    '''
+    try:
+        os.mkdir(path, 0700)
+    except OSError, e:
+        if e.errno != errno.EEXIST:
+            raise DaemonError('unable to create %s: %s' % (path, e))
+    st = os.lstat(path)
+    if (not stat.S_ISDIR(st.st_mode) or st.st_uid != os.getuid() or
+            st.st_mode & 077):
+        raise DaemonError('%s is not a private directory of ours' % (path,))
+    return path
+
+def defaultSocketPath():
+    '''
+    $ADDRSYMFILT_DAEMON_SOCKET if set, otherwise a socket in a per-user
+    private directory in $XDG_RUNTIME_DIR (or the temp dir, where anyone
+    could otherwise have put something at the predictable path first).
+    Raises DaemonError if that directory is not safe to use.
+    '''
+    path = os.environ.get('ADDRSYMFILT_DAEMON_SOCKET')
+    if path:
+        return path
+    rundir = os.environ.get('XDG_RUNTIME_DIR') or tempfile.gettempdir()
+    private_dir = _privateDir(os.path.join(rundir,
+                                           'addrsymfilt-%d' % (os.getuid(),)))
+    return os.path.join(private_dir, 'daemon.sock')
+
+def _checkPeer(sock, socket_path):
+    '''
+    Make sure whoever is on the other end of the connected sock is running as
+    us, since we are going to unmarshal whatever it sends.
+    '''
+    if SO_PEERCRED is not None:
+        pid, uid, gid = PEERCRED.unpack(
+            sock.getsockopt(socket.SOL_SOCKET, SO_PEERCRED, PEERCRED.size))
+    else:
+        uid = os.stat(socket_path).st_uid
+    if uid != os.getuid():
+        raise DaemonError('%s belongs to uid %d, not us' % (socket_path, uid))
+
+def _recvExactly(sock, size):
+    chunks = []
+    while size:
+        chunk = sock.recv(size)
+        if not chunk:
+            raise DaemonError('connection closed')
+        chunks.append(chunk)
+        size -= len(chunk)
+    return ''.join(chunks)
+
+def sendMessage(sock, obj):
+    data = marshal.dumps(obj)
+    sock.sendall(LENGTH.pack(len(data)) + data)
+
+def recvMessage(sock):
+    size, = LENGTH.unpack(_recvExactly(sock, LENGTH.size))
+    return marshal.loads(_recvExactly(sock, size))
+
+
+class SymbolDaemonHandler(SocketServer.BaseRequestHandler):
+    '''
+    Serves all the requests on one client connection.
+    '''
+    def handle(self):
+        server = self.server
+        server.connectionOpened()
+        try:
+            while True:
+                try:
+                    request = recvMessage(self.request)
+                except DaemonError:
+                    return
+                server.touch()
+                try:
+                    response = (True, server.dispatch(request))
+                except Exception, e:
+                    response = (False, '%s: %s' % (e.__class__.__name__, e))
+                sendMessage(self.request, response)
+        finally:
+            server.connectionClosed()
+
+class SymbolDaemon(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    '''
+    Holds one BinaryInfo per distinct binary for every client.  Symbol loading
+    happens under a per-binary lock so that one client loading libxul does not
+    hold up everyone else; translation itself happens under one big lock since
+    we share a demangler.
+    '''
+    daemon_threads = True
+
+    def __init__(self, socket_path, symbol_cache=True):
+        if symbol_cache is True:
+            symbol_cache = symcache.SymbolCache.default()
+        self.symbol_cache = symbol_cache
+        self.socket_path = socket_path
+        #: (path, dev, inode, size, mtime) => handle
+        self.handles_by_identity = {}
+        #: handle => BinaryInfo
+        self.binaries = []
+        #: handle => lock held while loading that binary's symbols
+        self.load_locks = []
+        self.lock = threading.Lock()
+        self.num_connections = 0
+        self.last_activity = time.time()
+
+        old_umask = os.umask(077)
+        try:
+            SocketServer.UnixStreamServer.__init__(self, socket_path,
+                                                   SymbolDaemonHandler)
+        finally:
+            os.umask(old_umask)
+
+    def connectionOpened(self):
+        self.lock.acquire()
+        self.num_connections += 1
+        self.lock.release()
+
+    def connectionClosed(self):
+        self.lock.acquire()
+        self.num_connections -= 1
+        self.last_activity = time.time()
+        self.lock.release()
+
+    def touch(self):
+        self.last_activity = time.time()
+
+    def dispatch(self, request):
+        op = request[0]
+        if op == 'translate':
+            return self.translate(request[1], request[2], request[3])
+        elif op == 'open':
+            return self.open(request[1])
+        elif op == 'preload':
+            return self.preload(request[1])
+        raise DaemonError('unknown request: %r' % (op,))
+
+    def open(self, path):
+        st = os.stat(path)
+        identity = (path, st.st_dev, st.st_ino, st.st_size, st.st_mtime)
+        self.lock.acquire()
+        try:
+            handle = self.handles_by_identity.get(identity)
+            if handle is None:
+                handle = len(self.binaries)
+                self.binaries.append(
+                    addrsymfilt.BinaryInfo(path, self.symbol_cache))
+                self.load_locks.append(threading.Lock())
+                self.handles_by_identity[identity] = handle
+            return handle
+        finally:
+            self.lock.release()
+
+    def _ensureLoaded(self, handle):
+        binary = self.binaries[handle]
+        if binary.symbols is None:
+            load_lock = self.load_locks[handle]
+            load_lock.acquire()
+            try:
+                if binary.symbols is None:
+                    binary._loadSymbols()
+            finally:
+                load_lock.release()
+        return binary
+
+    def translate(self, handle, addrOffsets, raw):
+        binary = self._ensureLoaded(handle)
+        self.lock.acquire()
+        try:
+            return binary.translateAddresses(addrOffsets, raw)
+        finally:
+            self.lock.release()
+
+    def preload(self, handles):
+        def load_all():
+            for handle in handles:
+                try:
+                    self._ensureLoaded(handle)
+                except Exception, e:
+                    sys.stderr.write('Preloading %s failed: %s\n' %
+                                     (self.binaries[handle].path, e))
+        thread = threading.Thread(target=load_all)
+        thread.setDaemon(True)
+        thread.start()
+        return True
+
+    def serve(self, idle_timeout=0):
+        '''
+        Serve until killed or, if idle_timeout is non-zero, until nobody has
+        been connected for that many seconds.
+        '''
+        if idle_timeout:
+            # (wake up now and then to check whether we have been idle)
+            self.timeout = min(idle_timeout, 1.0)
+        else:
+            self.timeout = None
+        while True:
+            self.handle_request()
+            if (idle_timeout and not self.num_connections and
+                    time.time() - self.last_activity >= idle_timeout):
+                break
+
+    def server_close(self):
+        SocketServer.UnixStreamServer.server_close(self)
+        try:
+            os.unlink(self.socket_path)
+        except OSError:
+            pass
+
+
+class DaemonClient(object):
+    '''
+    One connection to the daemon.  Any failure talking to the daemon raises
+    DaemonError and marks us dead, after which our users are expected to do
+    things themselves.
+
+    If we get forked, the child makes its own connection the first time it
+    needs one rather than talking over the parent's.
+    '''
+    def __init__(self, socket_path=None):
+        self.dead = False
+        if socket_path is None:
+            try:
+                socket_path = defaultSocketPath()
+            except DaemonError:
+                self.dead = True
+                raise
+        self.socket_path = socket_path
+        self._connect()
+
+    def _connect(self):
+        self.pid = os.getpid()
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            self.sock.connect(self.socket_path)
+            _checkPeer(self.sock, self.socket_path)
+        except (socket.error, OSError, DaemonError), e:
+            self.sock.close()
+            self.dead = True
+            if isinstance(e, DaemonError):
+                raise
+            raise DaemonError('unable to connect to %s: %s' %
+                              (self.socket_path, e))
+
+    def call(self, *request):
+        if self.dead:
+            raise DaemonError('daemon connection already failed')
+        try:
+            if self.pid != os.getpid():
+                # (closing our copy of the parent's socket does not hurt it)
+                self.sock.close()
+                self._connect()
+            sendMessage(self.sock, request)
+            ok, result = recvMessage(self.sock)
+        except (socket.error, DaemonError, EOFError, ValueError), e:
+            self.close()
+            sys.stderr.write('Lost the symbol daemon (%s); symbolizing '
+                             'in-process from here on.\n' % (e,))
+            raise DaemonError('lost the daemon: %s' % (e,))
+        if not ok:
+            raise DaemonError(result)
+        return result
+
+    def close(self):
+        self.dead = True
+        self.sock.close()
+
+class RemoteBinaryInfo(object):
+    '''
+    Stands in for a BinaryInfo by asking the daemon.  If the daemon cannot
+    help us, we turn into a regular in-process BinaryInfo for the rest of our
+    life.
+    '''
+    def __init__(self, path, client, symbolCache=None):
+        self.path = path
+        self.client = client
+        self.symbolCache = symbolCache
+        self.handle = None
+        #: the BinaryInfo we fell back to, if we had to
+        self.local = None
+        # (ProcInfo.start_preload looks at these)
+        self.symbols = None
+        self.pendingLoad = None
+
+    def _fallBack(self):
+        if self.local is None:
+            self.local = addrsymfilt.BinaryInfo(self.path, self.symbolCache)
+        return self.local
+
+    def getHandle(self):
+        if self.handle is None:
+            self.handle = self.client.call('open', self.path)
+        return self.handle
+
+    def startPreload(self, pool):
+        self._fallBack().startPreload(pool)
+
+    def translateAddress(self, addr, offset, raw=False):
+        return self.translateAddresses([(addr, offset)], raw)[0]
+
+    def translateAddresses(self, addrOffsets, raw=False):
+        if self.local is None:
+            try:
+                return self.client.call('translate', self.getHandle(),
+                                        addrOffsets, raw)
+            except DaemonError, e:
+                if not self.client.dead:
+                    # (the daemon is fine, it just could not help with us)
+                    sys.stderr.write('Symbolizing %s in-process: %s\n' %
+                                     (self.path, e))
+                self._fallBack()
+        return self.local.translateAddresses(addrOffsets, raw)
+
+class DaemonProcInfo(addrsymfilt.ProcInfo):
+    '''
+    ProcInfo that symbolizes through the daemon if it is running and
+    in-process if it is not.  Takes all of ProcInfo's arguments plus
+    socket_path.
+    '''
+    def __init__(self, pid, mappath=None, socket_path=None, **kwargs):
+        try:
+            self.client = DaemonClient(socket_path)
+        except DaemonError, e:
+            self.client = None
+        addrsymfilt.ProcInfo.__init__(self, pid, mappath, **kwargs)
+
+    def _make_binary(self, path):
+        if self.client is None:
+            return addrsymfilt.ProcInfo._make_binary(self, path)
+        return RemoteBinaryInfo(path, self.client, self.symbol_cache)
+
+    def start_preload(self, preload=True, jobs=None):
+        '''
+        With a daemon, preloading means asking the daemon to go load things
+        (if it does not have them already) while we get on with our work.
+        '''
+        if self.client is None:
+            return addrsymfilt.ProcInfo.start_preload(self, preload, jobs)
+        if preload is True:
+            wanted = lambda path: True
+        else:
+            wanted = re.compile(preload).search
+        try:
+            handles = [binary.getHandle()
+                       for path, binary in self.binaries_by_path.items()
+                       if wanted(path)]
+            self.client.call('preload', handles)
+        except DaemonError, e:
+            # the binaries fall back on their own when they get used.
+            pass
+
+
+def main():
+    parser = optparse.OptionParser(
+        usage='usage: %prog [--socket PATH] [--idle-timeout SECS]')
+    parser.add_option('--socket', dest='socket_path', default=None,
+                      help='Unix domain socket to listen on.')
+    parser.add_option('--idle-timeout', dest='idle_timeout', type='float',
+                      default=0,
+                      help='Exit after this many seconds without any ' +
+                           'clients; 0 means run until killed.')
+    options, args = parser.parse_args()
+    if options.socket_path is None:
+        try:
+            options.socket_path = defaultSocketPath()
+        except DaemonError, e:
+            sys.stderr.write('%s\n' % (e,))
+            return 1
+
+    # Clean up after a daemon that died without removing its socket, but do
+    #  not stomp on one that is still alive (or on someone else's).
+    if os.path.exists(options.socket_path):
+        if os.lstat(options.socket_path).st_uid != os.getuid():
+            sys.stderr.write('%s belongs to someone else\n' %
+                             (options.socket_path,))
+            return 1
+        try:
+            DaemonClient(options.socket_path).close()
+            sys.stderr.write('A daemon is already listening on %s\n' %
+                             (options.socket_path,))
+            return 1
+        except DaemonError:
+            os.unlink(options.socket_path)
+
+    server = SymbolDaemon(options.socket_path)
+    try:
+        server.serve(options.idle_timeout)
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())